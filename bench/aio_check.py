@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+"""
+Exercise the `asyncssh` backend against a fake SSH server.
+
+The server runs on the loopback interface and executes each command
+locally with `bash`.  A fake `sudo` on the server's `PATH` prints its
+prompt in two pieces and checks the password, so the prompt has to be
+matched across reads.  The command `drop-channel` closes the channel
+without an exit status.
+
+Example::
+
+    $ pipenv run python bench/aio_check.py
+"""
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import asyncssh
+from invoke import Exit
+from deployer import aio
+
+PASSWORD = "s3cret"
+FAKE_SUDO = r"""#! /bin/bash
+prompt=""
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -p) prompt="$2"; shift 2 ;;
+        -S|-H|-n|-v) shift ;;
+        *) break ;;
+    esac
+done
+half=$(( ${#prompt} / 2 ))
+printf '%s' "${prompt:0:$half}" >&2
+sleep 0.2
+printf '%s' "${prompt:$half}" >&2
+IFS= read -r pw
+if [ "$pw" != "$FAKE_SUDO_PASSWORD" ]; then
+    echo "sudo: wrong password" >&2
+    exit 1
+fi
+exec "$@"
+"""
+
+class FakeServer(asyncssh.SSHServer):
+    def begin_auth(self, username):
+        return False
+
+def make_handler(bin_dir):
+    env = dict(os.environ)
+    env['PATH'] = "{}:{}".format(bin_dir, env['PATH'])
+    env['FAKE_SUDO_PASSWORD'] = PASSWORD
+
+    async def handle(process):
+        if process.command == "drop-channel":
+            process.close()
+            return
+        proc = await asyncio.create_subprocess_exec(
+            "bash", "-c", process.command,
+            env=env,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        await process.redirect(stdin=proc.stdin, stdout=proc.stdout, stderr=proc.stderr)
+        status = await proc.wait()
+        await process.stdout.drain()
+        await process.stderr.drain()
+        process.exit(status)
+
+    return handle
+
+async def start_server(bin_dir):
+    key = asyncssh.generate_private_key('ssh-ed25519')
+    return await asyncssh.create_server(
+        FakeServer, '127.0.0.1', 0,
+        server_host_keys=[key],
+        process_factory=make_handler(bin_dir),
+        encoding=None)
+
+def expect_exit(label, func):
+    try:
+        func()
+    except Exit as ex:
+        print("[ok] {}: {}".format(label, ex))
+        return
+    raise AssertionError("{} did not raise Exit".format(label))
+
+def check(port):
+    conn = aio.AsyncSSHConnection(
+        "127.0.0.1:{}".format(port),
+        sudo_passwd=PASSWORD,
+        echo=False,
+        connect_kwargs={'known_hosts': None, 'username': 'bench'})
+    result = conn.run("echo hello", hide=True)
+    assert result.stdout == "hello\n", result
+    print("[ok] run")
+    result = conn.run("exit 3", hide=True, warn=True)
+    assert result.return_code == 3, result
+    print("[ok] run with warn")
+    expect_exit("failed command", lambda: conn.run("exit 4", hide=True))
+    expect_exit("dropped channel", lambda: conn.run("drop-channel", hide=True, warn=True))
+    result = conn.sudo("echo root", hide=True)
+    assert result.stdout == "root\n", result
+    assert result.stderr == "", result
+    print("[ok] sudo prompt split across reads")
+    stdout = conn.pipe("wc -c", [b"x" * 100000, b"y" * 5])
+    assert stdout.strip() == "100005", stdout
+    print("[ok] pipe")
+    expect_exit("failed pipe", lambda: conn.pipe("cat >/dev/null; exit 2", [b"data"]))
+    expect_exit("dropped pipe", lambda: conn.pipe("drop-channel", [b"data"]))
+    aio.close_connections()
+    assert conn.aconn._conn is None
+    print("[ok] close connections")
+
+def main():
+    bin_dir = tempfile.mkdtemp(prefix="aio-check-")
+    try:
+        sudo_path = os.path.join(bin_dir, "sudo")
+        with open(sudo_path, "w") as f:
+            f.write(FAKE_SUDO)
+        os.chmod(sudo_path, 0o755)
+        loop_thread = aio.get_loop_thread()
+        server = loop_thread.call(start_server(bin_dir))
+        port = server.sockets[0].getsockname()[1]
+        try:
+            check(port)
+        finally:
+            server.close()
+    finally:
+        shutil.rmtree(bin_dir)
+
+if __name__ == '__main__':
+    main()
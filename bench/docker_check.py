@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+"""
+Exercise the docker helpers against `bench/docker_shim.py`, a fake
+`docker` command line that only records containers in a state file.
+
+Registry references are checked for build names with registry ports, and
+`docker_replace()` is run with no slot, one slot, and both slots running,
+and with a container that never becomes ready.
+
+Example::
+
+    $ pipenv run python bench/docker_check.py
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from invoke import Context, Exit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from deployer import docker
+
+class FakeConfig(object):
+    """
+    The subset of `Config` the docker helpers read.
+    """
+    stage = 'prod'
+
+    def __init__(self, build_name, registry=None, replace=None):
+        self.build_name = build_name
+        self.registry = registry
+        self.replace = replace
+
+    def get_docker_build_name(self):
+        return self.build_name
+
+    def get_docker_registry(self):
+        return self.registry
+
+    def get_docker_distribute(self):
+        return None if self.registry is None else 'registry'
+
+    def get_docker_run_args(self):
+        return []
+
+    def get_docker_replace_settings(self):
+        return self.replace
+
+class LocalHost(object):
+    """
+    Runs commands locally with the shim first on the `PATH`.
+    """
+    host = 'localhost'
+
+    def __init__(self, env):
+        self.invoker = Context()
+        self.env = env
+
+    def run(self, command, **kwargs):
+        kwargs.setdefault('hide', True)
+        return self.invoker.run(command, env=self.env, **kwargs)
+
+    def sudo(self, command, **kwargs):
+        return self.run(command, **kwargs)
+
+def check_registry_refs():
+    cases = [
+        (FakeConfig('app', 'registry.example.com'), 'registry.example.com/app:prod'),
+        (FakeConfig('app:1.0', 'registry.example.com/'), 'registry.example.com/app:prod'),
+        (FakeConfig('localhost:5000/team/app', 'localhost:5000'), 'localhost:5000/localhost:5000/team/app:prod'),
+        (FakeConfig('localhost:5000/team/app:1.0', 'r:5000'), 'r:5000/localhost:5000/team/app:prod'),
+        (FakeConfig('team/app@sha256:abcd', 'r:5000'), 'r:5000/team/app:prod'),
+    ]
+    for config, expected in cases:
+        ref = docker.registry_ref(config, 'prod')
+        assert ref == expected, (config.build_name, ref)
+    print("[ok] registry references")
+
+def containers(state_dir):
+    with open(os.path.join(state_dir, "state.json")) as f:
+        return dict((name, c['state']) for name, c in json.load(f)['containers'].items())
+
+def check_replace(conn, state_dir):
+    settings = {'name': 'app', 'timeout': 2, 'interval': 1}
+    config = FakeConfig('app', replace=settings)
+    docker.docker_replace(conn, config)
+    assert containers(state_dir) == {'app-blue': 'running'}, containers(state_dir)
+    print("[ok] replace with no container running")
+    docker.docker_replace(conn, config)
+    assert containers(state_dir) == {'app-green': 'running'}, containers(state_dir)
+    print("[ok] replace the running slot")
+    conn.run("docker run -d --name app-blue app")
+    time.sleep(0.01)
+    docker.docker_replace(conn, config)
+    assert containers(state_dir) == {'app-green': 'running'}, containers(state_dir)
+    print("[ok] replace with both slots running")
+    try:
+        docker.docker_replace(conn, FakeConfig('app-unready', replace=settings))
+    except Exit as ex:
+        print("[ok] unready container: {}".format(ex))
+    else:
+        raise AssertionError("an unready container replaced the running one")
+    assert containers(state_dir) == {'app-green': 'running'}, containers(state_dir)
+
+def main():
+    state_dir = tempfile.mkdtemp(prefix="docker-check-")
+    try:
+        bin_dir = os.path.join(state_dir, "bin")
+        os.mkdir(bin_dir)
+        shim = os.path.join(bin_dir, "docker")
+        with open(shim, "w") as f:
+            f.write("#! /bin/sh\nexec {} {} \"$@\"\n".format(
+                sys.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "docker_shim.py")))
+        os.chmod(shim, 0o755)
+        env = {
+            'PATH': "{}:{}".format(bin_dir, os.environ['PATH']),
+            'FAKE_DOCKER_STATE': state_dir,
+        }
+        check_registry_refs()
+        check_replace(LocalHost(env), state_dir)
+    finally:
+        shutil.rmtree(state_dir)
+
+if __name__ == '__main__':
+    main()
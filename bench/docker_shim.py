@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+"""
+A stand-in for the `docker` command line used by `bench/docker_check.py`.
+
+Only the sub-commands and options the deployer uses are understood.
+Containers don't run anything; their names, images, states, and start
+times are kept in `state.json` in the folder named by the
+`FAKE_DOCKER_STATE` environment variable, and every invocation is
+appended to `calls.log` there.  A container started from an image whose
+name contains `unready` never becomes ready.
+"""
+
+import json
+import os
+import sys
+import time
+
+def state_dir():
+    return os.environ['FAKE_DOCKER_STATE']
+
+def load_state():
+    try:
+        with open(os.path.join(state_dir(), "state.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'containers': {}, 'images': []}
+
+def save_state(state):
+    with open(os.path.join(state_dir(), "state.json"), "w") as f:
+        json.dump(state, f)
+
+def fail(message):
+    print(message, file=sys.stderr)
+    sys.exit(1)
+
+def render(fmt, name, container):
+    if "StartedAt" in fmt:
+        return "{} /{}".format(container['started'], name)
+    if container['state'] == 'running' and 'unready' in container['image']:
+        return "starting"
+    return container['state']
+
+def main(args):
+    with open(os.path.join(state_dir(), "calls.log"), "a") as f:
+        f.write(' '.join(args) + "\n")
+    state = load_state()
+    containers = state['containers']
+    command, args = args[0], args[1:]
+    if command == 'ps':
+        for name, container in sorted(containers.items()):
+            print("{} {}".format(name, container['state']))
+    elif command == 'inspect':
+        fmt = args[1]
+        for name in args[2:]:
+            if not name in containers:
+                fail("Error: No such object: {}".format(name))
+            print(render(fmt, name, containers[name]))
+    elif command == 'run':
+        name = args[args.index('--name') + 1]
+        if name in containers:
+            fail("Conflict. The container name \"/{}\" is already in use.".format(name))
+        now = time.time()
+        started = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now)) + ".{:09d}Z".format(int(now % 1 * 1e9))
+        containers[name] = {'image': args[-1], 'state': 'running', 'started': started}
+    elif command == 'stop':
+        containers[args[0]]['state'] = 'exited'
+    elif command == 'rm':
+        for name in args:
+            if name == '-f':
+                continue
+            if containers.get(name, {}).get('state', None) == 'running' and not '-f' in args:
+                fail("Error: container {} is running.".format(name))
+            containers.pop(name, None)
+    elif command in ('pull', 'tag', 'build', 'push', 'load', 'logs'):
+        if command == 'tag':
+            state['images'].append(args[1])
+    else:
+        fail("docker_shim: unsupported command '{}'".format(command))
+    save_state(state)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
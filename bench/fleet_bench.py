@@ -0,0 +1,284 @@
+#! /usr/bin/env python
+"""
+Benchmark `deploy.py` sub-commands against a simulated fleet.
+
+Each simulated host is a folder on the local machine.  Remote commands
+run locally with the host's folder standing in for `/etc` and the config
+folder.  Every command and upload is delayed by a simulated round trip
+time and bandwidth.  A synthetic configuration repository of the
+requested size (plain files, templates with secrets, `__perms__` entries,
+and an `etc` overlay) is generated for the run.
+
+Example::
+
+    $ pipenv run python bench/fleet_bench.py --hosts 20 --files 500 --rtt-ms 30 -P 10 --batch
+
+Commands run as the invoking user with the owner and group set to that
+user, so no root access is needed.
+"""
+
+import argparse
+import getpass
+import grp
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import yaml
+from invoke import Context
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import deploy
+from deployer.config import Config
+from deployer.etc import ETC_BACKUP_ROOT
+from deployer import etc, profiling
+
+APP = "benchapp"
+# The config folder on every simulated host.  Mapped into the host's folder.
+REMOTE_PREFIX = "/srv/deployer-bench"
+
+class FakeHost(object):
+    """
+    A simulated host.  Commands run on the local machine with `/etc`, the
+    `/etc` backup folder, and `REMOTE_PREFIX` mapped into `root`.  Each command costs one
+    round trip of `rtt` seconds, and uploads cost `size / bandwidth` more.
+    """
+    def __init__(self, host, root, rtt, bandwidth):
+        self.host = host
+        self.root = root
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.invoker = Context()
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(root, "etc"), exist_ok=True)
+        os.makedirs(root + REMOTE_PREFIX, exist_ok=True)
+
+    def localize(self, text):
+        text = text.replace(ETC_BACKUP_ROOT, self.root + ETC_BACKUP_ROOT)
+        text = text.replace(REMOTE_PREFIX, self.root + REMOTE_PREFIX)
+        return text.replace("'/etc'", "'{}/etc'".format(self.root))
+
+    def _round_trip(self, size=0):
+        with self.lock:
+            self.round_trips += 1
+            self.bytes_sent += size
+        delay = self.rtt
+        if self.bandwidth > 0:
+            delay += size / self.bandwidth
+        time.sleep(delay)
+
+    def run(self, command, **kwargs):
+        self._round_trip(len(command))
+        kwargs.setdefault('hide', True)
+        kwargs.pop('pty', None)
+        return self.invoker.run(self.localize(command), **kwargs)
+
+    def sudo(self, command, **kwargs):
+        return self.run(command, **kwargs)
+
+    def put(self, local, remote=None, **kwargs):
+        if isinstance(local, io.BytesIO):
+            data = self.localize(local.getvalue().decode('utf-8')).encode('utf-8')
+        else:
+            with open(local, "rb") as f:
+                data = f.read()
+        self._round_trip(len(data))
+        with open(remote, "wb") as f:
+            f.write(data)
+
+    def pipe(self, command, chunks):
+        data = b''.join(chunks)
+        self._round_trip(len(command) + len(data))
+        command = self.localize(command).replace("sudo -n ", "")
+        proc = subprocess.run(["bash", "-c", command], input=data, stdout=subprocess.PIPE, check=True)
+        return proc.stdout.decode('utf-8')
+
+    def cd(self, path):
+        return self.invoker.cd(path)
+
+def write_file(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+def make_repo(path, files, templates, perms, etc_files, size):
+    """
+    Create a synthetic configuration repository at `path` and return the
+    name of its branch.  Secrets are "encrypted" with a GnuPG stand-in
+    that passes data through unchanged.
+    """
+    padding = "x" * max(size - 40, 0)
+    for n in range(files):
+        write_file(os.path.join(path, "conf{}".format(n % 10), "file{}.cfg".format(n)), "value = {}\n{}\n".format(n, padding))
+    secrets = {'files': {}}
+    for n in range(templates):
+        name = "templates/t{}.cfg.template".format(n)
+        write_file(os.path.join(path, name), "password = {{ password }}\nvalue = %d\n" % n)
+        secrets['files'][name] = {'secrets': {'password': "secret{}".format(n)}}
+    write_file(os.path.join(path, "secrets.yml.secret"), yaml.safe_dump(secrets))
+    write_file(os.path.join(path, ".gitsecret", "paths", "mapping.cfg"), "secrets.yml:0\n")
+    user = getpass.getuser()
+    group = grp.getgrgid(os.getgid()).gr_name
+    lines = []
+    for n in range(min(perms, files)):
+        if n % 10 == 0:
+            lines.append("file{}.cfg:{}:{}:u=rw,g=r,o=".format(n, user, group))
+    for n in range(10):
+        folder_lines = [line for line in lines if int(line.split(':')[0][4:-4]) % 10 == n]
+        if len(folder_lines) > 0:
+            write_file(os.path.join(path, "conf{}".format(n), "__perms__"), '\n'.join(folder_lines) + '\n')
+    for n in range(etc_files):
+        write_file(os.path.join(path, "etc", APP, "conf.d", "e{}.conf".format(n)), "setting {}\n".format(n))
+    if etc_files > 0:
+        write_file(os.path.join(path, "etc", APP, "conf.d", "__perms__"), "e0.conf:{}:{}:u=rw,g=r,o=\n".format(user, group))
+    git = lambda *args: subprocess.run(['git'] + list(args), cwd=path, check=True, stdout=subprocess.DEVNULL)
+    git('init', '-q', '-b', 'bench')
+    git('add', '-A')
+    git('-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '-q', '-m', 'Synthetic configuration.')
+    return 'bench'
+
+def change_repo(path, n):
+    """
+    Commit a change to one file of the synthetic repository.
+    """
+    with open(os.path.join(path, "conf0", "file0.cfg"), "a") as f:
+        f.write("change = {}\n".format(n))
+    subprocess.run(
+        ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '-q', '-am', 'Change {}.'.format(n)],
+        cwd=path,
+        check=True)
+
+def make_fake_gpg(workdir):
+    path = os.path.join(workdir, "fake-gpg")
+    write_file(path, "#!/bin/sh\nexec cat\n")
+    os.chmod(path, 0o755)
+    return path
+
+def make_config(workdir, repo, hosts, keep_releases):
+    """
+    Return the deployment configuration for the synthetic repository.
+    """
+    settings = {
+        'working-tree': repo,
+        'targets': {
+            'config-folder': "{}/{}".format(REMOTE_PREFIX, APP),
+            'config-owner': getpass.getuser(),
+            'config-group': grp.getgrgid(os.getgid()).gr_name,
+            'keep-releases': keep_releases,
+        },
+        'roles': {'bench': {'target-hosts': [host.host for host in hosts]}},
+        'archive_cache': {
+            'path': os.path.join(workdir, "cache", "archives"),
+            'template_path': os.path.join(workdir, "cache", "templates"),
+        },
+    }
+    return Config(settings=settings, stage='bench', invoker=Context(), conn_pool=hosts)
+
+def deploy_args(opts):
+    """
+    Return the `deploy-config` arguments for the benchmark options.
+    """
+    return argparse.Namespace(
+        config=None,
+        stage='bench',
+        sudo_passwd=None,
+        pty=False,
+        backend='fabric',
+        exclude_host=[],
+        host=[],
+        label=[],
+        parallel=opts.parallel,
+        commit=None,
+        add_config=[],
+        archive=None,
+        no_etc=False,
+        legacy_archive=False,
+        no_archive_cache=opts.no_archive_cache,
+        delta=opts.delta,
+        batch=opts.batch,
+        stream=opts.stream,
+        force=opts.force)
+
+def phase_times(recorder, hosts):
+    """
+    Return the mean time per host spent in each phase.
+    """
+    totals = {}
+    for span in recorder.spans:
+        if span.kind != 'phase':
+            continue
+        totals[span.name] = totals.get(span.name, 0.0) + span.elapsed
+    divisor = dict((name, 1 if name == "create local archive" else len(hosts)) for name in totals)
+    return sorted(((name, total / divisor[name]) for name, total in totals.items()), key=lambda item: -item[1])
+
+def run_scenario(name, opts, cfg, hosts):
+    for host in hosts:
+        host.round_trips = 0
+        host.bytes_sent = 0
+    profiling.RECORDER.spans = []
+    profiling.RECORDER.enable()
+    start = time.time()
+    deploy.deploy_config(deploy_args(opts))
+    elapsed = time.time() - start
+    print()
+    print("=== {} ===".format(name))
+    print("{} host(s) in {:.2f}s: {:.1f} hosts/minute".format(len(hosts), elapsed, len(hosts) * 60.0 / elapsed))
+    print("Round trips per host: {:.1f}".format(sum(h.round_trips for h in hosts) / float(len(hosts))))
+    print("Bytes sent per host: {:.0f}".format(sum(h.bytes_sent for h in hosts) / float(len(hosts))))
+    print("Mean time per host by phase:")
+    for phase_name, seconds in phase_times(profiling.RECORDER, hosts)[:opts.top]:
+        print("  {:8.3f}s  {}".format(seconds, phase_name))
+
+def main(opts):
+    workdir = tempfile.mkdtemp(prefix="deployer-bench-")
+    try:
+        os.environ['SECRETS_GPG_COMMAND'] = make_fake_gpg(workdir)
+        repo = os.path.join(workdir, "repo")
+        make_repo(repo, opts.files, opts.templates, opts.perms, opts.etc, opts.file_size)
+        hosts = [
+            FakeHost(
+                "host{:03d}".format(n),
+                os.path.join(workdir, "hosts", "host{:03d}".format(n)),
+                opts.rtt_ms / 1000.0,
+                opts.bandwidth_mbps * 125000.0)
+            for n in range(opts.hosts)]
+        cfg = make_config(workdir, repo, hosts, opts.keep_releases)
+        deploy.load_config = lambda *args, **kwargs: cfg
+        etc.ETC_OWNER = getpass.getuser()
+        etc.ETC_GROUP = grp.getgrgid(os.getgid()).gr_name
+        run_scenario("initial deploy", opts, cfg, hosts)
+        run_scenario("redeploy, nothing changed", opts, cfg, hosts)
+        change_repo(repo, 1)
+        run_scenario("redeploy, one file changed", opts, cfg, hosts)
+    finally:
+        if opts.keep:
+            print("Kept {}".format(workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark deploy-config against a simulated fleet.")
+    parser.add_argument("--hosts", type=int, default=10, help="Number of simulated hosts.")
+    parser.add_argument("--files", type=int, default=200, help="Plain files in the synthetic repository.")
+    parser.add_argument("--templates", type=int, default=10, help="Templates with secrets.")
+    parser.add_argument("--perms", type=int, default=50, help="Files considered for `__perms__` entries (every tenth gets one).")
+    parser.add_argument("--etc", type=int, default=10, help="Files in the `etc` overlay.")
+    parser.add_argument("--file-size", type=int, default=512, help="Approximate size of each plain file in bytes.")
+    parser.add_argument("--rtt-ms", type=float, default=20.0, help="Simulated round trip time per command.")
+    parser.add_argument("--bandwidth-mbps", type=float, default=100.0, help="Simulated upload bandwidth (0 for unlimited).")
+    parser.add_argument("-P", "--parallel", type=int, default=1, help="Hosts to deploy to at once.")
+    parser.add_argument("--batch", action="store_true", help="Deploy with `--batch`.")
+    parser.add_argument("--delta", action="store_true", help="Deploy with `--delta`.")
+    parser.add_argument("--force", action="store_true", help="Deploy with `--force`.")
+    parser.add_argument("--stream", action="store_true", help="Deploy with `--stream`.")
+    parser.add_argument("--keep-releases", type=int, default=0, help="Keep releases on the hosts.")
+    parser.add_argument("--no-archive-cache", action="store_true", help="Deploy with `--no-archive-cache`.")
+    parser.add_argument("--top", type=int, default=12, help="Phases to show per scenario.")
+    parser.add_argument("--keep", action="store_true", help="Keep the working folder.")
+    main(parser.parse_args())
@@ -2,102 +2,338 @@
 
 import argparse
 import getpass
+import os
 import sys
 from deployer.config import load_config
+from deployer import aio
 from deployer import config_deployer
+from deployer import deploy_plan
 from deployer import docker
+from deployer import etc
 from deployer import introspect
 from deployer import package_deployer
+from deployer import profiling
+from deployer import releases
+from deployer import rollout
+from deployer import scheduler
+from deployer import secrets_session
+from deployer import sshmux
 from deployer.shellfuncs import shellquote
+from deployer.terminal import warn
+from invoke import Exit
 
-def print_host_banner(conn):
+def filter_conn_pool(pool, selected_hosts):
     """
-    Print the host banner.
+    Only produce connections to the selected hosts.
     """
-    msg = "=== [Connected to {}] ===".format(conn.host)
-    border = "=" * len(msg)
-    print()
-    print(border)
-    print(msg)
-    print(border)
-    print()
+    for conn in pool:
+        if not conn.host in selected_hosts:
+            continue
+        yield profiling.instrument(conn)
 
-def filter_conn_pool(pool, excluded_hosts):
+def select_hosts(cfg, args):
     """
-    Only produce connections that haven't been excluded.
+    Return the hosts of the stage chosen by the `--host`, `--label`, and
+    `--exclude-host` options.
     """
-    for conn in pool:
-        if conn.host in excluded_hosts:
-            continue
-        yield conn
+    hosts = cfg.get_inventory().select(cfg.stage, args.host, args.label, args.exclude_host)
+    if len(hosts) == 0 and (len(args.host) > 0 or len(args.label) > 0):
+        raise Exit("No hosts of stage `{}` match the selection.".format(cfg.stage))
+    return set(hosts)
+
+def warn_shadowed_hosts(cfg, hosts):
+    """
+    Warn about hosts that belong to a role with a higher priority than
+    the stage being deployed.
+    """
+    for host, role in cfg.get_inventory().shadowed(cfg.stage, sorted(hosts)):
+        warn("Host `{}` also belongs to role `{}`, which has a higher priority than `{}`.".format(
+            host, role, cfg.stage))
 
 def deploy_config(args):
     """
     Deploy a configuration.
     """
-    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty)
-    invoker = cfg.invoker
-    archive_path = config_deployer.create_local_archive(invoker, cfg, args.commit)
+    if len(args.add_config) > 0:
+        deploy_configs(args)
+        return
+    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty, args.backend)
+    selected_hosts = select_hosts(cfg, args)
+    warn_shadowed_hosts(cfg, selected_hosts)
+    invoker = profiling.instrument(cfg.invoker, profiling.LOCAL_HOST)
+    commit = config_deployer.resolve_commit(cfg, args.commit)
+    with profiling.phase("create local archive"):
+        archive_path = config_deployer.create_local_archive(
+            invoker,
+            cfg,
+            args.commit,
+            legacy=args.legacy_archive,
+            use_cache=not args.no_archive_cache)
     if not args.archive is None:
         invoker.run("mv {} {}".format(shellquote(archive_path), shellquote(args.archive)))
+    docker_image = None
     try:
-        pool = filter_conn_pool(cfg.conn_pool, set(args.exclude_host))
-        for conn in pool:
-            print_host_banner(conn)
-            config_deployer.deploy_config(
+        pool = filter_conn_pool(cfg.conn_pool, selected_hosts)
+        move_etc = (not args.no_etc) and (args.archive is None)
+        if cfg.is_docker_build_target():
+            with profiling.phase("build docker image"):
+                docker_image = docker.build_image_once(invoker, cfg, archive_path, commit, move_etc)
+        results = rollout.rolling_run(
+            pool,
+            lambda conn: config_deployer.deploy_config(
                 conn,
                 cfg,
                 archive_path,
-                move_etc=(not args.no_etc) and (args.archive is None))
+                move_etc=move_etc,
+                delta=args.delta,
+                batch=args.batch,
+                baked_perms=not args.legacy_archive,
+                skip_unchanged=(not args.force) and (args.archive is None),
+                commit=commit,
+                docker_image=docker_image,
+                stream=args.stream),
+            rollout.parse_rollout(cfg.get_rollout_settings()),
+            args.parallel)
+        scheduler.check_results(results)
+    finally:
+        docker.remove_image_archive(docker_image)
+        invoker.run("rm {}".format(shellquote(archive_path)))
+
+def deploy_configs(args):
+    """
+    Deploy several configurations to a stage.  The archives are built
+    concurrently and each host gets all of its configurations in one
+    session.
+    """
+    if not args.commit is None:
+        raise Exit("`--commit` can't be used with `--add-config`.")
+    if not args.archive is None:
+        raise Exit("`--archive` can't be used with `--add-config`.")
+    names = [args.config] + args.add_config
+    if len(set(names)) < len(names):
+        raise Exit("A configuration is listed more than once.")
+    deployments = []
+    hosts_by_name = {}
+    conns = {}
+    for name in names:
+        cfg = load_config(name, args.stage, args.sudo_passwd, args.pty, args.backend)
+        selected_hosts = set(cfg.get_inventory().select(cfg.stage, args.host, args.label, args.exclude_host))
+        warn_shadowed_hosts(cfg, selected_hosts)
+        hosts_by_name[name] = selected_hosts
+        for conn in cfg.conn_pool:
+            if conn.host in selected_hosts and not conn.host in conns:
+                conns[conn.host] = conn
+        deployments.append(config_deployer.Deployment(name, cfg, commit=config_deployer.resolve_commit(cfg, None)))
+    if len(conns) == 0:
+        raise Exit("No hosts of stage `{}` match the selection.".format(args.stage))
+    rollouts = [rollout.parse_rollout(d.config.get_rollout_settings()) for d in deployments]
+    if any(r != rollouts[0] for r in rollouts[1:]):
+        raise Exit("The configurations have different `rollout` settings for stage `{}`.".format(args.stage))
+    invokers = [profiling.instrument(d.config.invoker, profiling.LOCAL_HOST) for d in deployments]
+    move_etc = not args.no_etc
+    try:
+        config_deployer.create_local_archives(
+            deployments,
+            invokers,
+            legacy=args.legacy_archive,
+            use_cache=not args.no_archive_cache)
+        if move_etc:
+            conflicts = deploy_plan.find_etc_conflicts(deployments, hosts_by_name)
+            if len(conflicts) > 0:
+                for path, conflict_names in conflicts:
+                    print("/etc/{}: {}".format(path, ', '.join(conflict_names)), file=sys.stderr)
+                raise Exit("{} `/etc` path(s) are deployed differently by more than one configuration.".format(len(conflicts)))
+        for deployment, invoker in zip(deployments, invokers):
+            if deployment.config.is_docker_build_target():
+                with profiling.phase("build docker image ({})".format(deployment.name)):
+                    deployment.docker_image = docker.build_image_once(
+                        invoker,
+                        deployment.config,
+                        deployment.archive_path,
+                        deployment.commit,
+                        move_etc)
+        pool = [profiling.instrument(conn) for conn in conns.values()]
+        results = rollout.rolling_run(
+            pool,
+            lambda conn: config_deployer.deploy_configs(
+                conn,
+                [d for d in deployments if conn.host in hosts_by_name[d.name]],
+                move_etc=move_etc,
+                delta=args.delta,
+                batch=args.batch,
+                baked_perms=not args.legacy_archive,
+                skip_unchanged=not args.force,
+                stream=args.stream),
+            rollouts[0],
+            args.parallel)
+        scheduler.check_results(results)
+    finally:
+        for deployment in deployments:
+            docker.remove_image_archive(deployment.docker_image)
+            if deployment.archive_path is not None:
+                os.unlink(deployment.archive_path)
+
+def plan(args):
+    """
+    Show what `deploy-config` would change on each host.
+    """
+    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty, args.backend)
+    selected_hosts = select_hosts(cfg, args)
+    warn_shadowed_hosts(cfg, selected_hosts)
+    invoker = profiling.instrument(cfg.invoker, profiling.LOCAL_HOST)
+    with profiling.phase("create local archive"):
+        archive_path = config_deployer.create_local_archive(
+            invoker,
+            cfg,
+            args.commit,
+            use_cache=not args.no_archive_cache)
+    try:
+        pool = filter_conn_pool(cfg.conn_pool, selected_hosts)
+        host_plans = {}
+
+        def plan_one(conn):
+            host_plan = deploy_plan.plan_host(conn, cfg, archive_path, move_etc=not args.no_etc)
+            deploy_plan.print_host_plan(host_plan)
+            host_plans[conn.host] = host_plan
+
+        results = scheduler.run_on_hosts(pool, plan_one, args.parallel, keep_going=True)
+        deploy_plan.print_plan_summary(list(host_plans.values()))
+        scheduler.check_results(results)
     finally:
         invoker.run("rm {}".format(shellquote(archive_path)))
 
+def rollback(args):
+    """
+    Point the config folder on each host back at an earlier release.
+    """
+    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty, args.backend)
+    pool = list(filter_conn_pool(cfg.conn_pool, select_hosts(cfg, args)))
+    parallel = args.parallel
+    if parallel <= 1:
+        parallel = max(len(pool), 1)
+    results = scheduler.run_on_hosts(
+        pool,
+        lambda conn: releases.rollback(conn, cfg, args.release, move_etc=not args.no_etc),
+        parallel)
+    scheduler.check_results(results)
+
+def restore_etc(args):
+    """
+    Undo the last `/etc` sync on each host.
+    """
+    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty, args.backend)
+    pool = filter_conn_pool(cfg.conn_pool, select_hosts(cfg, args))
+    results = scheduler.run_on_hosts(
+        pool,
+        lambda conn: conn.sudo(etc.restore_etc_command(args.backup)),
+        args.parallel)
+    scheduler.check_results(results)
+
 def query(args):
     """
     Interrogate runtime configuration.
     """
-    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty)
-    introspect.list_hosts(cfg)
+    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty, args.backend)
+    if args.roles_of is not None:
+        introspect.list_roles(cfg, args.roles_of)
+        return
+    selected_hosts = select_hosts(cfg, args)
+    introspect.list_hosts(cfg, [host for host in cfg.get_inventory().hosts_for(cfg.stage) if host in selected_hosts])
 
 def docker_run(args):
     """
     Run a docker container on remote hosts.
     """
-    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty)
-    pool = filter_conn_pool(cfg.conn_pool, set(args.exclude_host))
-    for conn in pool:
-        print_host_banner(conn)
-        docker.docker_run(conn, cfg, args.stop_and_remove)
+    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty, args.backend)
+    pool = filter_conn_pool(cfg.conn_pool, select_hosts(cfg, args))
+    if args.stop_and_remove is None and cfg.get_docker_replace_settings() is not None:
+        host_timings = {}
+
+        def replace(conn):
+            host_timings[conn.host] = docker.docker_replace(conn, cfg)
+
+        results = scheduler.run_on_hosts(pool, replace, args.parallel)
+        docker.print_replace_timings(host_timings)
+    else:
+        results = scheduler.run_on_hosts(
+            pool,
+            lambda conn: docker.docker_run(conn, cfg, args.stop_and_remove),
+            args.parallel)
+    scheduler.check_results(results)
 
 def manage_rpm(args):
     """
     Manage RPM packages on remote hosts.
     """
-    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty)
-    pool = filter_conn_pool(cfg.conn_pool, set(args.exclude_host))
-    for conn in pool:
-        print_host_banner(conn)
+    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty, args.backend)
+    pool = filter_conn_pool(cfg.conn_pool, select_hosts(cfg, args))
+    package_archive = None
+    if args.local:
+        package_archive = package_deployer.bundle_local_rpms(args.package)
+
+    def manage(conn):
         if args.local:
-            package_deployer.install_local_rpm(conn, args.package)
+            package_deployer.install_local_rpms(conn, package_archive)
         elif args.uninstall:
-            package_deployer.remove_rpm(conn, args.package)
+            package_deployer.remove_rpms(conn, args.package)
         else:
-            package_deployer.install_rpm(conn, args.package)
+            package_deployer.install_rpms(conn, args.package)
+
+    try:
+        results = scheduler.run_on_hosts(pool, manage, args.parallel)
+    finally:
+        if package_archive is not None:
+            os.unlink(package_archive)
+    scheduler.check_results(results)
 
 def execute_shell(args):
     """
     Execute arbitrary remote commands.
     """
-    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty)
+    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty, args.backend)
     cmd = ' '.join([shellquote(arg) for arg in args.arg])
-    pool = filter_conn_pool(cfg.conn_pool, set(args.exclude_host))
-    for conn in pool:
-        print_host_banner(conn)
+    pool = filter_conn_pool(cfg.conn_pool, select_hosts(cfg, args))
+    if args.backend == 'asyncssh':
+        results = [
+            scheduler.HostResult(host, ok=(error is None), error=error)
+            for host, error in aio.run_command_on_hosts(pool, cmd, args.sudo, args.parallel)]
+        scheduler.print_summary(results)
+        scheduler.check_results(results)
+        return
+
+    def execute(conn):
         if args.sudo:
             conn.sudo(cmd)
         else:
             conn.run(cmd)
 
+    results = scheduler.run_on_hosts(pool, execute, args.parallel)
+    scheduler.check_results(results)
+
+def disconnect(args):
+    """
+    Close persistent SSH master connections.
+    """
+    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty, 'openssh')
+    for conn in filter_conn_pool(cfg.conn_pool, select_hosts(cfg, args)):
+        if conn.close_master():
+            print("Closed master connection to {}.".format(conn.host))
+
+def forget_secrets(args):
+    """
+    Remove decrypted secrets from the secrets session.
+    """
+    cfg = load_config(args.config, args.stage, args.sudo_passwd, args.pty, args.backend)
+    session = secrets_session.open_secrets_session(cfg)
+    if session is None:
+        print("Secrets sessions are not enabled.")
+        return
+    if session.path is None:
+        print("Decrypted secrets are only kept in memory; nothing to remove.")
+        return
+    session.forget()
+    print("Removed decrypted secrets from '{}'.".format(session.path))
+
 def main(args):
     """
     Main function.
@@ -107,7 +343,21 @@ def main(args):
         sys.exit(1)
     if args.prompt_sudo:
         args.sudo_passwd = getpass.getpass("Enter `sudo` password: ")
-    args.func(args)
+    if args.profile or args.trace is not None or args.metrics is not None:
+        profiling.RECORDER.enable()
+    try:
+        args.func(args)
+    finally:
+        if args.backend == 'asyncssh':
+            aio.close_connections()
+        if args.backend == 'openssh':
+            print(sshmux.STATS.report(), file=sys.stderr)
+        if args.trace is not None:
+            profiling.write_chrome_trace(profiling.RECORDER, args.trace)
+        if args.metrics is not None:
+            profiling.write_openmetrics(profiling.RECORDER, args.metrics)
+        if args.profile:
+            print(profiling.report(profiling.RECORDER), file=sys.stderr)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Deploy configurations to remote hosts.")
@@ -129,11 +379,54 @@ if __name__ == "__main__":
         action="append",
         metavar="HOST",
         default=[],
-        help="Exclude host HOST.  May be used multiple times.")
+        help="Exclude host HOST.  HOST may be a glob pattern.  May be used multiple times.")
+    parser.add_argument(
+        "-H",
+        "--host",
+        action="append",
+        metavar="PATTERN",
+        default=[],
+        help="Only use hosts of the stage that match the glob PATTERN.  May be used multiple times.")
+    parser.add_argument(
+        "--label",
+        action="append",
+        metavar="LABEL",
+        default=[],
+        help="Only use hosts of the stage that have LABEL.  May be used multiple times to require several labels.")
     parser.add_argument(
         "--pty",
         action='store_true',
         help="When issuing remote commands use a PTY.")
+    parser.add_argument(
+        "-P",
+        "--parallel",
+        action="store",
+        type=int,
+        metavar="N",
+        default=1,
+        help="Run on up to N hosts at once.  Output is buffered per host and a summary is printed at the end.")
+    parser.add_argument(
+        "--backend",
+        action="store",
+        choices=['fabric', 'openssh', 'asyncssh'],
+        default='fabric',
+        help=(
+            "How to run remote commands.  `openssh` uses the OpenSSH client with persistent, shared master connections.  "
+            "`asyncssh` drives all hosts from a single event loop (requires the asyncssh package)."))
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Time every local and remote step and print the slowest steps and hosts at the end.")
+    parser.add_argument(
+        "--trace",
+        action="store",
+        metavar="FILE",
+        help="Write the step timings to FILE as a Chrome trace (chrome://tracing or Perfetto).")
+    parser.add_argument(
+        "--metrics",
+        action="store",
+        metavar="FILE",
+        help="Write the step timings per host to FILE in the OpenMetrics text format.")
     parser.set_defaults(sudo_passwd=None)
     subparsers = parser.add_subparsers(help='sub-command help')
 
@@ -143,6 +436,14 @@ if __name__ == "__main__":
         "--commit",
         action="store",
         help="Deploy from the given commit instead of HEAD.")
+    parser_dc.add_argument(
+        "--add-config",
+        action="append",
+        metavar="CONFIG",
+        default=[],
+        help=(
+            "Also deploy CONFIG to the stage.  May be used multiple times.  "
+            "The archives are built concurrently and each host receives all of its configurations in one session."))
     parser_dc.add_argument(
         "--archive",
         action="store",
@@ -152,9 +453,74 @@ if __name__ == "__main__":
         "--no-etc",
         action="store_true",
         help="Don't deploy the `etc` configuration.")
+    parser_dc.add_argument(
+        "--legacy-archive",
+        action="store_true",
+        help="Build the archive by checking out a temporary git branch in the working tree.")
+    parser_dc.add_argument(
+        "--no-archive-cache",
+        action="store_true",
+        help="Always build a fresh archive instead of using the local archive cache.")
+    parser_dc.add_argument(
+        "--delta",
+        action="store_true",
+        help="Only upload files that changed since the deployed configuration.")
+    parser_dc.add_argument(
+        "--batch",
+        action="store_true",
+        help="Run the remote installation steps as a single script with one `sudo`.")
+    parser_dc.add_argument(
+        "--stream",
+        action="store_true",
+        help="Pipe the archive over SSH straight into `tar` in the remote staging folder instead of uploading it to a temporary file.")
+    parser_dc.add_argument(
+        "--force",
+        action="store_true",
+        help="Deploy to every host, even hosts that already match the archive.")
     parser_dc.set_defaults(func=deploy_config)
 
+    parser_plan = subparsers.add_parser('plan', help='Show what `deploy-config` would change on each host.')
+    parser_plan.add_argument(
+        "-c",
+        "--commit",
+        action="store",
+        help="Compare the given commit instead of HEAD.")
+    parser_plan.add_argument(
+        "--no-etc",
+        action="store_true",
+        help="Don't compare the `etc` configuration.")
+    parser_plan.add_argument(
+        "--no-archive-cache",
+        action="store_true",
+        help="Always build a fresh archive instead of using the local archive cache.")
+    parser_plan.set_defaults(func=plan)
+
+    parser_rollback = subparsers.add_parser('rollback', help='Switch the config folder back to an earlier release.')
+    parser_rollback.add_argument(
+        "-r",
+        "--release",
+        action="store",
+        help="Roll back to the release with this name or commit prefix instead of the previous release.")
+    parser_rollback.add_argument(
+        "--no-etc",
+        action="store_true",
+        help="Don't copy the `etc` configuration of the release to `/etc`.")
+    parser_rollback.set_defaults(func=rollback)
+
+    parser_restore_etc = subparsers.add_parser('restore-etc', help='Undo the last change deployed to `/etc`.')
+    parser_restore_etc.add_argument(
+        "-b",
+        "--backup",
+        action="store",
+        help="Restore the named backup instead of the newest one.")
+    parser_restore_etc.set_defaults(func=restore_etc)
+
     parser_query = subparsers.add_parser('query', help='Interrogate configuration.')
+    parser_query.add_argument(
+        "--roles-of",
+        action="store",
+        metavar="HOST",
+        help="List the roles of HOST by priority instead of the hosts of the stage.")
     parser_query.set_defaults(func=query)
 
     parser_docker_run = subparsers.add_parser('docker-run', help='Run docker containers on remote hosts.')
@@ -170,7 +536,8 @@ if __name__ == "__main__":
     parser_rpm.add_argument(
         "package",
         action="store",
-        help="RPM package name or path.")
+        nargs="+",
+        help="RPM package names or paths.  All packages are handled in a single yum transaction on each host.")
     mxg = parser_rpm.add_mutually_exclusive_group(required=False)
     mxg.add_argument(
         "-u",
@@ -181,7 +548,7 @@ if __name__ == "__main__":
         "-l",
         "--local",
         action="store_true",
-        help="PACKAGE is a path to a local package that must first be copied to the remote host.")
+        help="Each PACKAGE is a path to a local package that must first be copied to the remote host.  The packages are uploaded together.")
     del mxg
     parser_rpm.set_defaults(func=manage_rpm)
 
@@ -198,6 +565,12 @@ if __name__ == "__main__":
         help="Arguments that will be passed to the remote shell")
     parser_shell.set_defaults(func=execute_shell)
 
+    parser_disconnect = subparsers.add_parser('disconnect', help='Close persistent SSH master connections.')
+    parser_disconnect.set_defaults(func=disconnect)
+
+    parser_forget_secrets = subparsers.add_parser('forget-secrets', help='Remove decrypted secrets from the secrets session.')
+    parser_forget_secrets.set_defaults(func=forget_secrets)
+
     args = parser.parse_args()
     main(args)
 
@@ -0,0 +1,316 @@
+
+import asyncio
+import contextlib
+import sys
+import threading
+import attr
+from invoke import Exit
+from deployer.shellfuncs import shellquote
+from deployer.sshmux import SUDO_PROMPT, parse_host
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+@attr.s
+class Result(object):
+    command = attr.ib()
+    stdout = attr.ib(default='')
+    stderr = attr.ib(default='')
+    return_code = attr.ib(default=0)
+
+    @property
+    def failed(self):
+        return self.return_code != 0
+
+    @property
+    def ok(self):
+        return not self.failed
+
+class EventLoopThread(object):
+    """
+    A single asyncio event loop running in a daemon thread.  All
+    `AsyncConnection` objects share it, so any number of hosts are
+    driven by one loop.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def call(self, coro):
+        """
+        Run `coro` on the loop and block until it completes.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+_loop_thread = None
+_loop_lock = threading.Lock()
+_open_connections = []
+
+def get_loop_thread():
+    global _loop_thread
+    with _loop_lock:
+        if _loop_thread is None:
+            _loop_thread = EventLoopThread()
+        return _loop_thread
+
+def hidden_streams(hide):
+    """
+    Return the set of stream names (`stdout`, `stderr`) hidden by the
+    invoke-style `hide` argument.
+    """
+    if hide in (None, False):
+        return set()
+    if hide in (True, 'both'):
+        return set(['stdout', 'stderr'])
+    if hide in ('out', 'stdout'):
+        return set(['stdout'])
+    if hide in ('err', 'stderr'):
+        return set(['stderr'])
+    raise ValueError("Invalid value for `hide`: {!r}".format(hide))
+
+def take_prompts(data, prompt):
+    """
+    Remove each `prompt` from `data`.  A trailing part of `data` that
+    could be the start of a `prompt` split across reads is held back.
+
+    :returns: A tuple of (text, count, pending).  `text` is the output to
+        pass on, `count` is the number of prompts found, and `pending`
+        must be prepended to the next read.
+    """
+    count = data.count(prompt)
+    data = data.replace(prompt, '')
+    for n in range(min(len(prompt) - 1, len(data)), 0, -1):
+        if data.endswith(prompt[:n]):
+            return data[:-n], count, data[-n:]
+    return data, count, ''
+
+def exit_status(host, process):
+    """
+    Return the exit status of a finished asyncssh `process`.  Raise `Exit`
+    if the channel closed without reporting one.
+    """
+    status = process.returncode
+    if status is None:
+        raise Exit("The connection to {} closed before the command exited.".format(host))
+    return status
+
+class AsyncConnection(object):
+    """
+    An asyncssh based connection with coroutine versions of `run()`,
+    `sudo()`, and `put()`.  The SSH connection is opened on first use
+    and reused for every command.
+    """
+    def __init__(self, host, sudo_passwd=None, echo=True, connect_kwargs=None):
+        if asyncssh is None:
+            raise Exit("The `asyncssh` backend requires the asyncssh package.")
+        self.host = host
+        self.user, self.hostname, self.port = parse_host(host)
+        self.sudo_passwd = sudo_passwd
+        self.echo = echo
+        self.connect_kwargs = dict(connect_kwargs or {})
+        self.command_cwds = []
+        self._conn = None
+        self._connect_lock = None
+
+    async def connect(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._conn is None:
+                kwargs = dict(self.connect_kwargs)
+                if self.user is not None:
+                    kwargs['username'] = self.user
+                if self.port is not None:
+                    kwargs['port'] = int(self.port)
+                self._conn = await asyncssh.connect(self.hostname, **kwargs)
+        return self._conn
+
+    async def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            await self._conn.wait_closed()
+            self._conn = None
+
+    def _prefix(self, command):
+        for cwd in reversed(self.command_cwds):
+            command = "cd {} && {}".format(shellquote(cwd), command)
+        return command
+
+    async def _run(self, command, display, warn=False, hide=None, out_stream=None,
+                   err_stream=None, password=None, **kwargs):
+        conn = await self.connect()
+        if self.echo:
+            print("\033[1;37m{}\033[0m".format(display), file=out_stream or sys.stdout)
+        hidden = hidden_streams(hide)
+        process = await conn.create_process(self._prefix(command))
+        stdout = []
+        stderr = []
+
+        async def pump(reader, name, captured, stream):
+            pending = ''
+            while True:
+                data = await reader.read(8192)
+                if data == '':
+                    data = pending
+                    pending = ''
+                elif name == 'stderr' and password is not None:
+                    data, count, pending = take_prompts(pending + data, SUDO_PROMPT)
+                    for n in range(count):
+                        process.stdin.write("{}\n".format(password))
+                    if data == '':
+                        continue
+                if data == '':
+                    break
+                captured.append(data)
+                if not name in hidden:
+                    stream = stream or (sys.stdout if name == 'stdout' else sys.stderr)
+                    stream.write(data)
+                    stream.flush()
+
+        await asyncio.gather(
+            pump(process.stdout, 'stdout', stdout, out_stream),
+            pump(process.stderr, 'stderr', stderr, err_stream))
+        await process.wait_closed()
+        result = Result(display, ''.join(stdout), ''.join(stderr), exit_status(self.host, process))
+        if result.failed and not warn:
+            raise Exit("Command `{}` failed on {} with exit status {}.".format(
+                display, self.host, result.return_code))
+        return result
+
+    async def run(self, command, **kwargs):
+        return await self._run(command, command, **kwargs)
+
+    async def sudo(self, command, **kwargs):
+        password = kwargs.pop('password', self.sudo_passwd)
+        sudo_cmd = "sudo -S -p {} -H {}".format(shellquote(SUDO_PROMPT), command)
+        return await self._run(sudo_cmd, command, password=password, **kwargs)
+
+    async def put(self, local, remote):
+        """
+        Copy a local file (a path or a file-like object) to `remote` with SFTP.
+        """
+        conn = await self.connect()
+        async with conn.start_sftp_client() as sftp:
+            if hasattr(local, 'read'):
+                async with sftp.open(remote, 'wb') as f:
+                    await f.write(local.read())
+            else:
+                await sftp.put(local, remote)
+
+    async def pipe(self, command, chunks):
+        """
+        Run `command` with the byte strings in `chunks` as its stdin.
+        Return its stdout.
+        """
+        conn = await self.connect()
+        process = await conn.create_process(self._prefix(command), encoding=None)
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+            process.stdin.write_eof()
+        except OSError:
+            # The command stopped reading; its exit status says why.
+            pass
+        stdout, stderr = await asyncio.gather(process.stdout.read(), process.stderr.read())
+        await process.wait_closed()
+        status = exit_status(self.host, process)
+        if status != 0:
+            raise Exit("Streaming to {} failed with exit status {}: {}".format(
+                self.host, status, stderr.decode('utf-8', 'replace').strip()))
+        return stdout.decode('utf-8')
+
+class AsyncSSHConnection(object):
+    """
+    A blocking facade over `AsyncConnection` that matches the subset of the
+    Fabric `Connection` interface used by the deployer (`host`, `run()`,
+    `sudo()`, `put()`, and `cd()`), plus `pipe()`.  The I/O for every host runs on one
+    shared event loop.
+    """
+    def __init__(self, host, sudo_passwd=None, echo=True, connect_kwargs=None):
+        self.aconn = AsyncConnection(host, sudo_passwd, echo, connect_kwargs)
+        self.host = host
+        self.loop_thread = get_loop_thread()
+        _open_connections.append(self)
+
+    @contextlib.contextmanager
+    def cd(self, path):
+        self.aconn.command_cwds.append(path)
+        try:
+            yield
+        finally:
+            self.aconn.command_cwds.pop()
+
+    def run(self, command, **kwargs):
+        kwargs.pop('in_stream', None)
+        return self.loop_thread.call(self.aconn.run(command, **kwargs))
+
+    def sudo(self, command, **kwargs):
+        kwargs.pop('in_stream', None)
+        return self.loop_thread.call(self.aconn.sudo(command, **kwargs))
+
+    def put(self, local, remote):
+        return self.loop_thread.call(self.aconn.put(local, remote))
+
+    def pipe(self, command, chunks):
+        return self.loop_thread.call(self.aconn.pipe(command, chunks))
+
+    @property
+    def sudo_passwd(self):
+        return self.aconn.sudo_passwd
+
+    def close(self):
+        self.loop_thread.call(self.aconn.close())
+
+def close_connections():
+    """
+    Close every `AsyncSSHConnection` created so far.
+    """
+    while len(_open_connections) > 0:
+        _open_connections.pop().close()
+
+async def gather_hosts(aconns, func, parallel):
+    """
+    Await `func(aconn)` for each `AsyncConnection`, with at most `parallel`
+    hosts in flight at once.
+
+    :returns: A list of (host, exception or None) pairs.
+    """
+    semaphore = asyncio.Semaphore(max(1, parallel))
+
+    async def one(aconn):
+        async with semaphore:
+            try:
+                await func(aconn)
+                return (aconn.host, None)
+            except Exception as ex:
+                return (aconn.host, ex)
+            finally:
+                await aconn.close()
+
+    return await asyncio.gather(*[one(aconn) for aconn in aconns])
+
+def run_command_on_hosts(conns, command, sudo=False, parallel=1):
+    """
+    Run a shell command on every host from the shared event loop, without
+    a thread per host.  Output lines are prefixed with the host name.
+
+    :returns: A list of (host, exception or None) pairs.
+    """
+    async def execute(aconn):
+        if sudo:
+            result = await aconn.sudo(command, hide=True, warn=True)
+        else:
+            result = await aconn.run(command, hide=True, warn=True)
+        for line in (result.stdout + result.stderr).splitlines():
+            print("[{}] {}".format(aconn.host, line))
+        if result.failed:
+            raise Exit("Exit status {}.".format(result.return_code))
+
+    aconns = [conn.aconn for conn in conns]
+    for aconn in aconns:
+        aconn.echo = False
+    return get_loop_thread().call(gather_hosts(aconns, execute, parallel))
@@ -0,0 +1,364 @@
+
+import gzip
+import io
+import os
+import subprocess
+import tarfile
+import attr
+from invoke import Exit
+import yaml
+from deployer import template_tools as ttools
+from deployer.permissions import apply_mode, parse_permissions, split_ad_hoc_perms
+from deployer.secrets_session import decrypt_with, open_secrets_session
+from deployer.terminal import warn
+
+# Bump when a change to the builder changes the archives it produces.
+ARCHIVE_FORMAT_VERSION = 4
+
+@attr.s
+class TreeEntry(object):
+    path = attr.ib()
+    mode = attr.ib()
+    sha = attr.ib()
+
+@attr.s
+class Member(object):
+    """
+    A file, symlink, or folder to be written to the deployment archive.
+    Content comes from `data`, or from the git blob `sha` if `data` is None.
+    """
+    path = attr.ib()
+    mode = attr.ib()
+    sha = attr.ib(default=None)
+    data = attr.ib(default=None)
+    kind = attr.ib(default=tarfile.REGTYPE)
+    user = attr.ib(default=None)
+    group = attr.ib(default=None)
+
+class GitRepo(object):
+    """
+    Read-only access to the object store of a git repository.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def git(self, *args, **kwargs):
+        """
+        Run a git command and return its output as bytes.
+        """
+        cmd = ['git'] + list(args)
+        proc = subprocess.run(
+            cmd,
+            cwd=self.path,
+            input=kwargs.get('input', None),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise Exit("`{}` failed: {}".format(' '.join(cmd), proc.stderr.decode('utf-8', 'replace').strip()))
+        return proc.stdout
+
+    def resolve_commit(self, rev):
+        """
+        Return the full SHA of the commit `rev` refers to.
+        """
+        return self.git('rev-parse', '--verify', '{}^{{commit}}'.format(rev)).decode('ascii').strip()
+
+    def commit_time(self, commit):
+        """
+        Return the commit timestamp of `commit`.
+        """
+        return int(self.git('show', '-s', '--format=%ct', commit).decode('ascii').strip())
+
+    def list_tree(self, commit):
+        """
+        Return a list of `TreeEntry` for every file in `commit`.
+        """
+        output = self.git('ls-tree', '-r', '-z', '--full-tree', commit)
+        entries = []
+        for record in output.split(b'\0'):
+            if record == b'':
+                continue
+            info, path = record.split(b'\t', 1)
+            mode, kind, sha = info.decode('ascii').split(' ')
+            if kind != 'blob':
+                continue
+            entries.append(TreeEntry(path.decode('utf-8'), mode, sha))
+        return entries
+
+    def open_blob_reader(self):
+        """
+        Return a `BlobReader` backed by a single `git cat-file --batch`.
+        """
+        return BlobReader(self.path)
+
+class BlobReader(object):
+    """
+    Read blob contents from a long running `git cat-file --batch` process.
+    """
+    def __init__(self, path):
+        self.proc = subprocess.Popen(
+            ['git', 'cat-file', '--batch'],
+            cwd=path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+    def read(self, sha):
+        """
+        Return the contents of blob `sha`.
+        """
+        self.proc.stdin.write("{}\n".format(sha).encode('ascii'))
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().decode('ascii').split()
+        if len(header) != 3:
+            raise Exit("Could not read git object '{}'.".format(sha))
+        size = int(header[2])
+        data = self.proc.stdout.read(size)
+        self.proc.stdout.read(1)
+        return data
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def in_hidden_folder(path):
+    """
+    Return True if any parent folder of `path` is a dotfile folder.
+    """
+    parts = path.split('/')[:-1]
+    return any(part.startswith('.') for part in parts)
+
+def classify_entries(entries, secrets_file_name, has_secrets):
+    """
+    Sort the entries of a commit into files that are archived as-is,
+    encrypted `.secret` files, and `.template` files.
+    Files that never belong in the archive are dropped.
+
+    :returns: A tuple of (plain, secrets, templates) lists.
+    """
+    plain = []
+    secrets = []
+    templates = []
+    for entry in entries:
+        path = entry.path
+        if path == '.gitignore' or path.startswith('.gitsecret/'):
+            continue
+        if has_secrets and path == secrets_file_name:
+            continue
+        if in_hidden_folder(path):
+            plain.append(entry)
+        elif path.endswith('.secret'):
+            secrets.append(entry)
+        elif path.endswith('.template'):
+            templates.append(entry)
+        else:
+            plain.append(entry)
+    return plain, secrets, templates
+
+def git_mode_to_tar(mode):
+    """
+    Map a git file mode to a (tar type, permission bits) pair.
+    """
+    if mode == '120000':
+        return tarfile.SYMTYPE, 0o777
+    if mode == '100755':
+        return tarfile.REGTYPE, 0o755
+    return tarfile.REGTYPE, 0o644
+
+def plan_members(repo, reader, commit, config):
+    """
+    Work out the contents of the deployment archive for `commit`.
+    Encrypted secrets are decrypted and templates are rendered in memory.
+
+    :returns: A list of `Member`.
+    """
+    entries = repo.list_tree(commit)
+    by_path = dict((entry.path, entry) for entry in entries)
+    has_secrets = any(entry.path.startswith('.gitsecret/') for entry in entries)
+    secrets_file_name = config.get_secrets_file_name()
+    plain, secrets, templates = classify_entries(entries, secrets_file_name, has_secrets)
+    members = {}
+    for entry in plain:
+        kind, mode = git_mode_to_tar(entry.mode)
+        members[entry.path] = Member(entry.path, mode, sha=entry.sha, kind=kind)
+    revealed = {}
+    if has_secrets:
+        session = open_secrets_session(config)
+        for entry in secrets:
+            data = decrypt_with(session, entry.sha, lambda: reader.read(entry.sha))
+            revealed[entry.path[:-len('.secret')]] = (entry, data)
+    if has_secrets and secrets_file_name is not None:
+        if secrets_file_name in revealed:
+            doc = yaml.safe_load(revealed[secrets_file_name][1].decode('utf-8'))
+        elif secrets_file_name in by_path:
+            doc = yaml.safe_load(reader.read(by_path[secrets_file_name].sha).decode('utf-8'))
+        else:
+            raise Exit("Secrets file '{}' does not exist.".format(secrets_file_name))
+
+        def read_template(fname):
+            if not fname in by_path:
+                raise Exit("Template '{}' is not in commit {}.".format(fname, commit))
+            return reader.read(by_path[fname].sha).decode('utf-8')
+
+        template_cache = ttools.open_template_cache(config)
+        for fname, text in ttools.render_templates(doc, read_template, template_cache):
+            kind, mode = git_mode_to_tar(by_path[fname].mode)
+            transformed = os.path.splitext(fname)[0]
+            members[transformed] = Member(transformed, mode, data="{}\n".format(text).encode('utf-8'))
+    for transformed, (entry, data) in revealed.items():
+        if transformed == secrets_file_name:
+            continue
+        kind, mode = git_mode_to_tar(entry.mode)
+        members[transformed] = Member(transformed, mode, data=data)
+    for entry in secrets + templates:
+        transformed = entry.path[:-len(os.path.splitext(entry.path)[1])]
+        if not transformed in members and transformed != secrets_file_name:
+            warn("Could not find file '{}' for archival.".format(transformed))
+    members = add_folders(list(members.values()))
+    return bake_permissions(members, reader, config)
+
+def add_folders(members):
+    """
+    Add a folder member for each parent folder and return all
+    members sorted by path.
+    """
+    folders = set()
+    for member in members:
+        parts = member.path.split('/')[:-1]
+        for n in range(1, len(parts) + 1):
+            folders.add('/'.join(parts[:n]))
+    members = members + [Member(path, 0o755, kind=tarfile.DIRTYPE) for path in folders]
+    members.sort(key=lambda m: m.path)
+    return members
+
+def bake_permissions(members, reader, config, perm_file='__perms__'):
+    """
+    Set the owner, group, and mode of each member the same way the
+    deployment settings, ad hoc permissions, and permission files would
+    set them on the remote host.  The permission files themselves are
+    left out of the archive, except those in the `etc` folder, which the
+    `/etc` sync reads for the owners it applies.
+
+    :returns: The list of members to archive.
+    """
+    owner = config.get_config_owner()
+    group = config.get_config_group()
+    folder_perms = config.get_config_folder_perms()
+    file_perms = config.get_config_file_perms()
+    by_path = dict((member.path, member) for member in members)
+    for member in members:
+        member.user = owner
+        member.group = group
+        if member.kind == tarfile.SYMTYPE:
+            continue
+        is_dir = (member.kind == tarfile.DIRTYPE)
+        if folder_perms.lower() != "skip":
+            member.mode = apply_mode(folder_perms, member.mode, is_dir)
+        if not is_dir and file_perms.lower() != "skip":
+            member.mode = apply_mode(file_perms, member.mode)
+    inside, outside = split_ad_hoc_perms(config)
+    for path, perm in inside.items():
+        member = by_path.get(os.path.normpath(path), None)
+        if member is None:
+            warn("Ad hoc permission path '{}' is not in the configuration.".format(path))
+            continue
+        member.mode = apply_mode(perm, member.mode, member.kind == tarfile.DIRTYPE)
+    perm_members = [
+        member for member in members
+        if member.kind == tarfile.REGTYPE and os.path.basename(member.path) == perm_file]
+    for perm_member in perm_members:
+        data = perm_member.data
+        if data is None:
+            data = reader.read(perm_member.sha)
+        dirpth = os.path.dirname(perm_member.path)
+        for fname, user, group, perms in parse_permissions(data.decode('utf-8'), perm_member.path):
+            path = os.path.normpath(os.path.join(dirpth, fname))
+            member = by_path.get(path, None)
+            if member is None:
+                raise Exit("Permission file '{}' refers to '{}', which is not in the configuration.".format(
+                    perm_member.path, fname))
+            member.user = user
+            member.group = group
+            member.mode = apply_mode(perms, member.mode, member.kind == tarfile.DIRTYPE)
+    perm_paths = set(member.path for member in perm_members if not member.path.startswith("etc/"))
+    return [member for member in members if not member.path in perm_paths]
+
+def owner_fields(name):
+    """
+    Return the (name, id) pair to store in the archive for the user or
+    group `name`.  Numeric ids are stored without a name.  Names are
+    stored with id 0 and mapped by name when the remote host extracts
+    the archive, so they don't have to exist on the building host.
+    """
+    if name.isdigit():
+        return '', int(name)
+    return name, 0
+
+def write_archive(fileobj, members, reader, mtime):
+    """
+    Stream `members` into `fileobj` as a gzipped tar.  Blob contents are
+    read one at a time so the tree is never held in memory.
+    """
+    with gzip.GzipFile(fileobj=fileobj, mode='wb', mtime=mtime) as gz:
+        with tarfile.open(fileobj=gz, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            for member in members:
+                info = tarfile.TarInfo(member.path)
+                info.mode = member.mode
+                info.mtime = mtime
+                info.uname, info.uid = owner_fields(member.user or 'root')
+                info.gname, info.gid = owner_fields(member.group or 'root')
+                info.type = member.kind
+                data = member.data
+                if data is None and member.sha is not None:
+                    data = reader.read(member.sha)
+                if member.kind == tarfile.SYMTYPE:
+                    info.linkname = data.decode('utf-8')
+                    tar.addfile(info)
+                elif member.kind == tarfile.DIRTYPE:
+                    tar.addfile(info)
+                else:
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+
+def archive_settings(config):
+    """
+    Return the settings that affect the contents of an archive
+    other than the commit itself.
+    """
+    return {
+        'format': ARCHIVE_FORMAT_VERSION,
+        'secrets-file-name': config.get_secrets_file_name(),
+        'config-folder': config.get_remote_config_folder(),
+        'config-owner': config.get_config_owner(),
+        'config-group': config.get_config_group(),
+        'config-folder-perms': config.get_config_folder_perms(),
+        'config-file-perms': config.get_config_file_perms(),
+        'ad-hoc-perms': config.get_ad_hoc_perms(),
+    }
+
+def build_archive(config, rev, fileobj):
+    """
+    Write the deployment archive for revision `rev` of the working tree
+    to `fileobj`.  Only the git object store is read; the working tree,
+    index, and refs are left untouched.
+
+    :returns: The SHA of the archived commit.
+    """
+    repo = GitRepo(config.get_working_tree())
+    commit = repo.resolve_commit(rev)
+    write_commit_archive(repo, commit, config, fileobj)
+    return commit
+
+def write_commit_archive(repo, commit, config, fileobj):
+    """
+    Write the deployment archive for the resolved `commit` to `fileobj`.
+    """
+    mtime = repo.commit_time(commit)
+    with repo.open_blob_reader() as reader:
+        members = plan_members(repo, reader, commit, config)
+        write_archive(fileobj, members, reader, mtime)
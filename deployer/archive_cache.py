@@ -0,0 +1,118 @@
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from deployer.archive_builder import archive_settings
+from deployer.terminal import warn
+
+DEFAULT_CACHE_DIR = '~/.cache/config-deployer/archives'
+DEFAULT_MAX_MB = 512
+DEFAULT_MAX_AGE_DAYS = 7
+
+class ArchiveCache(object):
+    """
+    A local, content-addressed store of built deployment archives.
+
+    Archives contain decrypted secrets, so the cache folder is only
+    accessible by its owner and each archive is only readable by its
+    owner.
+    """
+    def __init__(self, path, max_bytes, max_age):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        os.chmod(path, 0o700)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, "{}.tgz".format(key))
+
+    def lookup(self, key):
+        """
+        Return the path of the cached archive for `key` or None.
+        """
+        path = self.entry_path(key)
+        if not os.path.exists(path):
+            return None
+        if time.time() - os.path.getmtime(path) > self.max_age:
+            os.unlink(path)
+            return None
+        os.utime(path)
+        return path
+
+    def store(self, key, archive_path):
+        """
+        Add a copy of the archive at `archive_path` to the cache.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                with open(archive_path, "rb") as fin:
+                    shutil.copyfileobj(fin, fout)
+            os.chmod(tmp_path, 0o600)
+            os.rename(tmp_path, self.entry_path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Remove archives older than the maximum age, then remove the least
+        recently used archives until the cache fits in its maximum size.
+        """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".tgz"):
+                continue
+            path = os.path.join(self.path, name)
+            st = os.stat(path)
+            if now - st.st_mtime > self.max_age:
+                os.unlink(path)
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum(size for mtime, size, path in entries)
+        while total > self.max_bytes and len(entries) > 0:
+            mtime, size, path = entries.pop(0)
+            os.unlink(path)
+            total -= size
+
+def open_archive_cache(config):
+    """
+    Return the `ArchiveCache` described by the user settings, or None if
+    caching is disabled.
+    """
+    settings = config.get_archive_cache_settings()
+    if not settings.get('enabled', True):
+        return None
+    path = os.path.expanduser(settings.get('path', DEFAULT_CACHE_DIR))
+    max_bytes = settings.get('max_mb', DEFAULT_MAX_MB) * 1024 * 1024
+    max_age = settings.get('max_age_days', DEFAULT_MAX_AGE_DAYS) * 86400
+    try:
+        return ArchiveCache(path, max_bytes, max_age)
+    except OSError as ex:
+        warn("Archive cache '{}' is unavailable: {}".format(path, ex))
+        return None
+
+def cache_key(repo, commit, config):
+    """
+    Compute the cache key for the archive of `commit`.
+
+    The key covers the commit, the blobs that are decrypted or rendered
+    when the archive is built, and the settings that affect the build.
+    """
+    digest = hashlib.sha256()
+    digest.update(commit.encode('ascii'))
+    secrets_file_name = config.get_secrets_file_name()
+    for entry in repo.list_tree(commit):
+        path = entry.path
+        if path.endswith('.secret') or path.endswith('.template') or path == secrets_file_name:
+            digest.update("\0{}\0{}".format(path, entry.sha).encode('utf-8'))
+    settings = json.dumps(archive_settings(config), sort_keys=True)
+    digest.update(settings.encode('utf-8'))
+    return digest.hexdigest()
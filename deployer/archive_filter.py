@@ -1,9 +1,62 @@
-
 import os
 import sys
-from deployer.shellfuncs import shellquote
+from deployer.shellfuncs import chunked, shellquote
 from deployer.terminal import warn
 
+def scan_working_tree(wt, extensions):
+    """
+    Walk the working tree once and return a dict that maps each extension
+    in `extensions` to the paths (relative to `wt`) of the files that end
+    with it.
+
+    Dotfile folders (including `.git`) are pruned without being read.
+    """
+    found = dict((extension, []) for extension in extensions)
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        with os.scandir(os.path.join(wt, reldir)) as it:
+            for dirent in it:
+                relpath = os.path.join(reldir, dirent.name)
+                if dirent.is_dir(follow_symlinks=False):
+                    if not dirent.name.startswith("."):
+                        stack.append(relpath)
+                    continue
+                for extension in extensions:
+                    if dirent.name.endswith(extension):
+                        found[extension].append(relpath)
+                        break
+    for paths in found.values():
+        paths.sort()
+    return found
+
+def filter_working_tree_for_archival(conn, config, extensions=(".secret", ".template")):
+    """
+    Scan the working tree once for files that end with any of
+    `extensions`.  For each one, add the file in the same folder with the
+    same name sans the extension to the archival branch, and remove the
+    file with the extension from the archival branch.  The index is
+    updated with one `git add` and one `git rm` per batch of files.
+
+    Excludes descending into dotfile folders.
+    """
+    wt = config.get_working_tree()
+    found = scan_working_tree(wt, extensions)
+    added = []
+    removed = []
+    for extension in extensions:
+        for path in found[extension]:
+            transformed = os.path.splitext(path)[0]
+            if os.path.exists(os.path.join(wt, transformed)):
+                added.append(transformed)
+            else:
+                warn("Could not find file '{}' for archival.".format(os.path.basename(transformed)))
+            removed.append(path)
+    for paths in chunked(added):
+        conn.run("cd {} && git add -f -- {}".format(shellquote(wt), ' '.join(shellquote(p) for p in paths)))
+    for paths in chunked(removed):
+        conn.run("cd {} && git rm -q -f -- {}".format(shellquote(wt), ' '.join(shellquote(p) for p in paths)))
+
 def filter_files_for_archival(conn, config, extension):
     """
     Scan the working tree for files that end with `extension`.
@@ -13,22 +66,4 @@ def filter_files_for_archival(conn, config, extension):
     
     Excludes descending into dotfile folders.
     """
-    wt = config.get_working_tree()
-    for dirpath, dirnames, filenames in os.walk(wt):
-        parts = os.path.split(dirpath)
-        has_dotfile = False
-        for part in parts:
-            if part.startswith("."):
-                has_dotfile = True
-                break
-        if has_dotfile:
-            continue
-        for fname in filenames:
-            if fname.endswith(extension):
-                transformed = os.path.splitext(fname)[0]
-                if os.path.exists(os.path.join(dirpath, transformed)):
-                    conn.run("cd {} && git add -f {}".format(shellquote(dirpath), shellquote(transformed))) 
-                else:
-                    warn("Could not find file '{}' for archival.".format(transformed))
-                conn.run("cd {} && git rm -f {}".format(shellquote(dirpath), shellquote(fname)))
-        
+    filter_working_tree_for_archival(conn, config, (extension,))
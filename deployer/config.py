@@ -2,12 +2,14 @@
 from configparser import SafeConfigParser
 import os
 import sys
-import yaml
 import attr
 from fabric import SerialGroup
 from fabric.config import Config as ConnectionConfig
 import invoke
 from invoke import Exit
+from deployer.aio import AsyncSSHConnection
+from deployer.inventory import load_deployment_config, parse_inventory
+from deployer.sshmux import MuxConnection
 
 @attr.s
 class Config(object):
@@ -15,6 +17,15 @@ class Config(object):
     stage = attr.ib(default=None)
     invoker = attr.ib(default=None)
     conn_pool = attr.ib(default=None)
+    inventory = attr.ib(default=None)
+
+    def get_inventory(self):
+        """
+        Return the `Inventory` of all the roles in the deployment config.
+        """
+        if self.inventory is None:
+            self.inventory = parse_inventory(self.settings)
+        return self.inventory
 
     def get_config_branch(self):
         """
@@ -47,6 +58,18 @@ class Config(object):
         """
         return self.settings.get('secrets-file-name', 'secrets.yml')
 
+    def get_archive_cache_settings(self):
+        """
+        Return the local archive cache settings from `~/.deployer.cfg`.
+        """
+        return self.settings.get('archive_cache', {})
+
+    def get_secrets_session_settings(self):
+        """
+        Return the secrets session settings from `~/.deployer.cfg`.
+        """
+        return self.settings.get('secrets_session', {})
+
     def get_remote_config_folder(self):
         """
         Return the path of the config folder on the remote host.
@@ -95,6 +118,28 @@ class Config(object):
         """
         return self.settings['targets'].get('ad-hoc-perms', {})
 
+    def get_keep_releases(self):
+        """
+        Return how many releases of the config folder to keep on each
+        host.  0 means the config folder is replaced in place.
+        """
+        return int(self.settings['targets'].get('keep-releases', 0))
+
+    def get_reload_hooks(self):
+        """
+        Return the `reload-hooks` section of the current role or None.
+        """
+        role = self.settings['roles'][self.stage]
+        return role.get("reload-hooks", None)
+
+    def get_rollout_settings(self):
+        """
+        Return the `rollout` section of the current role or None if
+        the role deploys to all hosts at once.
+        """
+        role = self.settings['roles'][self.stage]
+        return role.get("rollout", None)
+
     def is_docker_build_target(self):
         """
         Return True is the targets section has `docker-build-target` set.
@@ -139,6 +184,28 @@ class Config(object):
         role = self.settings['roles'][self.stage]
         return list(role.get("docker-build-options", []))
 
+    def get_docker_distribute(self):
+        """
+        Return how a docker image built once is distributed to the hosts
+        (`registry` or `load`), or None if it is built on each host.
+        """
+        role = self.settings['roles'][self.stage]
+        return role.get("docker-distribute", None)
+
+    def get_docker_registry(self):
+        """
+        Return the registry docker images are pushed to, or None.
+        """
+        role = self.settings['roles'][self.stage]
+        return role.get("docker-registry", None)
+
+    def get_docker_replace_settings(self):
+        """
+        Return the `docker-replace` section of the current role or None.
+        """
+        role = self.settings['roles'][self.stage]
+        return role.get("docker-replace", None)
+
     def get_docker_run_args(self):
         """
         Return a list of args to apply to `docker run`. 
@@ -147,13 +214,16 @@ class Config(object):
         return list(role.get("docker-run-args", []))
 
 
-def load_config(config_path, stage, sudo_passwd=None, pty=False):
+def load_config(config_path, stage, sudo_passwd=None, pty=False, backend='fabric'):
     """
     Load the deployment config.
 
     :param:`config_path`: Full or relative path to deployment config file.  May be
         relative to DEPLOYER_CONFIG_PREFIX environment variable. 
     :param:`stage`: The stage (aka role) used to select target hosts.
+    :param:`backend`: How remote commands are run.  One of `fabric`,
+        `openssh` (OpenSSH client with persistent master connections), or
+        `asyncssh` (asyncssh connections driven by one event loop).
 
     :returns: A configuration object.
     """
@@ -162,14 +232,17 @@ def load_config(config_path, stage, sudo_passwd=None, pty=False):
     deployer_config_prefix = os.environ.get('DEPLOYER_CONFIG_PREFIX', None)
     if deployer_config_prefix is not None:
         config_path = os.path.join(deployer_config_prefix, config_path)
-    with open(config_path, "r") as f:
-        cfg.settings = yaml.load(f)
-    if not stage in cfg.settings['roles']:
-        raise Exit("Stage `{}` not found in configuration.".format(stage))
-    create_connections_(cfg, sudo_passwd, pty)
     settings = load_settings_()
+    cfg.settings, cfg.inventory = load_deployment_config(config_path, settings.get('inventory_cache', {}))
+    if not stage in cfg.inventory.roles:
+        raise Exit("Stage `{}` not found in configuration.".format(stage))
     if 'working_tree_base' in settings:
         cfg.settings['working_tree_base'] = settings['working_tree_base']
+    if 'archive_cache' in settings:
+        cfg.settings['archive_cache'] = settings['archive_cache']
+    if 'secrets_session' in settings:
+        cfg.settings['secrets_session'] = settings['secrets_session']
+    create_connections_(cfg, sudo_passwd, pty, backend, settings.get('ssh', {}))
     return cfg
 
 def load_settings_():
@@ -190,15 +263,50 @@ def load_settings_():
     if scp.has_section("SOURCES"):
         if scp.has_option("SOURCES", "working_tree_base"):
             settings['working_tree_base'] = os.path.expanduser(scp.get("SOURCES", "working_tree_base"))
+    if scp.has_section("CACHE"):
+        cache = {}
+        if scp.has_option("CACHE", "archive_cache"):
+            cache['enabled'] = scp.getboolean("CACHE", "archive_cache")
+        if scp.has_option("CACHE", "archive_cache_dir"):
+            cache['path'] = os.path.expanduser(scp.get("CACHE", "archive_cache_dir"))
+        if scp.has_option("CACHE", "template_cache_dir"):
+            cache['template_path'] = os.path.expanduser(scp.get("CACHE", "template_cache_dir"))
+        if scp.has_option("CACHE", "archive_cache_max_mb"):
+            cache['max_mb'] = scp.getint("CACHE", "archive_cache_max_mb")
+        if scp.has_option("CACHE", "archive_cache_max_age_days"):
+            cache['max_age_days'] = scp.getfloat("CACHE", "archive_cache_max_age_days")
+        settings['archive_cache'] = cache
+        inventory_cache = {}
+        if scp.has_option("CACHE", "inventory_cache"):
+            inventory_cache['enabled'] = scp.getboolean("CACHE", "inventory_cache")
+        if scp.has_option("CACHE", "inventory_cache_dir"):
+            inventory_cache['path'] = os.path.expanduser(scp.get("CACHE", "inventory_cache_dir"))
+        settings['inventory_cache'] = inventory_cache
+    if scp.has_section("SECRETS"):
+        session = {}
+        if scp.has_option("SECRETS", "session"):
+            session['enabled'] = scp.getboolean("SECRETS", "session")
+        if scp.has_option("SECRETS", "session_dir"):
+            session['path'] = os.path.expanduser(scp.get("SECRETS", "session_dir"))
+        if scp.has_option("SECRETS", "session_ttl"):
+            session['ttl'] = scp.getint("SECRETS", "session_ttl")
+        settings['secrets_session'] = session
+    if scp.has_section("SSH"):
+        ssh = {}
+        if scp.has_option("SSH", "control_dir"):
+            ssh['control_dir'] = scp.get("SSH", "control_dir")
+        if scp.has_option("SSH", "control_persist"):
+            ssh['control_persist'] = scp.getint("SSH", "control_persist")
+        settings['ssh'] = ssh
     return settings
 
-def create_connections_(cfg, sudo_passwd, pty):
+def create_connections_(cfg, sudo_passwd, pty, backend='fabric', ssh_settings=None):
     """
     Create connections from the config and stage.
     """
-    roles = cfg.settings['roles']
-    stage = roles[cfg.stage]
-    target_hosts = stage['target-hosts']
+    if ssh_settings is None:
+        ssh_settings = {}
+    target_hosts = cfg.get_inventory().hosts_for(cfg.stage)
     cf_settings = {
         'run': {
             'echo': True, 
@@ -207,10 +315,19 @@ def create_connections_(cfg, sudo_passwd, pty):
         },
         'sudo': {'password': sudo_passwd},
     }
-    cf = ConnectionConfig(cf_settings)
-    group = SerialGroup(*target_hosts, config=cf)
-    cfg.conn_pool = group
     cf = invoke.config.Config(cf_settings)
     ctx = invoke.context.Context(cf)
     cfg.invoker = ctx
+    if backend == 'openssh':
+        cfg.conn_pool = [
+            MuxConnection(host, ctx, sudo_passwd, pty, **ssh_settings)
+            for host in target_hosts]
+    elif backend == 'asyncssh':
+        cfg.conn_pool = [AsyncSSHConnection(host, sudo_passwd) for host in target_hosts]
+    elif backend == 'fabric':
+        cf = ConnectionConfig(cf_settings)
+        group = SerialGroup(*target_hosts, config=cf)
+        cfg.conn_pool = group
+    else:
+        raise Exit("Unknown connection backend `{}`.".format(backend))
 
@@ -1,90 +1,353 @@
 
 import os
+import shutil
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import attr
 import yaml
 from invoke import Exit
 from invocations.console import confirm
-from deployer.archive_filter import filter_files_for_archival 
-from deployer.etc import _copy_etc
-from deployer.permissions import apply_permissions
+from deployer.archive_builder import GitRepo, write_commit_archive
+from deployer.archive_cache import cache_key, open_archive_cache
+from deployer.archive_filter import filter_working_tree_for_archival
+from deployer.delta import upload_delta
+from deployer import docker
+from deployer.docker import docker_build_command
+from deployer.deploy_plan import plan_host
+from deployer.etc import copy_etc_command, new_etc_backup_dir
+from deployer.hooks import new_changes_file, parse_reload_hooks, plan_changes_and_hooks, record_tree_changes_command
+from deployer.permissions import archive_permissions, plan_permissions, plan_remove_perm_files, split_ad_hoc_perms
+from deployer import profiling
+from deployer import releases
+from deployer.remote_plan import RemotePlan, execute_plan
+from deployer.secrets_session import open_secrets_session, reveal_working_tree
 from deployer import template_tools as ttools
 from deployer.shellfuncs import shellquote
+from deployer.stream import stream_archive
 from deployer.terminal import warn
 
-def deploy_config(conn, config, archive_path, move_etc=True):
+@attr.s
+class Deployment(object):
+    """
+    A configuration and its archive, deployed with others in one session.
+    `name` identifies the configuration in messages.
+    """
+    name = attr.ib()
+    config = attr.ib()
+    archive_path = attr.ib(default=None)
+    commit = attr.ib(default=None)
+    docker_image = attr.ib(default=None)
+
+def deploy_config(conn, config, archive_path, move_etc=True, delta=False, batch=False, baked_perms=False, skip_unchanged=False, commit=None, docker_image=None, stream=False):
     """
     Deploy a configuration.
     
     :param move_etc:`(True)/False - Move the embedded 'etc' config to the '/etc' root.` 
     :param local_archive:`Don't deploy-- instead create a local archive at this path.`
+    :param delta:`True/(False) - Only upload files that differ from the deployed config folder.`
+    :param batch:`True/(False) - Run the steps after the upload as one remote script.`
+    :param baked_perms:`True/(False) - The archive entries already carry their final owners and modes.`
+    :param skip_unchanged:`True/(False) - Don't deploy if the host already matches the archive.  Requires baked_perms.`
+    :param commit:`The commit being deployed.  Used to name the release if releases are kept.`
+    :param docker_image:`A docker.DistributedImage to install instead of building the image on the host.`
+    :param stream:`True/(False) - Pipe the archive into a remote `tar` instead of uploading it to a file.`
+    """
+    plan = RemotePlan()
+    if not plan_deploy(conn, plan, config, archive_path, move_etc, delta, baked_perms, skip_unchanged, commit, docker_image, stream=stream):
+        return None
+    return execute_plan(conn, plan, batch=batch)
+
+def deploy_configs(conn, deployments, move_etc=True, delta=False, batch=False, baked_perms=False, skip_unchanged=False, stream=False):
+    """
+    Deploy several configurations to a host in one session.  All the
+    archives are uploaded and their installation steps are run as one
+    plan.  `/etc` files replaced by any of them are backed up together,
+    so `restore-etc` undoes the whole deployment.
+
+    :param deployments:`A list of `Deployment`.`
+    """
+    plan = RemotePlan()
+    etc_backup_dir = None
+    if move_etc:
+        etc_backup_dir = new_etc_backup_dir()
+    planned = 0
+    for deployment in deployments:
+        print("--- {} ---".format(deployment.name))
+        if plan_deploy(
+                conn,
+                plan,
+                deployment.config,
+                deployment.archive_path,
+                move_etc,
+                delta,
+                baked_perms,
+                skip_unchanged,
+                deployment.commit,
+                deployment.docker_image,
+                etc_backup_dir,
+                stream):
+            planned += 1
+    if planned == 0:
+        return None
+    return execute_plan(conn, plan, batch=batch)
+
+def plan_deploy(conn, plan, config, archive_path, move_etc=True, delta=False, baked_perms=False, skip_unchanged=False, commit=None, docker_image=None, etc_backup_dir=None, stream=False):
+    """
+    Upload the archive and add the steps that install it to `plan`.  See
+    `deploy_config()` for the options.  Replaced `/etc` files are backed up
+    to `etc_backup_dir` (a new backup folder by default).
+
+    :returns: False if the host already matches the archive and nothing
+        was added to `plan`, otherwise True.
+    """
+    remote_config_folder = config.get_remote_config_folder() 
+    remote = None
+    if skip_unchanged and baked_perms:
+        with profiling.phase("compare with deployed config", conn.host):
+            host_plan = plan_host(conn, config, archive_path, move_etc)
+        if not host_plan.has_changes:
+            print("No changes for {}; skipping.".format(conn.host))
+            return False
+        remote = host_plan.remote
+    release = None
+    keep_releases = config.get_keep_releases()
+    if keep_releases > 0 and not remote_config_folder is None:
+        release = releases.new_release(commit, archive_path)
+        existing = releases.remote_releases(conn, remote_config_folder).find_digest(release.digest)
+        if not existing is None:
+            print("Reusing release {}.".format(existing))
+            if docker_image is not None:
+                docker.stage_image(conn, plan, docker_image)
+            releases.plan_activate(plan, config, existing, move_etc, etc_backup_dir, build_image=docker_image is None)
+            plan.sudo("remove old releases", releases.prune_command(remote_config_folder, keep_releases))
+            return True
+    remote_stagedir = None
+    if delta and not remote_config_folder is None:
+        remote_stagedir = upload_delta(conn, plan, remote_config_folder, archive_path, baked_perms, remote, move_etc)
+    if remote_stagedir is None and stream:
+        remote_stagedir = stream_archive(conn, archive_path, baked_perms)
+    if remote_stagedir is None:
+        remote_stagedir = upload_archive(conn, plan, archive_path, baked_perms)
+    if docker_image is not None:
+        docker.stage_image(conn, plan, docker_image)
+    plan_install(
+        plan,
+        config,
+        remote_stagedir,
+        archive_path,
+        move_etc,
+        baked_perms,
+        release,
+        build_image=docker_image is None,
+        etc_backup_dir=etc_backup_dir)
+    return True
+
+def plan_install(plan, config, remote_stagedir, archive_path, move_etc=True, baked_perms=False, release=None, build_image=True, etc_backup_dir=None):
+    """
+    Add the steps that install the staged configuration in
+    `remote_stagedir` to `plan`.  Permission files are read from the
+    local archive at `archive_path`.
+
+    If `baked_perms` is True, the extracted files already have their final
+    owners and modes, so only the staging folder itself and ad hoc paths
+    outside the config folder are changed.
+
+    If `release` is given, the staging folder becomes that release and the
+    config folder is switched to it instead of being replaced.
+
+    If `build_image` is False, a docker build target's image is installed
+    by other steps rather than built from the staging folder.
+
+    If the role has reload hooks, the paths that change are collected and
+    the triggered hooks run after the configuration is installed.
+
+    Replaced `/etc` files are backed up to `etc_backup_dir` (a new backup
+    folder by default).
     """
     remote_config_folder = config.get_remote_config_folder() 
-    remote_archive = conn.run("mktemp").stdout.rstrip()
-    paths = conn.put(archive_path, remote_archive)
-    remote_stagedir = conn.run("mktemp -d").stdout.rstrip()
-    with conn.cd(remote_stagedir):
-        conn.run("tar xzvf {}".format(shellquote(remote_archive)))
-        conn.run("rm {}".format(shellquote(remote_archive)))
     config_owner = config.get_config_owner()
     config_group = config.get_config_group()
-    conn.sudo("chown -R {}:{} {}".format(
-        shellquote(config_owner), 
-        shellquote(config_group), 
-        shellquote(remote_stagedir))
-    )
     folder_perms = config.get_config_folder_perms()
     file_perms = config.get_config_file_perms()
-    ad_hoc_perms = config.get_ad_hoc_perms()
-    if folder_perms.lower() != "skip":
-        conn.sudo("chmod {} -R {}".format(folder_perms, shellquote(remote_stagedir)))
-    if file_perms.lower() != "skip":
-        conn.sudo("find {} -type f -exec chmod {} {{}} \;".format(shellquote(remote_stagedir), file_perms))
+    if baked_perms:
+        plan.sudo("set staging folder owner", "chown {}:{} {}".format(
+            shellquote(config_owner), 
+            shellquote(config_group), 
+            shellquote(remote_stagedir))
+        )
+        if folder_perms.lower() != "skip":
+            plan.sudo("set staging folder permissions", "chmod {} {}".format(folder_perms, shellquote(remote_stagedir)))
+        ad_hoc_perms = split_ad_hoc_perms(config)[1]
+    else:
+        plan.sudo("set owner", "chown -R {}:{} {}".format(
+            shellquote(config_owner), 
+            shellquote(config_group), 
+            shellquote(remote_stagedir))
+        )
+        if folder_perms.lower() != "skip":
+            plan.sudo("set folder permissions", "chmod {} -R {}".format(folder_perms, shellquote(remote_stagedir)))
+        if file_perms.lower() != "skip":
+            plan.sudo("set file permissions", "find {} -type f -exec chmod {} {{}} +".format(shellquote(remote_stagedir), file_perms))
+        ad_hoc_perms = config.get_ad_hoc_perms()
     for path, perm in ad_hoc_perms.items():
-        conn.sudo("chmod {} {}".format(shellquote(perm), shellquote(path)))        
-    apply_permissions(conn, config, remote_stagedir)
+        plan.sudo("set ad hoc permissions", "chmod {} {}".format(shellquote(perm), shellquote(path)))        
+    if not baked_perms:
+        plan_permissions(plan, remote_stagedir, archive_path, keep_etc=move_etc)
+    elif not move_etc:
+        perm_files = archive_permissions(archive_path)[0]
+        plan_remove_perm_files(plan, remote_stagedir, [path for path in perm_files if path.startswith("etc/")])
+    reload_hooks = parse_reload_hooks(config.get_reload_hooks())
+    changes_file = None
+    if len(reload_hooks) > 0:
+        changes_file = new_changes_file()
+        if not remote_config_folder is None:
+            plan.sudo("record config changes", record_tree_changes_command(
+                remote_stagedir,
+                remote_config_folder,
+                changes_file,
+                exclude_etc=move_etc))
+    if not move_etc:
+        etc_backup_dir = None
+    elif etc_backup_dir is None:
+        etc_backup_dir = new_etc_backup_dir()
+    if release is not None:
+        if move_etc:
+            releases.plan_release_etc(plan, remote_config_folder, remote_stagedir, release, etc_backup_dir)
+        if config.is_docker_build_target() and build_image:
+            plan.sudo("docker build", docker_build_command(config, remote_stagedir))
+        releases.plan_release(plan, remote_config_folder, remote_stagedir, release, config.get_keep_releases())
+        plan_changes_and_hooks(plan, reload_hooks, changes_file, etc_backup_dir)
+        return
     if move_etc:
         remote_staged_etc = os.path.join(remote_stagedir, "etc")
-        _copy_etc(conn, remote_stagedir, 'etc', '/etc')
-        conn.sudo("rm -Rf {}".format(shellquote(remote_staged_etc)))
+        plan.sudo("copy etc", copy_etc_command(remote_stagedir, 'etc', '/etc', etc_backup_dir))
+        plan.sudo("remove staged etc", "rm -Rf {}".format(shellquote(remote_staged_etc)))
     is_docker_build_target = config.is_docker_build_target()
-    if is_docker_build_target:
-        build_docker_target(conn, config, remote_stagedir) 
+    if is_docker_build_target and build_image:
+        plan.sudo("docker build", docker_build_command(config, remote_stagedir))
     if not remote_config_folder is None:
-        conn.sudo("rm -Rf {}".format(remote_config_folder))
-        conn.sudo("mv {} {}".format(remote_stagedir, remote_config_folder))
-        result = conn.sudo("which restorecon", warn=True)
-        if not result.failed:
-            conn.sudo("restorecon -R {}".format(shellquote(remote_config_folder)))
+        plan.sudo("remove old config", "rm -Rf {}".format(remote_config_folder))
+        plan.sudo("install config", "mv {} {}".format(remote_stagedir, remote_config_folder))
+        plan.sudo("restorecon", releases.restorecon_command(remote_config_folder))
     else:
-        conn.sudo("rm -Rf {}".format(shellquote(remote_stagedir)))
+        plan.sudo("remove staging folder", "rm -Rf {}".format(shellquote(remote_stagedir)))
+    plan_changes_and_hooks(plan, reload_hooks, changes_file, etc_backup_dir)
     
+def upload_archive(conn, plan, archive_path, baked_perms=False):
+    """
+    Upload the archive and add the steps that extract it into a new
+    remote staging folder to `plan`.  If `baked_perms` is True, the
+    archive is extracted as root, keeping the owners and modes of its
+    entries.
+    Return the path of the staging folder.
+    """
+    remote_archive, remote_stagedir = conn.run("mktemp && mktemp -d").stdout.split()
+    paths = conn.put(archive_path, remote_archive)
+    if baked_perms:
+        plan.sudo("extract archive", "tar xzvpf {} --same-owner -C {}".format(
+            shellquote(remote_archive),
+            shellquote(remote_stagedir)))
+    else:
+        plan.run("extract archive", "cd {} && tar xzvf {}".format(shellquote(remote_stagedir), shellquote(remote_archive)))
+    plan.run("remove archive", "rm {}".format(shellquote(remote_archive)))
+    return remote_stagedir
+
 def build_docker_target(conn, config, remote_stagedir):
     """
     Build a docker image from the configuration in `remote_stagedir`.
     """
-    with conn.cd(remote_stagedir):
-        build_name = config.get_docker_build_name()
-        build_path = config.get_docker_build_path()
-        rm_flag = config.get_docker_build_rm()
-        build_args = config.get_docker_build_args() 
-        build_options = config.get_docker_build_options()
-        args = ['docker', 'build']
-        if rm_flag:
-            args.append("--rm")
-        if not build_name is None:
-            args.append("-t")
-            args.append(shellquote(build_name))
-        for k, v in build_args.items():
-            args.append("--build-arg")
-            args.append(shellquote("{}={}".format(k, v)))
-        args.extend(build_options)
-        args.append(shellquote(build_path))
-        command = ' '.join(args)
-    conn.sudo('''bash -c "cd {} && {}"'''.format(shellquote(remote_stagedir), command))
-
-def create_local_archive(conn, config, src_commit):
+    conn.sudo(docker_build_command(config, remote_stagedir))
+
+def resolve_commit(config, src_commit):
+    """
+    Return the full SHA of the commit that would be deployed.
+    """
+    if src_commit is None:
+        src_commit = config.get_config_branch()
+    return GitRepo(config.get_working_tree()).resolve_commit(src_commit)
+
+def create_local_archive(conn, config, src_commit, legacy=False, use_cache=True):
     """
     Create local archive and return its path.
+
+    The archive is built directly from the git object store for the
+    commit, so the working tree is not modified.  If an archive for the
+    same commit, secrets, and settings is in the local archive cache, it
+    is used instead.  If `legacy` is True, the archive is built by
+    checking out a temporary archive branch instead.
+    """
+    if legacy:
+        return create_local_archive_from_branch(conn, config, src_commit)
+    wt = config.get_working_tree()
+    if src_commit is None:
+        src_commit = config.get_config_branch()
+    if not os.path.exists(wt):
+        raise Exit("Working tree '{}' does not exist!".format(wt))
+    repo = GitRepo(wt)
+    commit = repo.resolve_commit(src_commit)
+    cache = None
+    if use_cache:
+        cache = open_archive_cache(config)
+    key = None
+    cached_path = None
+    if cache is not None:
+        key = cache_key(repo, commit, config)
+        cached_path = cache.lookup(key)
+    fd, archive_path = tempfile.mkstemp(suffix=".tgz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if cached_path is not None:
+                print("Using cached archive for commit {}.".format(commit))
+                with open(cached_path, "rb") as fin:
+                    shutil.copyfileobj(fin, f)
+            else:
+                write_commit_archive(repo, commit, config, f)
+        if cache is not None and cached_path is None:
+            cache.store(key, archive_path)
+    except BaseException:
+        os.unlink(archive_path)
+        raise
+    return archive_path
+
+def create_local_archives(deployments, invokers, legacy=False, use_cache=True, workers=4):
+    """
+    Create the local archive of each `Deployment` concurrently and set its
+    `archive_path`.  `invokers` holds the local invoker to use for each
+    deployment.  If any archive can't be created, the others are removed.
+    The legacy archive is always built from the configured branch.
+
+    Legacy archives, and archives of configs that share a working tree,
+    are created one at a time, since the legacy build checks out branches
+    in the working tree and may ask for confirmation.
+    """
+
+    def create(deployment, invoker):
+        with profiling.phase("create local archive ({})".format(deployment.name)):
+            deployment.archive_path = create_local_archive(
+                invoker,
+                deployment.config,
+                None if legacy else deployment.commit,
+                legacy=legacy,
+                use_cache=use_cache)
+
+    working_trees = [os.path.realpath(deployment.config.get_working_tree()) for deployment in deployments]
+    if legacy or len(set(working_trees)) < len(working_trees):
+        workers = 1
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(deployments)))) as executor:
+        futures = [executor.submit(create, deployment, invoker) for deployment, invoker in zip(deployments, invokers)]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    if len(errors) > 0:
+        for deployment in deployments:
+            if deployment.archive_path is not None:
+                os.unlink(deployment.archive_path)
+                deployment.archive_path = None
+        raise errors[0]
+
+def create_local_archive_from_branch(conn, config, src_commit):
+    """
+    Create local archive by committing the decrypted files to a temporary
+    archive branch, and return its path.
     """
     wt = config.get_working_tree()
     if src_commit is None:
@@ -103,13 +366,16 @@ def create_local_archive(conn, config, src_commit):
                 raise Exit("Can't use working tree with uncommitted changes.  Stash, commit, or reset.")
         conn.run("git checkout {}".format(shellquote(src_branch)))
         if has_secrets:
-            conn.run("git secret reveal")
+            session = open_secrets_session(config)
+            if session is None:
+                conn.run("git secret reveal")
+            else:
+                reveal_working_tree(session, wt)
             ttools.fill_templates(config)
         archive_branch = "{}-archive".format(src_branch)
         conn.run("git branch -D {}".format(shellquote(archive_branch)), warn=True) 
         conn.run("git checkout -b {}".format(shellquote(archive_branch))) 
-        filter_files_for_archival(conn, config, ".secret") 
-        filter_files_for_archival(conn, config, ".template") 
+        filter_working_tree_for_archival(conn, config, (".secret", ".template"))
         if has_secrets:
             secrets_file_name = config.get_secrets_file_name()
             if secrets_file_name is not None:
@@ -0,0 +1,90 @@
+
+import os
+import tarfile
+import tempfile
+import threading
+from deployer import manifest
+from deployer.shellfuncs import chunked, shellquote
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def local_manifest(archive_path):
+    """
+    Return the manifest of a local archive.  Computed once per archive.
+    """
+    with _manifests_lock:
+        if not archive_path in _manifests:
+            _manifests[archive_path] = manifest.archive_manifest(archive_path)
+        return _manifests[archive_path]
+
+def write_delta_archive(archive_path, changed, delta_path):
+    """
+    Write the members of the archive at `archive_path` that are in
+    `changed` to a new archive at `delta_path`.  Folders are always
+    included.
+    """
+    changed = set(changed)
+    with tarfile.open(archive_path, "r:gz") as src:
+        with tarfile.open(delta_path, "w:gz", format=tarfile.PAX_FORMAT) as dst:
+            for info in src:
+                path = manifest.member_path(info)
+                if info.isfile():
+                    if path in changed:
+                        dst.addfile(info, src.extractfile(info))
+                elif info.isdir() or path in changed:
+                    dst.addfile(info)
+
+def upload_delta(conn, plan, remote_config_folder, archive_path, baked_perms=False, remote=None, move_etc=True):
+    """
+    Upload only the files that changed in the archive at `archive_path`
+    compared to the currently deployed configuration in
+    `remote_config_folder`.  Steps that assemble the new staging folder
+    from the deployed folder plus the delta are added to `plan`.
+    If `baked_perms` is True, files whose mode or owner changed are
+    uploaded too.  `remote` is the manifest of the deployed folder if it
+    has already been fetched.
+
+    Permission files and, if `move_etc` is True, the `etc` folder are
+    removed from the deployed folder when it is installed, so they are
+    left out of the comparison.  The `etc` files, including their
+    permission files, are always uploaded because the `/etc` sync
+    compares them with the live files.
+
+    :returns: The path of the remote staging folder, or None if nothing is
+        deployed yet and the full archive must be uploaded instead.
+    """
+    if remote is None:
+        remote = manifest.remote_manifest(conn, remote_config_folder)
+    if len(remote) == 0:
+        return None
+    local, local_etc = manifest.split_local_manifest(local_manifest(archive_path), move_etc)
+    changed, deleted = manifest.diff_manifests(local, remote, compare_attrs=baked_perms)
+    changed_files = [path for path in changed if not local[path].is_folder]
+    print("Delta: {} of {} files changed, {} removed.".format(
+        len(changed_files),
+        len([e for e in local.values() if not e.is_folder]),
+        len(deleted)))
+    shipped = changed_files + ["etc/{}".format(path) for path in local_etc]
+    if move_etc:
+        shipped += [
+            path for path, entry in local_manifest(archive_path).items()
+            if path.startswith("etc/") and os.path.basename(path) == manifest.PERM_FILE and not entry.is_folder]
+    fd, delta_path = tempfile.mkstemp(suffix=".tgz")
+    os.close(fd)
+    try:
+        write_delta_archive(archive_path, shipped, delta_path)
+        remote_archive, remote_stagedir = conn.run("mktemp && mktemp -d").stdout.split()
+        conn.put(delta_path, remote_archive)
+    finally:
+        os.unlink(delta_path)
+    plan.sudo("copy deployed config", "cp -a {}/. {}/".format(
+        shellquote(remote_config_folder),
+        shellquote(remote_stagedir)))
+    for paths in chunked(deleted):
+        plan.sudo("remove deleted files", "bash -c {}".format(shellquote("cd {} && rm -rf -- {}".format(
+            shellquote(remote_stagedir),
+            ' '.join(shellquote(p) for p in paths)))))
+    plan.sudo("extract delta", "tar xzpf {} --same-owner -C {}".format(shellquote(remote_archive), shellquote(remote_stagedir)))
+    plan.sudo("remove delta", "rm -f {}".format(shellquote(remote_archive)))
+    return remote_stagedir
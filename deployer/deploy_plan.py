@@ -0,0 +1,112 @@
+
+import attr
+from deployer import etc, manifest
+from deployer.delta import local_manifest
+
+@attr.s
+class HostPlan(object):
+    """
+    What deploying an archive would change on a host.  If `comparable` is
+    False, the host has to be deployed without knowing what would change.
+    """
+    host = attr.ib()
+    comparable = attr.ib(default=True)
+    changed = attr.ib(default=attr.Factory(list))
+    deleted = attr.ib(default=attr.Factory(list))
+    etc_changed = attr.ib(default=attr.Factory(list))
+    remote = attr.ib(default=None)
+    remote_etc = attr.ib(default=attr.Factory(dict))
+
+    @property
+    def has_changes(self):
+        if not self.comparable:
+            return True
+        return len(self.changed) + len(self.deleted) + len(self.etc_changed) > 0
+
+def plan_host(conn, config, archive_path, move_etc=True):
+    """
+    Compare the archive at `archive_path` with what is deployed on the host
+    and return a `HostPlan`.  Config folder entries are compared by
+    content, mode, and owner, so the archive must have baked permissions.
+    `/etc` files are compared with the owner and mode the `/etc` sync
+    would give them.
+    """
+    host_plan = HostPlan(conn.host)
+    remote_config_folder = config.get_remote_config_folder()
+    if remote_config_folder is None or config.is_docker_build_target():
+        host_plan.comparable = False
+        return host_plan
+    local_config, local_etc = manifest.split_local_manifest(local_manifest(archive_path), move_etc)
+    local_etc = etc.installed_entries(local_etc, etc.etc_owners(archive_path))
+    host_plan.remote = manifest.remote_manifest(conn, remote_config_folder)
+    host_plan.changed, host_plan.deleted = manifest.diff_manifests(local_config, host_plan.remote, compare_attrs=True)
+    if len(local_etc) > 0:
+        host_plan.remote_etc = manifest.remote_entries(conn, "/etc", sorted(local_etc.keys()))
+        host_plan.etc_changed = manifest.diff_manifests(local_etc, host_plan.remote_etc, compare_attrs=True)[0]
+    return host_plan
+
+def print_host_plan(host_plan):
+    """
+    Print the changes a deployment would make to a host.
+    """
+    if not host_plan.comparable:
+        print("Nothing to compare against; the host is always deployed.")
+        return
+    if not host_plan.has_changes:
+        print("No changes.")
+        return
+    for path in host_plan.changed:
+        if path in host_plan.remote:
+            print("  ~ {}".format(path))
+        else:
+            print("  + {}".format(path))
+    for path in host_plan.deleted:
+        print("  - {}".format(path))
+    for path in host_plan.etc_changed:
+        if path in host_plan.remote_etc:
+            print("  ~ /etc/{}".format(path))
+        else:
+            print("  + /etc/{}".format(path))
+    print("{} changed, {} removed, {} changed in /etc.".format(
+        len(host_plan.changed),
+        len(host_plan.deleted),
+        len(host_plan.etc_changed)))
+
+def print_plan_summary(host_plans):
+    """
+    Print how many hosts a deployment would change.
+    """
+    changed = sorted(p.host for p in host_plans if p.has_changes)
+    print()
+    print("{} of {} host(s) would change: {}".format(
+        len(changed),
+        len(host_plans),
+        ', '.join(changed) or '(none)'))
+
+def find_etc_conflicts(deployments, hosts_by_name):
+    """
+    Return a sorted list of (path, names) for the `/etc` files that more
+    than one of `deployments` would write to the same host with different
+    contents, owners, or modes.  `hosts_by_name` maps each deployment name
+    to the set of hosts it is deployed to.
+    """
+    by_path = {}
+    for deployment in deployments:
+        etc_entries = etc.installed_entries(
+            manifest.split_local_manifest(local_manifest(deployment.archive_path))[1],
+            etc.etc_owners(deployment.archive_path))
+        for path, entry in etc_entries.items():
+            by_path.setdefault(path, []).append((deployment.name, entry))
+    conflicts = []
+    for path, sources in sorted(by_path.items()):
+        names = set()
+        for n, (name, entry) in enumerate(sources):
+            for other_name, other_entry in sources[n + 1:]:
+                if entry == other_entry:
+                    continue
+                if hosts_by_name[name].isdisjoint(hosts_by_name[other_name]):
+                    continue
+                names.update((name, other_name))
+        if len(names) > 0:
+            conflicts.append((path, sorted(names)))
+    return conflicts
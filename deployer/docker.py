@@ -1,14 +1,59 @@
 
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+import attr
+from invoke import Exit
 from deployer.shellfuncs import shellquote
+from deployer.terminal import warn
+
+@attr.s
+class DistributedImage(object):
+    """
+    A docker image that was built once and is distributed to the hosts
+    instead of being built on each of them.  `mode` is `registry` (hosts
+    pull `ref`) or `load` (hosts load the `docker save` archive at
+    `image_archive`).  Hosts tag the image as `name`.
+    """
+    mode = attr.ib()
+    name = attr.ib()
+    ref = attr.ib()
+    image_archive = attr.ib(default=None)
+
+def image_repository(name):
+    """
+    Return the image name `name` without its tag or digest.  A `:` before
+    the last `/` belongs to a registry host and port and is kept.
+    """
+    name = name.split("@")[0]
+    if name.rfind(":") > name.rfind("/"):
+        name = name[:name.rfind(":")]
+    return name
+
+def registry_ref(config, tag):
+    """
+    Return the registry reference of the image with `tag`.
+    """
+    return "{}/{}:{}".format(
+        config.get_docker_registry().rstrip("/"),
+        image_repository(config.get_docker_build_name()),
+        tag)
 
 def docker_run(conn, config, stop_and_remove=None):
     """
     Run a docker container from a deployed image.
+    If the image is distributed through a registry, the newest image
+    pushed for the stage is pulled first.
     """
     if stop_and_remove is not None:
         docker_stop(conn, stop_and_remove)
         docker_rm(conn, stop_and_remove)
     build_name = config.get_docker_build_name()
+    if config.get_docker_distribute() == 'registry':
+        conn.sudo(pull_command(registry_ref(config, config.stage), build_name))
     args = ['docker', 'run']
     args.extend(config.get_docker_run_args())
     args.append(build_name)
@@ -16,6 +61,159 @@ def docker_run(conn, config, stop_and_remove=None):
     cmd = ' '.join(args)
     conn.sudo(cmd)
 
+@attr.s
+class ReplaceSettings(object):
+    """
+    How `docker_replace()` swaps containers.  The new container is started
+    in whichever of the two `slots` isn't running, named
+    `<name>-<slot>` and given the slot's extra `docker run` arguments
+    (e.g. its port mapping).
+    """
+    name = attr.ib()
+    slots = attr.ib()
+    readiness = attr.ib(default=None)
+    timeout = attr.ib(default=60)
+    interval = attr.ib(default=2)
+
+def parse_replace_settings(settings):
+    """
+    Return `ReplaceSettings` from the `docker-replace` section of a role,
+    or None if the role doesn't have one.
+    """
+    if settings is None:
+        return None
+    name = settings.get('name', None)
+    if name is None:
+        raise Exit("`docker-replace` requires a container `name`.")
+    slots = settings.get('slots', {'blue': [], 'green': []})
+    if len(slots) != 2:
+        raise Exit("`docker-replace` requires exactly two `slots`.")
+    slots = dict((slot, list(args or [])) for slot, args in slots.items())
+    return ReplaceSettings(
+        name,
+        slots,
+        settings.get('readiness', None),
+        int(settings.get('timeout', 60)),
+        int(settings.get('interval', 2)))
+
+def container_names(conn):
+    """
+    Return a dict mapping the names of all containers on the host to
+    True if they are running.
+    """
+    result = conn.sudo("docker ps -a --format '{{.Names}} {{.State}}'", hide=True)
+    names = {}
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            names[parts[0]] = (parts[1] == 'running')
+    return names
+
+_started_at = re.compile(r'^(\S{19})(\.\d+)?\S* /?(\S+)$')
+
+def oldest_container(conn, containers):
+    """
+    Return the name of the container in `containers` that was started
+    first.
+    """
+    result = conn.sudo("docker inspect -f '{{{{.State.StartedAt}}}} {{{{.Name}}}}' {}".format(
+        ' '.join(shellquote(name) for name in containers)), hide=True)
+    started = {}
+    for line in result.stdout.splitlines():
+        match = _started_at.match(line.strip())
+        if match is not None:
+            seconds, fraction, name = match.groups()
+            started[name] = (seconds, float("0{}".format(fraction or '')))
+    if len(started) != len(containers):
+        raise Exit("Could not tell which of {} started first.".format(', '.join(containers)))
+    return min(containers, key=lambda name: started[name])
+
+def readiness_command(settings, container, slot):
+    """
+    Return the command that waits until `container` is ready or the
+    timeout expires.  Without a `readiness` probe, the container is ready
+    once docker reports it as healthy (or running, if the image has no
+    health check).  `{container}` and `{slot}` in the probe are replaced
+    with the container name and slot.
+    """
+    if settings.readiness is None:
+        probe = (
+            "s=$(docker inspect -f '{{{{if .State.Health}}}}{{{{.State.Health.Status}}}}"
+            "{{{{else}}}}{{{{.State.Status}}}}{{{{end}}}}' {0}); "
+            "[ \"$s\" = healthy ] || [ \"$s\" = running ]").format(shellquote(container))
+    else:
+        probe = settings.readiness.replace("{container}", container).replace("{slot}", slot)
+    inner_cmd = "until {}; do sleep {}; done".format(probe, settings.interval)
+    return "timeout {} bash -c {}".format(settings.timeout, shellquote(inner_cmd))
+
+def docker_replace(conn, config):
+    """
+    Replace the running container with one from the deployed image without
+    downtime: start the new container beside the old one, wait for it to
+    be ready, then stop and remove the old one.  If the new container
+    doesn't become ready, it is removed and the old one keeps running.
+    If both slots are running, the container that was started first is
+    replaced and the other one is retired.
+
+    :returns: A dict of phase name to elapsed seconds.
+    """
+    settings = parse_replace_settings(config.get_docker_replace_settings())
+    build_name = config.get_docker_build_name()
+    timings = {}
+    start = time.time()
+    if config.get_docker_distribute() == 'registry':
+        conn.sudo(pull_command(registry_ref(config, config.stage), build_name))
+        timings['pull'] = time.time() - start
+    names = container_names(conn)
+    containers = dict(("{}-{}".format(settings.name, slot), slot) for slot in sorted(settings.slots))
+    old = [name for name in containers if names.get(name, False)]
+    free = [name for name in containers if not name in old]
+    if len(free) > 0:
+        new = free[0]
+    else:
+        new = oldest_container(conn, old)
+        old.remove(new)
+        warn("Both slots of '{}' are running; replacing the older container '{}'.".format(settings.name, new))
+    if new in names:
+        conn.sudo("docker rm -f {}".format(shellquote(new)))
+    args = ['docker', 'run', '-d', '--name', new]
+    args.extend(settings.slots[containers[new]])
+    args.extend(config.get_docker_run_args())
+    args.append(build_name)
+    phase_start = time.time()
+    conn.sudo(' '.join(shellquote(arg) for arg in args))
+    timings['start'] = time.time() - phase_start
+    phase_start = time.time()
+    result = conn.sudo(readiness_command(settings, new, containers[new]), warn=True)
+    timings['ready'] = time.time() - phase_start
+    if result.failed:
+        conn.sudo("docker logs --tail 20 {}".format(shellquote(new)), warn=True)
+        conn.sudo("docker rm -f {}".format(shellquote(new)), warn=True)
+        raise Exit("Container '{}' did not become ready within {}s.".format(new, settings.timeout))
+    phase_start = time.time()
+    for name in old:
+        docker_stop(conn, name)
+        docker_rm(conn, name)
+    timings['retire'] = time.time() - phase_start
+    timings['total'] = time.time() - start
+    print("Replaced {} with {}: {}".format(
+        ', '.join(old) or '(nothing)',
+        new,
+        format_timings(timings)))
+    return timings
+
+def format_timings(timings):
+    return ', '.join("{} {:.1f}s".format(phase, elapsed) for phase, elapsed in timings.items())
+
+def print_replace_timings(host_timings):
+    """
+    Print the per-host phase timings of a container replacement.
+    """
+    print()
+    print("=== Container replacement timings ===")
+    for host, timings in sorted(host_timings.items(), key=lambda item: -item[1]['total']):
+        print("{}  {}".format(host, format_timings(timings)))
+
 def docker_stop(conn, container):
     """
     Stop a docker container from a deployed image.
@@ -36,3 +234,113 @@ def docker_rm(conn, container):
     cmd = ' '.join(args)
     conn.sudo(cmd)
 
+def docker_build_command(config, remote_stagedir, tags=()):
+    """
+    Return the command that builds a docker image from the configuration
+    in `remote_stagedir`.  The image is tagged with the build name and
+    any extra `tags`.
+    """
+    build_name = config.get_docker_build_name()
+    build_path = config.get_docker_build_path()
+    rm_flag = config.get_docker_build_rm()
+    build_args = config.get_docker_build_args() 
+    build_options = config.get_docker_build_options()
+    args = ['docker', 'build']
+    if rm_flag:
+        args.append("--rm")
+    if not build_name is None:
+        args.append("-t")
+        args.append(shellquote(build_name))
+    for tag in tags:
+        args.append("-t")
+        args.append(shellquote(tag))
+    for k, v in build_args.items():
+        args.append("--build-arg")
+        args.append(shellquote("{}={}".format(k, v)))
+    args.extend(build_options)
+    args.append(shellquote(build_path))
+    command = ' '.join(args)
+    return '''bash -c "cd {} && {}"'''.format(shellquote(remote_stagedir), command)
+
+def pull_command(ref, name):
+    """
+    Return the command that pulls `ref` and tags it as `name`.
+    """
+    return "docker pull {0} && docker tag {0} {1}".format(shellquote(ref), shellquote(name))
+
+def build_image_once(invoker, config, archive_path, commit, move_etc=True):
+    """
+    Build the docker image for the configuration in the local archive at
+    `archive_path` on the local host and publish it as the role's
+    `docker-distribute` setting says.
+
+    :returns: A `DistributedImage`, or None if the image is built on each
+        host instead.
+    """
+    mode = config.get_docker_distribute()
+    if mode is None:
+        return None
+    if not mode in ('registry', 'load'):
+        raise Exit("Unknown `docker-distribute` mode '{}'.".format(mode))
+    build_name = config.get_docker_build_name()
+    if build_name is None:
+        raise Exit("`docker-distribute` requires a `docker-build-name`.")
+    if mode == 'registry':
+        if config.get_docker_registry() is None:
+            raise Exit("`docker-distribute: registry` requires a `docker-registry`.")
+        ref = registry_ref(config, commit[:12])
+        tags = [ref, registry_ref(config, config.stage)]
+    else:
+        ref = build_name
+        tags = []
+    build_dir = tempfile.mkdtemp(prefix="deployer-docker-")
+    try:
+        with tarfile.open(archive_path, "r:gz") as tar:
+            tar.extractall(build_dir)
+        if move_etc:
+            remove_tree(os.path.join(build_dir, "etc"))
+        print("Building docker image '{}' locally.".format(build_name))
+        invoker.run(docker_build_command(config, build_dir, tags))
+    finally:
+        remove_tree(build_dir)
+    image = DistributedImage(mode, build_name, ref)
+    if mode == 'registry':
+        for tag in tags:
+            invoker.run("docker push {}".format(shellquote(tag)))
+    else:
+        fd, image.image_archive = tempfile.mkstemp(suffix=".tar.gz")
+        os.close(fd)
+        invoker.run("docker save {} | gzip > {}".format(shellquote(ref), shellquote(image.image_archive)))
+    return image
+
+def remove_image_archive(image):
+    """
+    Remove the local `docker save` archive of `image`, if any.
+    """
+    if image is not None and image.image_archive is not None:
+        os.unlink(image.image_archive)
+
+def remove_tree(path):
+    """
+    Remove a local folder extracted from an archive.  Folders are made
+    writable first since the archive may have made them read-only.
+    """
+    if not os.path.isdir(path):
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        os.chmod(dirpath, 0o700)
+    shutil.rmtree(path)
+
+def stage_image(conn, plan, image):
+    """
+    Upload the image archive if the image is loaded rather than pulled,
+    and add the steps that install `image` on the host to `plan`.
+    """
+    if image.mode == 'registry':
+        plan.sudo("pull docker image", pull_command(image.ref, image.name))
+        return
+    remote_image = conn.run("mktemp").stdout.strip()
+    conn.put(image.image_archive, remote_image)
+    plan.sudo("load docker image", "bash -c {}".format(shellquote(
+        "gunzip -c {} | docker load".format(shellquote(remote_image)))))
+    plan.run("remove docker image archive", "rm -f {}".format(shellquote(remote_image)))
@@ -1,8 +1,24 @@
 
 import os
 import sys
+import tarfile
+import threading
+import time
+import uuid
+from deployer.manifest import PERM_FILE, Entry, member_path
+from deployer.permissions import DEFAULT_UMASK, parse_permissions
 from deployer.shellfuncs import shellquote
 
+ETC_BACKUP_ROOT = '/var/lib/config-deployer/etc-backups'
+KEEP_ETC_BACKUPS = 20
+# The owner and group of `/etc` files no permission file sets an owner for,
+# i.e. the user the `/etc` sync runs as.
+ETC_OWNER = 'root'
+ETC_GROUP = 'root'
+
+_owners = {}
+_owners_lock = threading.Lock()
+
 def copy_etc(conn, config, src_dir='etc', dst_dir='/etc'):
     """
     If the deployed config folder contains a top level folder named
@@ -19,14 +35,194 @@ def _copy_etc(conn, parent_dir, src_dir, dst_dir):
     are copied into the corresponding locations
     in the `dst_dir` file hirearchy.
     """
+    conn.sudo(copy_etc_command(parent_dir, src_dir, dst_dir))
+
+def new_etc_backup_dir(backup_root=ETC_BACKUP_ROOT):
+    """
+    Return the path of a new, unique backup folder for an `/etc` sync.
+    """
+    return "{}/{}-{}".format(
+        backup_root,
+        time.strftime("%Y%m%d%H%M%S", time.gmtime()),
+        uuid.uuid4().hex[:8])
+
+def etc_owners(archive_path, src_dir='etc', perm_file=PERM_FILE):
+    """
+    Return a mapping of path relative to `/etc` to (user, group) for the
+    `/etc` files and folders whose owner is set by a permission file in
+    the `src_dir` folder of the local archive at `archive_path`.
+    Computed once per archive.
+    """
+    with _owners_lock:
+        if archive_path in _owners:
+            return _owners[archive_path]
+    owners = {}
+    with tarfile.open(archive_path, "r:gz") as tar:
+        for info in tar:
+            path = member_path(info)
+            if not info.isfile() or not path.startswith(src_dir + "/") or os.path.basename(path) != perm_file:
+                continue
+            text = tar.extractfile(info).read().decode('utf-8')
+            dirpth = os.path.relpath(os.path.dirname(path), src_dir)
+            for fname, user, group, perms in parse_permissions(text, path):
+                owners[os.path.normpath(os.path.join(dirpth, fname))] = (user, group)
+    with _owners_lock:
+        _owners[archive_path] = owners
+    return owners
+
+def installed_entries(entries, owners, umask=DEFAULT_UMASK):
+    """
+    Return the manifest entries the `/etc` sync leaves in `/etc` for the
+    staged `entries`, keyed by path relative to `/etc`.  Files are owned
+    by `ETC_OWNER` and `ETC_GROUP` unless `owners` (see `etc_owners()`)
+    sets them, and their modes are masked by `umask`.
+    """
+    installed = {}
+    for path, entry in entries.items():
+        if entry.is_link:
+            installed[path] = entry
+            continue
+        user, group = owners.get(path, (ETC_OWNER, ETC_GROUP))
+        installed[path] = Entry(entry.digest, entry.mode & ~umask, user, group)
+    return installed
+
+def copy_etc_command(parent_dir, src_dir, dst_dir, backup_dir=None, perm_file=PERM_FILE):
+    """
+    Return the command used by `_copy_etc()`.
+
+    Files and folders are created by the user the command runs as (root
+    under `sudo`) with the staged mode masked by the umask, as `cp` would
+    create them.  Only an owner set by a permission file (`perm_file`) in
+    the staged folder is applied; the permission files themselves are not
+    copied.  Folders missing from `dst_dir`, including empty ones, are
+    created; existing folders are left as they are.  Only files whose
+    contents, mode, owner, or group differ from the ones they would get,
+    and symbolic links whose target differs, are written, each to a
+    temporary name that is renamed into place.  The files that are replaced
+    are first copied to `backup_dir` (a new folder under `ETC_BACKUP_ROOT`
+    by default), and a `manifest` in that folder lists each path as
+    `created` (folders), `added`, or `replaced`.  Each changed path is
+    reported on a line starting with `changed`.  Nothing is written to
+    `backup_dir` if nothing changed.
+    """
     src_etc = strip_trailing_slash(os.path.join(parent_dir, src_dir))
     dst_dir = strip_trailing_slash(dst_dir)
-    inner_cmd = "if [ -d {0} ]; then cp -dR --remove-destination {0}/. {1}/ ; fi".format(shellquote(src_etc), shellquote(dst_dir))
-    conn.sudo("bash -c {}".format(shellquote(inner_cmd)))
+    if backup_dir is None:
+        backup_dir = new_etc_backup_dir()
+    inner_cmd = '''
+src={src}; dst={dst}; bk={bk}; pf={pf}
+[ -d "$src" ] || exit 0
+cd "$src" || exit 1
+um=$(umask); me="$(id -u):$(id -g)"
+masked() {{ printf '%o' $(( 8#$(stat -c %a "$1") & ~8#$um )); }}
+owned() {{ [ "$(stat -c %U:%G "$1")" = "$2" ] || [ "$(stat -c %u:%g "$1")" = "$2" ]; }}
+declare -A owners
+while IFS= read -r -d '' f; do
+    dir="${{f%/*}}"; dir="${{dir#.}}"; dir="${{dir#/}}"
+    while IFS= read -r line || [ -n "$line" ]; do
+        [[ "$line" =~ ^[[:space:]]*# ]] && continue
+        [[ "$line" =~ ^([^:]*):([^:]*):([^:]*):([^:]*)$ ]] || continue
+        p="${{dir:+$dir/}}${{BASH_REMATCH[1]}}"
+        owners["${{p#./}}"]="${{BASH_REMATCH[2]}}:${{BASH_REMATCH[3]}}"
+    done < "$f"
+done < <(find . -type f -name "$pf" -print0)
+n=0
+while IFS= read -r -d '' p; do
+    p="${{p#./}}"; d="$dst/$p"
+    if [ -d "$d" ]; then continue; fi
+    mkdir -p "$bk" || exit 1
+    mkdir -m "$(masked "$p")" "$d" || exit 1
+    if [ -n "${{owners[$p]}}" ]; then chown "${{owners[$p]}}" "$d" || exit 1; fi
+    echo "created $p" >> "$bk/manifest"
+    echo "changed $d/"
+    n=$((n + 1))
+done < <(find . -mindepth 1 -type d -print0)
+while IFS= read -r -d '' p; do
+    p="${{p#./}}"; d="$dst/$p"
+    if [ "${{p##*/}}" = "$pf" ]; then continue; fi
+    if [ -L "$p" ]; then
+        if [ -L "$d" ] && [ "$(readlink "$p")" = "$(readlink "$d")" ]; then continue; fi
+    else
+        m=$(masked "$p")
+        if [ -f "$d" ] && [ ! -L "$d" ] && cmp -s "$p" "$d" && \
+                [ "$(stat -c %a "$d")" = "$m" ] && owned "$d" "${{owners[$p]:-$me}}"; then
+            continue
+        fi
+    fi
+    mkdir -p "$bk/files" || exit 1
+    if [ -e "$d" ] || [ -L "$d" ]; then
+        mkdir -p "$bk/files/$(dirname "$p")" && cp -d --preserve=mode,ownership "$d" "$bk/files/$p" || exit 1
+        echo "replaced $p" >> "$bk/manifest"
+    else
+        echo "added $p" >> "$bk/manifest"
+    fi
+    rm -f -- "$d.deployer-new" || exit 1
+    if [ -L "$p" ]; then
+        cp -d "$p" "$d.deployer-new" || exit 1
+    else
+        cp "$p" "$d.deployer-new" || exit 1
+        if [ -n "${{owners[$p]}}" ]; then chown "${{owners[$p]}}" "$d.deployer-new" || exit 1; fi
+        chmod "$m" "$d.deployer-new" || exit 1
+    fi
+    mv -fT "$d.deployer-new" "$d" || exit 1
+    echo "changed $d"
+    n=$((n + 1))
+done < <(find . \\( -type f -o -type l \\) -print0)
+if [ $n -eq 0 ]; then
+    echo "No files changed in $dst."
+else
+    echo "$n path(s) changed in $dst.  Backup: $bk"
+    ls -1d "$(dirname "$bk")"/*/ | sort | head -n -{keep} | xargs -r rm -rf --
+fi
+'''.format(
+        src=shellquote(src_etc),
+        dst=shellquote(dst_dir),
+        bk=shellquote(backup_dir),
+        pf=shellquote(perm_file),
+        keep=KEEP_ETC_BACKUPS)
+    return "bash -c {}".format(shellquote(inner_cmd))
+
+def restore_etc_command(backup=None, dst_dir='/etc', backup_root=ETC_BACKUP_ROOT):
+    """
+    Return the command that undoes the `/etc` sync recorded in the backup
+    folder named `backup` (the newest one by default).  Replaced files are
+    restored, added files are removed, and created folders are removed if
+    they are empty.
+    """
+    dst_dir = strip_trailing_slash(dst_dir)
+    if backup is None:
+        select = 'bk="$root/$(ls -1 "$root" | sort | tail -n 1)"'
+    else:
+        select = 'bk="$root"/{}'.format(shellquote(backup))
+    inner_cmd = '''
+root={root}; dst={dst}
+{select}
+[ -f "$bk/manifest" ] || {{ echo "No /etc backup to restore." >&2; exit 1; }}
+created=()
+while read -r action p; do
+    d="$dst/$p"
+    if [ "$action" = "created" ]; then
+        created=("$d" "${{created[@]}}")
+        continue
+    elif [ "$action" = "replaced" ]; then
+        cp -d --preserve=mode,ownership "$bk/files/$p" "$d.deployer-new" && mv -fT "$d.deployer-new" "$d" || exit 1
+    else
+        rm -f -- "$d" || exit 1
+    fi
+    echo "restored $d"
+done < "$bk/manifest"
+for d in "${{created[@]}}"; do
+    rmdir -- "$d" 2>/dev/null && echo "removed $d/"
+done
+true
+'''.format(
+        root=shellquote(backup_root),
+        dst=shellquote(dst_dir),
+        select=select)
+    return "bash -c {}".format(shellquote(inner_cmd))
 
 def strip_trailing_slash(pth):
     """
     Remove the trailing slash from a path.
     """
     return pth.rstrip("/")
-
@@ -0,0 +1,127 @@
+
+import fnmatch
+import uuid
+import attr
+from invoke import Exit
+from deployer.shellfuncs import shellquote
+
+@attr.s
+class ReloadHook(object):
+    """
+    Commands to run when a deployment changes any path that matches one of
+    `paths`.  `reload` only runs if `validate` succeeds.
+    """
+    name = attr.ib()
+    paths = attr.ib(default=attr.Factory(list))
+    validate = attr.ib(default=None)
+    reload = attr.ib(default=None)
+
+    def matches(self, changed_paths):
+        """
+        Return the changed paths that trigger this hook.
+        """
+        return [
+            path for path in changed_paths
+            if any(fnmatch.fnmatchcase(path, pattern) for pattern in self.paths)]
+
+def parse_reload_hooks(settings):
+    """
+    Return a list of `ReloadHook` from the `reload-hooks` section of a
+    role, in the order they are listed.
+    """
+    if settings is None:
+        return []
+    hooks = []
+    for name, hook in settings.items():
+        paths = hook.get('paths', [])
+        if isinstance(paths, str):
+            paths = [paths]
+        if len(paths) == 0:
+            raise Exit("Reload hook '{}' has no `paths`.".format(name))
+        if hook.get('reload', None) is None:
+            raise Exit("Reload hook '{}' has no `reload` command.".format(name))
+        hooks.append(ReloadHook(name, list(paths), hook.get('validate', None), hook['reload']))
+    return hooks
+
+def new_changes_file():
+    """
+    Return the path of a new remote file to collect changed paths in.
+    """
+    return "/tmp/deployer-changes-{}".format(uuid.uuid4().hex)
+
+def record_tree_changes_command(new_dir, old_dir, changes_file, exclude_etc=False):
+    """
+    Return the command that appends the paths (relative to the folders)
+    that differ between `new_dir` and `old_dir` to `changes_file`.  Every
+    file in `new_dir` counts as changed if `old_dir` doesn't exist.
+    """
+    prune = ""
+    if exclude_etc:
+        prune = "-path ./etc -prune -o "
+    inner_cmd = (
+        "new={new}; old={old}; changes={changes}; touch \"$changes\" && "
+        "( cd \"$new\" && find . {prune}\\( -type f -o -type l \\) -print | while IFS= read -r p; do "
+        "if [ -L \"$p\" ]; then [ \"$(readlink \"$p\")\" = \"$(readlink \"$old/$p\" 2>/dev/null)\" ] && continue; "
+        "else [ -f \"$old/$p\" ] && cmp -s \"$p\" \"$old/$p\" && continue; fi; "
+        "echo \"${{p#./}}\"; done ) >> \"$changes\" && "
+        "if [ -d \"$old\" ]; then ( cd \"$old\" && find . {prune}\\( -type f -o -type l \\) -print | while IFS= read -r p; do "
+        "[ -e \"$new/$p\" ] || [ -L \"$new/$p\" ] || echo \"${{p#./}}\"; done ) >> \"$changes\"; fi"
+    ).format(
+        new=shellquote(new_dir),
+        old=shellquote(old_dir),
+        changes=shellquote(changes_file),
+        prune=prune)
+    return "bash -c {}".format(shellquote(inner_cmd))
+
+def record_etc_changes_command(backup_dir, changes_file):
+    """
+    Return the command that appends the paths an `/etc` sync changed, as
+    `etc/...` paths, to `changes_file`.
+    """
+    inner_cmd = (
+        "touch {1} && if [ -f {0}/manifest ]; then "
+        "sed -E 's#^(added|replaced) #etc/#' {0}/manifest >> {1}; fi"
+    ).format(shellquote(backup_dir), shellquote(changes_file))
+    return "bash -c {}".format(shellquote(inner_cmd))
+
+def plan_changes_and_hooks(plan, hooks, changes_file, etc_backup_dir=None):
+    """
+    Add the steps that run once the files have landed to `plan`: collect
+    the `/etc` changes recorded in `etc_backup_dir` (if any) and run the
+    triggered hooks.  Does nothing if `changes_file` is None.
+    """
+    if changes_file is None:
+        return
+    if etc_backup_dir is not None:
+        plan.sudo("record etc changes", record_etc_changes_command(etc_backup_dir, changes_file))
+    plan_reload_hooks(plan, hooks, changes_file)
+
+def plan_reload_hooks(plan, hooks, changes_file):
+    """
+    Add a step to `plan` that reads the changed paths collected in
+    `changes_file` and runs each triggered hook once.
+    """
+
+    def run_hooks(conn):
+        result = conn.sudo("bash -c {}".format(shellquote(
+            "cat {0} 2>/dev/null; rm -f {0}".format(shellquote(changes_file)))), hide=True)
+        changed_paths = sorted(set(line for line in result.stdout.splitlines() if line != ""))
+        run_triggered_hooks(conn, hooks, changed_paths)
+
+    plan.call("reload hooks", run_hooks)
+
+def run_triggered_hooks(conn, hooks, changed_paths):
+    """
+    Run the validate and reload commands of each hook that one of
+    `changed_paths` triggers.  A failed validation stops the deployment
+    before the service is reloaded.
+    """
+    for hook in hooks:
+        triggers = hook.matches(changed_paths)
+        if len(triggers) == 0:
+            continue
+        print("Reload hook '{}' triggered by {} changed path(s), e.g. {}.".format(
+            hook.name, len(triggers), triggers[0]))
+        if hook.validate is not None:
+            conn.sudo(hook.validate)
+        conn.sudo(hook.reload)
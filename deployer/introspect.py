@@ -1,10 +1,37 @@
 
 
-def list_hosts(cfg):
+def list_hosts(cfg, hosts=None):
     """
-    List all the hosts for the current stage.
+    List all the hosts for the current stage, or only `hosts`.  Each
+    host's labels and, if it has more than one role, its roles are shown
+    with the effective (highest priority) role first.
     """
+    inventory = cfg.get_inventory()
+    if hosts is None:
+        hosts = inventory.hosts_for(cfg.stage)
     print("== Hosts for stage `{}` ==".format(cfg.stage))
-    for host in cfg.settings['roles'][cfg.stage]['target-hosts']:
-        print(host)
+    for host in hosts:
+        details = []
+        labels = sorted(inventory.labels.get(host, set()))
+        if len(labels) > 0:
+            details.append("labels: {}".format(', '.join(labels)))
+        roles = inventory.roles_of(host)
+        if len(roles) > 1:
+            details.append("roles: {}".format(', '.join(
+                "{} ({})".format(role, inventory.roles[role].priority) for role in roles)))
+        if len(details) == 0:
+            print(host)
+        else:
+            print("{}  [{}]".format(host, '; '.join(details)))
 
+def list_roles(cfg, host):
+    """
+    List the roles of `host`, the effective (highest priority) role first.
+    """
+    inventory = cfg.get_inventory()
+    roles = inventory.roles_of(host)
+    print("== Roles for host `{}` ==".format(host))
+    if len(roles) == 0:
+        print("(none)")
+    for role in roles:
+        print("{} (priority {})".format(role, inventory.roles[role].priority))
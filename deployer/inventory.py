@@ -0,0 +1,262 @@
+
+import fnmatch
+import hashlib
+import os
+import pickle
+import tempfile
+import attr
+import yaml
+from invoke import Exit
+from deployer.terminal import warn
+
+DEFAULT_CACHE_DIR = '~/.cache/config-deployer/inventory'
+# Bump when the cached `Inventory` layout changes.
+CACHE_FORMAT = 1
+
+@attr.s
+class Role(object):
+    """
+    A role (aka stage) and the hosts it targets, in the order listed.
+    """
+    name = attr.ib()
+    priority = attr.ib(default=0)
+    hosts = attr.ib(default=attr.Factory(list))
+
+@attr.s
+class Inventory(object):
+    """
+    All the roles of a deployment config, indexed by host.
+
+    `host_roles` maps each host to the names of its roles, highest
+    priority first.  Roles with the same priority keep the order they are
+    listed in.  `labels` maps each host to its set of labels.
+    """
+    roles = attr.ib(default=attr.Factory(dict))
+    host_roles = attr.ib(default=attr.Factory(dict))
+    labels = attr.ib(default=attr.Factory(dict))
+
+    def hosts_for(self, role):
+        """
+        Return the hosts of `role`.
+        """
+        return list(self.roles[role].hosts)
+
+    def roles_of(self, host):
+        """
+        Return the roles of `host`, highest priority first.
+        """
+        return list(self.host_roles.get(host, []))
+
+    def effective_role(self, host):
+        """
+        Return the highest priority role of `host` or None.
+        """
+        roles = self.host_roles.get(host, [])
+        if len(roles) == 0:
+            return None
+        return roles[0]
+
+    def select(self, role, patterns=(), labels=(), excluded=()):
+        """
+        Return the hosts of `role` that match any of the glob `patterns`
+        (all hosts if there are none), have all of `labels`, and don't
+        match any of the glob patterns in `excluded`.
+        """
+        labels = set(labels)
+        selected = []
+        for host in self.roles[role].hosts:
+            if len(patterns) > 0 and not matches_any(host, patterns):
+                continue
+            if not labels.issubset(self.labels.get(host, set())):
+                continue
+            if matches_any(host, excluded):
+                continue
+            selected.append(host)
+        return selected
+
+    def shadowed(self, role, hosts):
+        """
+        Return (host, role name) pairs for the `hosts` that belong to a
+        role with a higher priority than `role`.
+        """
+        priority = self.roles[role].priority
+        pairs = []
+        for host in hosts:
+            effective = self.effective_role(host)
+            if effective is not None and self.roles[effective].priority > priority:
+                pairs.append((host, effective))
+        return pairs
+
+def matches_any(host, patterns):
+    return any(fnmatch.fnmatchcase(host, pattern) for pattern in patterns)
+
+def parse_host_entry(role_name, entry):
+    """
+    Return the (host, labels) of an entry in `target-hosts`.  An entry is
+    either a host name or a mapping with `host` and optional `labels`.
+    """
+    if isinstance(entry, str):
+        return entry, set()
+    if isinstance(entry, dict) and isinstance(entry.get('host', None), str):
+        labels = entry.get('labels', [])
+        if isinstance(labels, str):
+            labels = [labels]
+        return entry['host'], set(str(label) for label in labels)
+    raise Exit("Role `{}` has an invalid `target-hosts` entry: {!r}".format(role_name, entry))
+
+def parse_inventory(settings):
+    """
+    Validate the roles in the deployment config `settings` and return
+    their `Inventory`.  Labels listed under a role's `labels` apply to all
+    of its hosts.
+    """
+    roles_settings = settings.get('roles', None)
+    if not isinstance(roles_settings, dict):
+        raise Exit("The deployment config has no `roles` mapping.")
+    inventory = Inventory()
+    order = {}
+    for role_name, role_settings in roles_settings.items():
+        if role_settings is None:
+            role_settings = {}
+        priority = role_settings.get('priority', 0)
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            raise Exit("Role `{}` has a priority that is not an integer: {!r}".format(role_name, priority))
+        entries = role_settings.get('target-hosts', [])
+        if entries is None:
+            entries = []
+        if not isinstance(entries, list):
+            raise Exit("The `target-hosts` of role `{}` is not a list.".format(role_name))
+        role_labels = role_settings.get('labels', [])
+        if isinstance(role_labels, str):
+            role_labels = [role_labels]
+        role = Role(role_name, priority)
+        for entry in entries:
+            host, labels = parse_host_entry(role_name, entry)
+            if host in role.hosts:
+                continue
+            role.hosts.append(host)
+            host_labels = inventory.labels.setdefault(host, set())
+            host_labels.update(labels)
+            host_labels.update(str(label) for label in role_labels)
+            inventory.host_roles.setdefault(host, []).append(role_name)
+        order[role_name] = len(order)
+        inventory.roles[role_name] = role
+    for host, role_names in inventory.host_roles.items():
+        role_names.sort(key=lambda name: (-inventory.roles[name].priority, order[name]))
+    return inventory
+
+class InventoryCache(object):
+    """
+    A local store of parsed and validated deployment configs.
+
+    An entry is reused without reading the config file if its size and
+    modification time are unchanged, or after reading it if its SHA-256
+    digest is unchanged.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        os.chmod(path, 0o700)
+
+    def entry_path(self, config_path):
+        key = hashlib.sha256(os.path.abspath(config_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, "{}.pickle".format(key))
+
+    def lookup(self, config_path, st, read_data):
+        """
+        Return the cached (settings, inventory) of `config_path` or None.
+        `st` is the result of `os.stat()` and `read_data()` returns the
+        contents of the file.
+        """
+        entry = self.read_entry(config_path)
+        if entry is None:
+            return None
+        if (entry['mtime_ns'], entry['size']) == (st.st_mtime_ns, st.st_size):
+            return entry['settings'], entry['inventory']
+        if entry['digest'] != hashlib.sha256(read_data()).hexdigest():
+            return None
+        entry['mtime_ns'] = st.st_mtime_ns
+        entry['size'] = st.st_size
+        self.write_entry(config_path, entry)
+        return entry['settings'], entry['inventory']
+
+    def store(self, config_path, st, data, settings, inventory):
+        entry = {
+            'format': CACHE_FORMAT,
+            'mtime_ns': st.st_mtime_ns,
+            'size': st.st_size,
+            'digest': hashlib.sha256(data).hexdigest(),
+            'settings': settings,
+            'inventory': inventory,
+        }
+        self.write_entry(config_path, entry)
+
+    def read_entry(self, config_path):
+        try:
+            with open(self.entry_path(config_path), "rb") as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as ex:
+            warn("Ignoring unreadable inventory cache entry for '{}': {}".format(config_path, ex))
+            return None
+        if not isinstance(entry, dict) or entry.get('format', None) != CACHE_FORMAT:
+            return None
+        return entry
+
+    def write_entry(self, config_path, entry):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.entry_path(config_path))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+def open_inventory_cache(settings):
+    """
+    Return the `InventoryCache` described by the user settings, or None if
+    caching is disabled.
+    """
+    if not settings.get('enabled', True):
+        return None
+    path = os.path.expanduser(settings.get('path', DEFAULT_CACHE_DIR))
+    try:
+        return InventoryCache(path)
+    except OSError as ex:
+        warn("Inventory cache '{}' is unavailable: {}".format(path, ex))
+        return None
+
+def load_deployment_config(config_path, cache_settings=None):
+    """
+    Return the settings and `Inventory` of the deployment config at
+    `config_path`, from the inventory cache if the file hasn't changed.
+    """
+    if cache_settings is None:
+        cache_settings = {}
+    cache = open_inventory_cache(cache_settings)
+    st = os.stat(config_path)
+    contents = []
+
+    def read_data():
+        if len(contents) == 0:
+            with open(config_path, "rb") as f:
+                contents.append(f.read())
+        return contents[0]
+
+    if cache is not None:
+        cached = cache.lookup(config_path, st, read_data)
+        if cached is not None:
+            return cached
+    data = read_data()
+    settings = yaml.safe_load(data.decode('utf-8'))
+    if not isinstance(settings, dict):
+        raise Exit("The deployment config '{}' is not a mapping.".format(config_path))
+    inventory = parse_inventory(settings)
+    if cache is not None:
+        try:
+            cache.store(config_path, st, data, settings, inventory)
+        except OSError as ex:
+            warn("Could not update the inventory cache: {}".format(ex))
+    return settings, inventory
@@ -0,0 +1,201 @@
+
+import hashlib
+import os
+import re
+import tarfile
+import attr
+from deployer.shellfuncs import chunked, shellquote
+from deployer.sshmux import SUDO_PROMPT
+
+FOLDER = 'dir'
+LINK_PREFIX = 'link:'
+PERM_FILE = '__perms__'
+
+_digest_line = re.compile(r'^([0-9a-f]{64})  \./(.+)$')
+_attr_line = re.compile(r'^([dfl]) ([0-7]+) (\S+) (\S+) ([0-9]+) ([0-9]+) \./(.+)$')
+_link_line = re.compile(r'^L \./(.+?)\x00(.*)$')
+
+@attr.s
+class Entry(object):
+    """
+    A manifest entry.  `digest` is the SHA-256 of a file's contents,
+    `FOLDER` for a folder, or `LINK_PREFIX` followed by the target of a
+    symbolic link.  Remote entries also have the numeric `uid` and `gid`,
+    so owners given as numbers can be compared.
+    """
+    digest = attr.ib(default=None)
+    mode = attr.ib(default=None)
+    user = attr.ib(default=None)
+    group = attr.ib(default=None)
+    uid = attr.ib(default=None)
+    gid = attr.ib(default=None)
+
+    @property
+    def is_folder(self):
+        return self.digest == FOLDER
+
+    @property
+    def is_link(self):
+        return self.digest is not None and self.digest.startswith(LINK_PREFIX)
+
+def same_owner(owner, name, number):
+    """
+    Return True if `owner`, a name or a numeric id, matches the `name` or
+    `number` reported by the remote host.
+    """
+    if owner.isdigit():
+        return number is not None and int(owner) == int(number)
+    return owner == name
+
+def same_attrs(entry, other):
+    """
+    Return True if the local `entry` and the remote `other` have the same
+    mode, owner, and group.
+    """
+    return (entry.mode == other.mode
+            and same_owner(entry.user, other.user, other.uid)
+            and same_owner(entry.group, other.group, other.gid))
+
+def link_digest(target):
+    return "{}{}".format(LINK_PREFIX, target)
+
+def member_path(info):
+    """
+    Return the path of an archive member without any leading `./`.
+    """
+    path = info.name
+    while path.startswith("./"):
+        path = path[2:]
+    return path
+
+def archive_manifest(archive_path):
+    """
+    Return a mapping of path to `Entry` for each file, folder, and
+    symbolic link in the local archive at `archive_path`.
+    """
+    manifest = {}
+    with tarfile.open(archive_path, "r:gz") as tar:
+        for info in tar:
+            path = member_path(info)
+            if path == "":
+                continue
+            if info.isdir():
+                digest = FOLDER
+            elif info.isfile():
+                sha = hashlib.sha256()
+                f = tar.extractfile(info)
+                for chunk in iter(lambda: f.read(65536), b''):
+                    sha.update(chunk)
+                digest = sha.hexdigest()
+            elif info.issym():
+                digest = link_digest(info.linkname)
+            else:
+                continue
+            manifest[path] = Entry(digest, info.mode & 0o7777, info.uname or str(info.uid), info.gname or str(info.gid))
+    return manifest
+
+def parse_entries(output, entries):
+    """
+    Add the entries listed in the `output` of a remote `find` and
+    `sha256sum` to `entries` and return it.  A sudo password prompt mixed
+    into the output is removed first.
+    """
+    for line in output.replace(SUDO_PROMPT, '').splitlines():
+        match = _link_line.match(line)
+        if match is not None:
+            entries.setdefault(match.group(1), Entry()).digest = link_digest(match.group(2))
+            continue
+        match = _attr_line.match(line)
+        if match is not None:
+            kind, mode, user, group, uid, gid, path = match.groups()
+            entry = entries.setdefault(path, Entry())
+            entry.mode = int(mode, 8)
+            entry.user = user
+            entry.group = group
+            entry.uid = uid
+            entry.gid = gid
+            if kind == 'd':
+                entry.digest = FOLDER
+            continue
+        match = _digest_line.match(line)
+        if match is not None:
+            entries.setdefault(match.group(2), Entry()).digest = match.group(1)
+    return entries
+
+def remote_manifest(conn, folder):
+    """
+    Return a mapping of path to `Entry` for each file, folder, and
+    symbolic link under `folder` on the remote host.
+    Returns an empty mapping if `folder` does not exist.
+    """
+    inner_cmd = (
+        "if [ -d {0} ]; then cd {0} && "
+        "find . -mindepth 1 \\( -type d -o -type f -o -type l \\) -printf '%y %m %u %g %U %G %p\\n' && "
+        "find . -type l -printf 'L %p\\0%l\\n' && "
+        "find . -type f -exec sha256sum {{}} + ; fi"
+    ).format(shellquote(folder))
+    result = conn.sudo("bash -c {}".format(shellquote(inner_cmd)), hide=True)
+    return parse_entries(result.stdout, {})
+
+def remote_entries(conn, folder, paths):
+    """
+    Return a mapping of path to `Entry` for each of `paths` (relative to
+    `folder`) that is a regular file or symbolic link on the remote host.
+    Symbolic links are not followed and only have a digest, made from the
+    target as in the manifests.
+    """
+    entries = {}
+    for chunk in chunked(paths):
+        inner_cmd = (
+            "cd {} 2>/dev/null || exit 0; for p in {}; do "
+            "if [ -L \"$p\" ]; then printf 'L %s\\0%s\\n' \"$p\" \"$(readlink \"$p\")\"; "
+            "elif [ -f \"$p\" ]; then find \"$p\" -maxdepth 0 -printf '%y %m %u %g %U %G %p\\n' && sha256sum -- \"$p\"; fi; "
+            "done; true"
+        ).format(
+            shellquote(folder),
+            ' '.join(shellquote("./" + p) for p in chunk))
+        result = conn.sudo("bash -c {}".format(shellquote(inner_cmd)), hide=True)
+        parse_entries(result.stdout, entries)
+    return entries
+
+def diff_manifests(local, remote, compare_attrs=False):
+    """
+    Compare a local and a remote manifest.  If `compare_attrs` is True,
+    entries with a different mode, owner, or group also count as changed.
+    Symbolic links are compared by target only.  Owners and groups given
+    as numbers in the local manifest are compared with the remote ids.
+
+    :returns: A tuple of (changed, deleted) path lists.  `changed` has the
+        paths that are new or differ locally.  `deleted` has the paths
+        that only exist remotely.
+    """
+    changed = []
+    for path, entry in sorted(local.items()):
+        other = remote.get(path, None)
+        if other is None or other.digest != entry.digest:
+            changed.append(path)
+        elif compare_attrs and not entry.is_link and not same_attrs(entry, other):
+            changed.append(path)
+    deleted = sorted(path for path in remote if not path in local)
+    return changed, deleted
+
+def split_local_manifest(local, move_etc=True, perm_file=PERM_FILE):
+    """
+    Split an archive manifest into the entries that end up in the config
+    folder and the files that are copied into `/etc`.  The `/etc` files
+    are keyed by their path relative to `/etc`.  Permission files never
+    end up in the config folder, so they are left out.
+    """
+    config_entries = {}
+    etc_entries = {}
+    for path, entry in local.items():
+        if os.path.basename(path) == perm_file and not entry.is_folder:
+            continue
+        if move_etc and path == "etc":
+            continue
+        if move_etc and path.startswith("etc/"):
+            if not entry.is_folder:
+                etc_entries[path[len("etc/"):]] = entry
+            continue
+        config_entries[path] = entry
+    return config_entries, etc_entries
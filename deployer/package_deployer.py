@@ -1,24 +1,72 @@
-
+import os
+import tarfile
+import tempfile
+from invoke import Exit
 from deployer.shellfuncs import shellquote
 
 def install_rpm(conn, name):
     """
     Deploy RPM path or package name.
     """
-    conn.sudo("yum install -y -q -e 0 {}".format(name))
+    install_rpms(conn, [name])
+
+def install_rpms(conn, names):
+    """
+    Install RPM paths or package names in a single yum transaction.
+    """
+    conn.sudo("yum install -y -q -e 0 {}".format(' '.join(names)))
 
 def install_local_rpm(conn, path):
     """
     Copy a local package to the target host and then install it.
     """
-    remote_path = conn.run("mktemp").stdout.rstrip()
-    conn.put(path, remote_path)
-    install_rpm(conn, remote_path)
-    conn.run("rm -f {}".format(shellquote(remote_path)))
+    package_archive = bundle_local_rpms([path])
+    try:
+        install_local_rpms(conn, package_archive)
+    finally:
+        os.unlink(package_archive)
+
+def bundle_local_rpms(paths):
+    """
+    Bundle local packages into a single tar file so each host only needs
+    one upload.  Return the path of the bundle.
+    """
+    names = set()
+    for path in paths:
+        if not os.path.isfile(path):
+            raise Exit("Package '{}' does not exist.".format(path))
+        name = os.path.basename(path)
+        if name in names:
+            raise Exit("More than one package is named '{}'.".format(name))
+        names.add(name)
+    fd, package_archive = tempfile.mkstemp(suffix=".tar")
+    os.close(fd)
+    with tarfile.open(package_archive, "w") as tar:
+        for path in paths:
+            tar.add(path, arcname=os.path.basename(path))
+    return package_archive
+
+def install_local_rpms(conn, package_archive):
+    """
+    Copy a bundle of local packages made by `bundle_local_rpms()` to the
+    target host and install all of them in a single yum transaction.
+    """
+    remote_dir = conn.run("mktemp -d").stdout.rstrip()
+    remote_archive = "{}/packages.tar".format(remote_dir)
+    conn.put(package_archive, remote_archive)
+    inner_cmd = (
+        "cd {0} && tar xf packages.tar && rm -f packages.tar && "
+        "yum install -y -q -e 0 ./*.rpm; rc=$?; rm -rf {0}; exit $rc").format(shellquote(remote_dir))
+    conn.sudo("bash -c {}".format(shellquote(inner_cmd)))
 
 def remove_rpm(conn, name):
     """
     Uninstall a package.
     """
-    conn.sudo("yum remove -y -q -e 0 {}".format(name))
+    remove_rpms(conn, [name])
 
+def remove_rpms(conn, names):
+    """
+    Uninstall packages in a single yum transaction.
+    """
+    conn.sudo("yum remove -y -q -e 0 {}".format(' '.join(names)))
@@ -1,37 +1,19 @@
 
 import os
+import re
 import sys
-from deployer.shellfuncs import shellquote
+import tarfile
+from invoke import Exit
+from deployer.manifest import member_path
+from deployer.shellfuncs import chunked, shellquote
 from deployer.terminal import warn
 
-def apply_permissions(conn, config, folder, perm_file='__perms__'):
+def parse_permissions(text, perm_file):
     """
-    Descend recursively into each folder starting with `folder`.
-    Look for a file with a name that matches the value of `perm_file`.
-    Parse the permission file and apply the permissions to files in
-    the folder as applicable.
-    """
-    result = conn.sudo("find {} -name {} -print".format(shellquote(folder), shellquote(perm_file)))
-    lines = result.stdout.splitlines()
-    for line in lines:
-        if line == '[sudo] password: ':
-            continue
-        if line.strip() == "":
-            continue
-        dirpth = os.path.dirname(line)
-        for fname, user, group, perms in parse_fields(conn, line):
-            pth = os.path.join(dirpth, fname)
-            conn.sudo("chown {}:{} {}".format(shellquote(user), shellquote(group), shellquote(pth)))
-            conn.sudo("chmod {} {}".format(shellquote(perms), shellquote(pth)))
-        conn.sudo("rm -f {}".format(line))
-
-def parse_fields(conn, perm_file):
-    """
-    Parse the fields of a permissions file.
+    Parse the text of the permissions file `perm_file`.
     Yield each permission.
     """
-    result = conn.sudo("cat {}".format(shellquote(perm_file)))
-    lines = result.stdout.splitlines()
+    lines = text.splitlines()
     for line in lines:
         if line.strip() == "":
             continue
@@ -47,3 +29,150 @@ def parse_fields(conn, perm_file):
         perms = fields[3]
         yield (fname, user, group, perms)
 
+def archive_permissions(archive_path, perm_file='__perms__'):
+    """
+    Read the permission files in the local archive at `archive_path`.
+
+    :returns: A tuple of (perm_files, permissions).  `perm_files` lists the
+        archive paths of the permission files.  `permissions` maps each
+        archive path to a (user, group, perms) tuple.  If a path is listed
+        more than once, the last entry wins.
+    """
+    perm_files = []
+    permissions = {}
+    with tarfile.open(archive_path, "r:gz") as tar:
+        for info in tar:
+            path = member_path(info)
+            if not info.isfile() or os.path.basename(path) != perm_file:
+                continue
+            perm_files.append(path)
+            text = tar.extractfile(info).read().decode('utf-8')
+            dirpth = os.path.dirname(path)
+            for fname, user, group, perms in parse_permissions(text, path):
+                permissions[os.path.normpath(os.path.join(dirpth, fname))] = (user, group, perms)
+    return tuple(perm_files), permissions
+
+def plan_permissions(plan, folder, archive_path, perm_file='__perms__', keep_etc=False):
+    """
+    Add steps to `plan` that apply the permission files from the local
+    archive to the staged configuration in `folder` and then remove the
+    permission files.  Paths that share an owner or a mode are changed
+    with a single `chown` or `chmod`.  If `keep_etc` is True, the
+    permission files in the `etc` folder are kept for the `/etc` sync.
+    """
+    perm_files, permissions = archive_permissions(archive_path, perm_file)
+    owners = {}
+    modes = {}
+    for path in sorted(permissions.keys()):
+        user, group, perms = permissions[path]
+        pth = shellquote(os.path.join(folder, path))
+        owners.setdefault((user, group), []).append(pth)
+        modes.setdefault(perms, []).append(pth)
+    for (user, group), paths in sorted(owners.items()):
+        for chunk in chunked(paths):
+            plan.sudo("permission files: chown {}:{}".format(user, group), "chown {}:{} {}".format(
+                shellquote(user),
+                shellquote(group),
+                ' '.join(chunk)))
+    for perms, paths in sorted(modes.items()):
+        for chunk in chunked(paths):
+            plan.sudo("permission files: chmod {}".format(perms), "chmod {} {}".format(
+                shellquote(perms),
+                ' '.join(chunk)))
+    if keep_etc:
+        perm_files = [path for path in perm_files if not path.startswith("etc/")]
+    plan_remove_perm_files(plan, folder, perm_files)
+
+def plan_remove_perm_files(plan, folder, perm_files):
+    """
+    Add steps to `plan` that remove the permission files `perm_files`
+    (archive paths) from the staged configuration in `folder`.
+    """
+    paths = [shellquote(os.path.join(folder, path)) for path in perm_files]
+    for chunk in chunked(paths):
+        plan.sudo("remove permission files", "rm -f {}".format(' '.join(chunk)))
+
+def split_ad_hoc_perms(config):
+    """
+    Split the ad hoc permissions into those for paths inside the remote
+    config folder and all others.
+
+    :returns: A tuple of (inside, outside) mappings of path to permissions.
+        Paths in `inside` are relative to the config folder.
+    """
+    remote_config_folder = config.get_remote_config_folder()
+    inside = {}
+    outside = {}
+    for path, perm in config.get_ad_hoc_perms().items():
+        if remote_config_folder is not None:
+            rel = os.path.relpath(path, remote_config_folder)
+            if os.path.isabs(path) and rel != '.' and not rel.startswith('..'):
+                inside[rel] = perm
+                continue
+        outside[path] = perm
+    return inside, outside
+
+_WHO_BITS = {
+    'u': 0o4700,
+    'g': 0o2070,
+    'o': 0o1007,
+}
+# The file mode creation mask `chmod` runs with under `sudo`.
+DEFAULT_UMASK = 0o022
+_octal_mode = re.compile(r'^[0-7]{1,4}$')
+_symbolic_clause = re.compile(r'^([ugoa]*)((?:[-+=][rwxXstugo]*)+)$')
+_symbolic_action = re.compile(r'([-+=])([rwxXstugo]*)')
+
+def apply_mode(spec, mode, is_dir=False, umask=DEFAULT_UMASK):
+    """
+    Return the permission bits that result from applying the `chmod` mode
+    `spec` (octal or symbolic, e.g. `u=rx,go=`) to a file or folder with
+    the permission bits `mode`.  As with `chmod`, clauses without a
+    `who` don't set or clear the bits in `umask`.
+    """
+    spec = spec.strip()
+    if _octal_mode.match(spec):
+        return int(spec, 8)
+    for clause in spec.split(','):
+        match = _symbolic_clause.match(clause)
+        if match is None:
+            raise Exit("Invalid permissions '{}'.".format(spec))
+        who = match.group(1)
+        masked = 0
+        if who == '':
+            masked = umask
+        if who == '' or 'a' in who:
+            who = 'ugo'
+        mask = 0
+        for w in who:
+            mask |= _WHO_BITS[w]
+        for op, perms in _symbolic_action.findall(match.group(2)):
+            bits = 0
+            for p in perms:
+                if p == 'r':
+                    bits |= 0o444
+                elif p == 'w':
+                    bits |= 0o222
+                elif p == 'x':
+                    bits |= 0o111
+                elif p == 'X':
+                    if is_dir or mode & 0o111:
+                        bits |= 0o111
+                elif p == 's':
+                    bits |= 0o6000
+                elif p == 't':
+                    bits |= 0o1000
+                else:
+                    shift = {'u': 6, 'g': 3, 'o': 0}[p]
+                    bits |= ((mode >> shift) & 0o7) * 0o111
+            bits &= mask & ~masked
+            if op == '+':
+                mode |= bits
+            elif op == '-':
+                mode &= ~bits
+            else:
+                cleared = mask
+                if is_dir:
+                    cleared &= ~0o6000
+                mode = (mode & ~cleared) | bits
+    return mode
@@ -0,0 +1,251 @@
+
+import contextlib
+import io
+import json
+import os
+import threading
+import time
+import attr
+
+LOCAL_HOST = 'local'
+MAX_LABEL = 80
+
+@attr.s
+class Span(object):
+    """
+    A timed step.  `kind` is `phase` for a named group of steps, or the
+    connection method (`run`, `sudo`, `put`) for a single command.
+    `exit_code` is None for steps that didn't run a command.
+    """
+    host = attr.ib()
+    name = attr.ib()
+    kind = attr.ib()
+    start = attr.ib()
+    end = attr.ib(default=None)
+    exit_code = attr.ib(default=None)
+    bytes_sent = attr.ib(default=0)
+    bytes_received = attr.ib(default=0)
+    thread = attr.ib(default=None)
+
+    @property
+    def elapsed(self):
+        return self.end - self.start
+
+class Recorder(object):
+    """
+    Collects the spans of all hosts.  Recording is off until `enable()`
+    is called.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.origin = time.time()
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        self.origin = time.time()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def phase(self, name, host=LOCAL_HOST):
+        """
+        Time the steps run inside the `with` block as phase `name`.
+        """
+        if not self.enabled:
+            yield
+            return
+        span = Span(host, name, 'phase', time.time(), thread=threading.get_ident())
+        try:
+            yield span
+        finally:
+            span.end = time.time()
+            self.add(span)
+
+RECORDER = Recorder()
+
+def phase(name, host=LOCAL_HOST):
+    return RECORDER.phase(name, host)
+
+def instrument(conn, host=None):
+    """
+    Return `conn` wrapped so its commands are recorded, or `conn` itself
+    if profiling is off.
+    """
+    if not RECORDER.enabled:
+        return conn
+    if host is None:
+        host = getattr(conn, 'host', LOCAL_HOST)
+    return TimedConnection(conn, host, RECORDER)
+
+def command_label(command):
+    label = ' '.join(str(command).split())
+    if len(label) > MAX_LABEL:
+        label = label[:MAX_LABEL - 3] + '...'
+    return label
+
+def output_size(result):
+    size = 0
+    for stream in (getattr(result, 'stdout', None), getattr(result, 'stderr', None)):
+        if stream:
+            size += len(stream.encode('utf-8'))
+    return size
+
+def local_size(local):
+    if isinstance(local, str):
+        try:
+            return os.path.getsize(local)
+        except OSError:
+            return 0
+    if isinstance(local, io.BytesIO):
+        return len(local.getvalue())
+    return 0
+
+class TimedConnection(object):
+    """
+    Wrap a connection (or the local invoker) and record a `Span` for each
+    `run`, `sudo`, and `put`.
+    """
+    def __init__(self, conn, host, recorder):
+        self._conn = conn
+        self._host = host
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def run(self, command, **kwargs):
+        return self._timed('run', command, len(command), self._conn.run, command, **kwargs)
+
+    def sudo(self, command, **kwargs):
+        return self._timed('sudo', command, len(command), self._conn.sudo, command, **kwargs)
+
+    def put(self, local, remote=None, **kwargs):
+        return self._timed('put', "put {}".format(remote), local_size(local), self._conn.put, local, remote, **kwargs)
+
+    def _timed(self, kind, label, bytes_sent, method, *args, **kwargs):
+        span = Span(
+            self._host,
+            command_label(label),
+            kind,
+            time.time(),
+            bytes_sent=bytes_sent,
+            thread=threading.get_ident())
+        try:
+            result = method(*args, **kwargs)
+            span.exit_code = getattr(result, 'return_code', 0)
+            span.bytes_received = output_size(result)
+            return result
+        except (Exception, SystemExit) as ex:
+            span.exit_code = getattr(getattr(ex, 'result', None), 'return_code', -1)
+            raise
+        finally:
+            span.end = time.time()
+            self._recorder.add(span)
+
+def chrome_trace(recorder):
+    """
+    Return the spans as a Chrome trace (`chrome://tracing`, Perfetto).
+    Each host is shown as a process.
+    """
+    hosts = []
+    for span in recorder.spans:
+        if not span.host in hosts:
+            hosts.append(span.host)
+    events = []
+    for pid, host in enumerate(hosts, 1):
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': host}})
+    for span in sorted(recorder.spans, key=lambda s: s.start):
+        events.append({
+            'name': span.name,
+            'cat': span.kind,
+            'ph': 'X',
+            'ts': int((span.start - recorder.origin) * 1e6),
+            'dur': int(span.elapsed * 1e6),
+            'pid': hosts.index(span.host) + 1,
+            'tid': span.thread or 0,
+            'args': {
+                'exit_code': span.exit_code,
+                'bytes_sent': span.bytes_sent,
+                'bytes_received': span.bytes_received,
+            },
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def write_chrome_trace(recorder, path):
+    with open(path, "w") as f:
+        json.dump(chrome_trace(recorder), f)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def openmetrics(recorder):
+    """
+    Return the spans aggregated per host and step in the OpenMetrics text
+    format (e.g. for the node exporter's textfile collector).
+    """
+    totals = {}
+    for span in recorder.spans:
+        key = (span.host, span.kind, span.name)
+        entry = totals.setdefault(key, [0.0, 0, 0, 0, 0])
+        entry[0] += span.elapsed
+        entry[1] += 1
+        entry[2] += span.bytes_sent
+        entry[3] += span.bytes_received
+        if span.exit_code not in (None, 0):
+            entry[4] += 1
+    families = [
+        ('deployer_step_seconds', 'Wall time spent in the step.', 0, 'seconds'),
+        ('deployer_step_calls', 'Times the step ran.', 1, None),
+        ('deployer_step_sent_bytes', 'Bytes sent by the step.', 2, 'bytes'),
+        ('deployer_step_received_bytes', 'Bytes of output received by the step.', 3, 'bytes'),
+        ('deployer_step_failures', 'Times the step exited with a non-zero status.', 4, None),
+    ]
+    lines = []
+    for family, help_text, n, unit in families:
+        lines.append("# TYPE {} counter".format(family))
+        if unit is not None:
+            lines.append("# UNIT {} {}".format(family, unit))
+        lines.append("# HELP {} {}".format(family, help_text))
+        for (host, kind, name), entry in sorted(totals.items()):
+            lines.append('{}_total{{host="{}",kind="{}",step="{}"}} {}'.format(
+                family,
+                escape_label(host),
+                escape_label(kind),
+                escape_label(name),
+                round(entry[n], 6)))
+    lines.append("# EOF")
+    return '\n'.join(lines) + '\n'
+
+def write_openmetrics(recorder, path):
+    with open(path, "w") as f:
+        f.write(openmetrics(recorder))
+
+def report(recorder, limit=10):
+    """
+    Return a summary of the slowest steps and hosts.
+    """
+    lines = []
+    lines.append("=== Profile ===")
+    lines.append("Slowest steps:")
+    spans = sorted(recorder.spans, key=lambda s: s.elapsed, reverse=True)
+    for span in spans[:limit]:
+        status = ""
+        if span.exit_code not in (None, 0):
+            status = "  [exit {}]".format(span.exit_code)
+        lines.append("  {:8.2f}s  {:<6} {}  {}{}".format(span.elapsed, span.kind, span.host, span.name, status))
+    host_totals = {}
+    for span in recorder.spans:
+        if span.kind == 'phase' or span.host == LOCAL_HOST:
+            continue
+        total = host_totals.setdefault(span.host, [0.0, 0, 0])
+        total[0] += span.elapsed
+        total[1] += span.bytes_sent
+        total[2] += 1
+    lines.append("Slowest hosts (time in remote commands):")
+    for host, (elapsed, sent, calls) in sorted(host_totals.items(), key=lambda item: -item[1][0])[:limit]:
+        lines.append("  {:8.2f}s  {}  {} command(s), {} byte(s) sent".format(elapsed, host, calls, sent))
+    return '\n'.join(lines)
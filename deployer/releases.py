@@ -0,0 +1,234 @@
+
+import hashlib
+import re
+import time
+import uuid
+import attr
+from invoke import Exit
+from deployer.docker import docker_build_command
+from deployer.etc import copy_etc_command, new_etc_backup_dir
+from deployer.hooks import new_changes_file, parse_reload_hooks, plan_changes_and_hooks, record_tree_changes_command
+from deployer.remote_plan import RemotePlan, execute_plan
+from deployer.shellfuncs import shellquote
+
+_release_name = re.compile(r'^[0-9a-z]+-[0-9]{14}(-[0-9a-f]{8})?$')
+
+# A config folder deployed before releases were kept becomes the oldest release.
+UNVERSIONED_RELEASE = "unversioned-00000000000000"
+
+@attr.s
+class Release(object):
+    """
+    A release to be installed.  `digest` is the SHA-256 of the archive it
+    was extracted from.
+    """
+    name = attr.ib()
+    digest = attr.ib()
+
+@attr.s
+class ReleaseState(object):
+    """
+    The releases on a host, newest first, and the name of the release the
+    config folder currently points to.
+    """
+    releases = attr.ib(default=attr.Factory(list))
+    current = attr.ib(default=None)
+    digests = attr.ib(default=attr.Factory(dict))
+
+    def find_digest(self, digest):
+        """
+        Return the newest release extracted from an archive with `digest`,
+        or None.
+        """
+        for name in self.releases:
+            if self.digests.get(name, None) == digest:
+                return name
+        return None
+
+def releases_folder(config_folder):
+    """
+    Return the folder that holds the releases of `config_folder`.
+    """
+    return "{}.releases".format(config_folder.rstrip("/"))
+
+def release_timestamp(now=None):
+    return time.strftime("%Y%m%d%H%M%S", time.gmtime(now))
+
+def new_release(commit, archive_path):
+    """
+    Return the `Release` for a deployment of `commit` from the archive at
+    `archive_path`.  A random suffix keeps the names of deployments of the
+    same commit within the same second apart.
+    """
+    if commit is None:
+        commit = "unknown"
+    return Release(
+        "{}-{}-{}".format(commit[:12], release_timestamp(), uuid.uuid4().hex[:8]),
+        archive_digest(archive_path))
+
+def archive_digest(archive_path):
+    """
+    Return the SHA-256 of the archive at `archive_path`.
+    """
+    sha = hashlib.sha256()
+    with open(archive_path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def remote_releases(conn, config_folder):
+    """
+    Return the `ReleaseState` of `config_folder` on the remote host.
+    """
+    inner_cmd = (
+        "if [ -L {0} ]; then echo current $(basename \"$(readlink {0})\"); fi; "
+        "if [ -d {1} ]; then cd {1} && for f in *; do "
+        "if [ -d \"$f\" ]; then echo release \"$f\"; "
+        "elif [ \"${{f%.sha256}}\" != \"$f\" ]; then echo digest \"${{f%.sha256}}\" $(cat \"$f\"); fi; "
+        "done; fi"
+    ).format(shellquote(config_folder.rstrip("/")), shellquote(releases_folder(config_folder)))
+    result = conn.sudo("bash -c {}".format(shellquote(inner_cmd)), hide=True)
+    state = ReleaseState()
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[0] == 'current':
+            state.current = parts[1]
+        elif len(parts) == 2 and parts[0] == 'release' and _release_name.match(parts[1]):
+            state.releases.append(parts[1])
+        elif len(parts) == 3 and parts[0] == 'digest':
+            state.digests[parts[1]] = parts[2]
+    state.releases.sort(key=lambda name: name.split('-')[1], reverse=True)
+    return state
+
+def plan_release_etc(plan, config_folder, remote_stagedir, release, etc_backup_dir=None):
+    """
+    Add the steps that move the `etc` folder out of `remote_stagedir` and
+    copy it to `/etc` to `plan`.  The folder is kept beside the release so
+    it can be copied to `/etc` again on rollback.
+    """
+    folder = releases_folder(config_folder)
+    release_path = "{}/{}".format(folder, release.name)
+    plan.sudo("create releases folder", "mkdir -p {}".format(shellquote(folder)))
+    plan.sudo("keep release etc", "bash -c {}".format(shellquote(
+        "if [ -d {0}/etc ]; then mv -T {0}/etc {1}.etc; fi".format(
+            shellquote(remote_stagedir),
+            shellquote(release_path)))))
+    plan.sudo("copy etc", copy_etc_command(folder, "{}.etc".format(release.name), "/etc", etc_backup_dir))
+
+def plan_release(plan, config_folder, remote_stagedir, release, keep):
+    """
+    Add the steps that turn `remote_stagedir` into `release` and make it
+    the current release to `plan`.
+    """
+    folder = releases_folder(config_folder)
+    release_path = "{}/{}".format(folder, release.name)
+    plan.sudo("create releases folder", "mkdir -p {}".format(shellquote(folder)))
+    plan.sudo("install release", "mv -T {} {}".format(shellquote(remote_stagedir), shellquote(release_path)))
+    plan.sudo("record release digest", "bash -c {}".format(shellquote(
+        "echo {} > {}.sha256".format(release.digest, shellquote(release_path)))))
+    plan.sudo("restorecon", restorecon_command(release_path))
+    plan.sudo("keep unversioned config", "bash -c {}".format(shellquote(
+        "if [ -d {0} ] && [ ! -L {0} ]; then mv -T {0} {1}/{2}; fi".format(
+            shellquote(config_folder.rstrip("/")),
+            shellquote(folder),
+            UNVERSIONED_RELEASE))))
+    plan.sudo("activate release", activate_command(config_folder, release.name))
+    plan.sudo("remove old releases", prune_command(config_folder, keep))
+
+def restorecon_command(path):
+    """
+    Return the command that restores the SELinux contexts under `path`
+    on hosts that have `restorecon`.
+    """
+    return "bash -c {}".format(shellquote(
+        "if which restorecon > /dev/null 2>&1; then restorecon -R {}; fi".format(shellquote(path))))
+
+def plan_activate(plan, config, name, move_etc=True, etc_backup_dir=None, build_image=True):
+    """
+    Add the steps that make the existing release `name` current to `plan`.
+    The role's reload hooks are triggered by the paths that differ from the
+    current release.  Replaced `/etc` files are backed up to
+    `etc_backup_dir` (a new backup folder by default).
+
+    As for a new release, the SELinux contexts of the release are restored
+    and, if `build_image` is True, a docker build target's image is built
+    from it.
+    """
+    config_folder = config.get_remote_config_folder()
+    folder = releases_folder(config_folder)
+    release_path = "{}/{}".format(folder, name)
+    reload_hooks = parse_reload_hooks(config.get_reload_hooks())
+    changes_file = None
+    if len(reload_hooks) > 0:
+        changes_file = new_changes_file()
+        plan.sudo("record config changes", record_tree_changes_command(release_path, config_folder, changes_file))
+    if not move_etc:
+        etc_backup_dir = None
+    elif etc_backup_dir is None:
+        etc_backup_dir = new_etc_backup_dir()
+    if move_etc:
+        plan.sudo("copy etc", copy_etc_command(folder, "{}.etc".format(name), "/etc", etc_backup_dir))
+    if config.is_docker_build_target() and build_image:
+        plan.sudo("docker build", docker_build_command(config, release_path))
+    plan.sudo("restorecon", restorecon_command(release_path))
+    plan.sudo("activate release", activate_command(config_folder, name))
+    plan_changes_and_hooks(plan, reload_hooks, changes_file, etc_backup_dir)
+
+def activate_command(config_folder, name):
+    """
+    Return the command that points `config_folder` at release `name`.
+    The symbolic link is replaced with a rename, so the config folder is
+    never missing.
+    """
+    config_folder = config_folder.rstrip("/")
+    tmp_link = "{}.deployer-swap".format(config_folder)
+    inner_cmd = "ln -sfn {} {} && mv -T {} {}".format(
+        shellquote("{}/{}".format(releases_folder(config_folder), name)),
+        shellquote(tmp_link),
+        shellquote(tmp_link),
+        shellquote(config_folder))
+    return "bash -c {}".format(shellquote(inner_cmd))
+
+def prune_command(config_folder, keep):
+    """
+    Return the command that removes all but the `keep` newest releases.
+    The current release is never removed.
+    """
+    inner_cmd = (
+        "cd {1} && current=$(basename \"$(readlink {0})\") && "
+        "ls -1 | grep -E '^[0-9a-z]+-[0-9]{{14}}(-[0-9a-f]{{8}})?$' | sort -t- -k2,2r | tail -n +{2} | "
+        "while read r; do if [ \"$r\" != \"$current\" ]; then rm -rf -- \"$r\" \"$r.etc\" \"$r.sha256\"; fi; done"
+    ).format(shellquote(config_folder.rstrip("/")), shellquote(releases_folder(config_folder)), keep + 1)
+    return "bash -c {}".format(shellquote(inner_cmd))
+
+def choose_rollback_target(state, target=None):
+    """
+    Return the name of the release to roll back to.  `target` may be a
+    release name or commit prefix.  By default, the release before the
+    current one is chosen.
+    """
+    if target is not None:
+        for name in state.releases:
+            if name == target or name.startswith(target):
+                return name
+        raise Exit("No release matches '{}'.".format(target))
+    if not state.current in state.releases:
+        raise Exit("The config folder does not point to a known release.")
+    n = state.releases.index(state.current)
+    if n + 1 >= len(state.releases):
+        raise Exit("There is no release before '{}'.".format(state.current))
+    return state.releases[n + 1]
+
+def rollback(conn, config, target=None, move_etc=True):
+    """
+    Point the config folder back at an earlier release.
+    """
+    config_folder = config.get_remote_config_folder()
+    if config_folder is None:
+        raise Exit("The configuration has no `config-folder`.")
+    state = remote_releases(conn, config_folder)
+    name = choose_rollback_target(state, target)
+    print("Rolling back from {} to {}.".format(state.current, name))
+    plan = RemotePlan()
+    plan_activate(plan, config, name, move_etc, build_image=config.get_docker_distribute() is None)
+    execute_plan(conn, plan)
@@ -0,0 +1,161 @@
+
+import io
+import uuid
+import attr
+from invoke import Exit
+from deployer import profiling
+from deployer.shellfuncs import shellquote
+
+STEP_MARKER = '@@deployer-step'
+
+@attr.s
+class Step(object):
+    name = attr.ib()
+    command = attr.ib(default=None)
+    sudo = attr.ib(default=True)
+    warn = attr.ib(default=False)
+    func = attr.ib(default=None)
+
+@attr.s
+class StepResult(object):
+    name = attr.ib()
+    return_code = attr.ib(default=0)
+    output = attr.ib(default='')
+
+    @property
+    def failed(self):
+        return self.return_code != 0
+
+class RemotePlan(object):
+    """
+    An ordered list of remote steps.  Command steps are shell command
+    lines that are valid both on their own and after `sudo`.  Function
+    steps call `func(conn)` and are used for steps that need the output of
+    an earlier step to decide what to do.
+    """
+    def __init__(self):
+        self.steps = []
+
+    def run(self, name, command, warn=False):
+        self.steps.append(Step(name, command, sudo=False, warn=warn))
+
+    def sudo(self, name, command, warn=False):
+        self.steps.append(Step(name, command, sudo=True, warn=warn))
+
+    def call(self, name, func):
+        self.steps.append(Step(name, func=func))
+
+def execute_plan(conn, plan, batch=False):
+    """
+    Run the steps of `plan` on the host.
+
+    If `batch` is False, each command step is a separate `run` or `sudo`.
+    Otherwise, consecutive command steps are compiled into a single script
+    that is uploaded and run with one `sudo`.  `run` steps in the script
+    still run as the login user.
+
+    :returns: A list of `StepResult` for the command steps.
+    """
+    results = []
+    pending = []
+    for step in plan.steps:
+        if step.func is not None:
+            if len(pending) > 0:
+                results.extend(run_script(conn, pending))
+                pending = []
+            with profiling.phase(step.name, conn.host):
+                step.func(conn)
+        elif batch:
+            pending.append(step)
+        else:
+            with profiling.phase(step.name, conn.host):
+                if step.sudo:
+                    result = conn.sudo(step.command, warn=step.warn)
+                else:
+                    result = conn.run(step.command, warn=step.warn)
+            results.append(StepResult(step.name, result.return_code))
+    if len(pending) > 0:
+        results.extend(run_script(conn, pending))
+    return results
+
+def compile_script(steps):
+    """
+    Compile command steps into a bash script.  Each step runs in a subshell
+    and is bracketed by marker lines carrying its index and exit status.
+    The script stops at the first failed step unless the step allows
+    failure.  The script removes itself when it starts.
+
+    The script is run with `sudo`, so steps that don't need it are run as
+    the user who ran `sudo` (`$SUDO_USER`), as they would be on their own.
+    """
+    lines = [
+        '#!/bin/bash',
+        'rm -f "$0"',
+        'as_user() { if [ -n "${SUDO_USER:-}" ]; then sudo -u "$SUDO_USER" -H bash -c "$1"; else bash -c "$1"; fi; }',
+    ]
+    for n, step in enumerate(steps):
+        lines.append("echo '{} {} begin'".format(STEP_MARKER, n))
+        if step.sudo:
+            lines.append("( {} ) 2>&1".format(step.command))
+        else:
+            lines.append("as_user {} 2>&1".format(shellquote(step.command)))
+        lines.append("rc=$?")
+        lines.append('echo "{} {} end $rc"'.format(STEP_MARKER, n))
+        if not step.warn:
+            lines.append("[ $rc -eq 0 ] || exit $rc")
+    lines.append("exit 0")
+    return '\n'.join(lines) + '\n'
+
+def parse_script_output(steps, output):
+    """
+    Split the output of a compiled script into a `StepResult` per step
+    that ran.
+    """
+    results = []
+    current = None
+    lines = []
+    for line in output.splitlines():
+        if line.startswith(STEP_MARKER + ' '):
+            fields = line.split()
+            n = int(fields[1])
+            if fields[2] == 'begin':
+                current = n
+                lines = []
+            elif fields[2] == 'end' and current == n:
+                results.append(StepResult(steps[n].name, int(fields[3]), '\n'.join(lines)))
+                current = None
+        elif current is not None:
+            lines.append(line)
+    if current is not None:
+        results.append(StepResult(steps[current].name, -1, '\n'.join(lines)))
+    return results
+
+def run_script(conn, steps):
+    """
+    Upload the compiled script for `steps`, run it with a single `sudo`,
+    and report each step.  Raise `Exit` if a step that must succeed failed.
+    """
+    with profiling.phase("batch of {} step(s)".format(len(steps)), conn.host):
+        return _run_script(conn, steps)
+
+def _run_script(conn, steps):
+    script = compile_script(steps)
+    remote_script = "/tmp/deployer-{}.sh".format(uuid.uuid4().hex)
+    conn.put(io.BytesIO(script.encode('utf-8')), remote_script)
+    result = conn.sudo("bash {}".format(shellquote(remote_script)), hide=True, warn=True)
+    results = parse_script_output(steps, result.stdout)
+    for n, step_result in enumerate(results):
+        if not step_result.failed:
+            status = "ok"
+        elif steps[n].warn:
+            status = "ignored"
+        else:
+            status = "FAILED"
+        print("[{}] {} (exit {})".format(status, step_result.name, step_result.return_code))
+        if step_result.output.strip() != "":
+            print(step_result.output)
+    if result.failed:
+        if len(results) > 0 and results[-1].failed:
+            raise Exit("Step '{}' failed with exit status {}.".format(results[-1].name, results[-1].return_code))
+        raise Exit("Remote script failed with exit status {}: {}".format(result.return_code, result.stderr.strip()))
+    return results
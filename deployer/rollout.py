@@ -0,0 +1,134 @@
+
+import math
+import attr
+from invoke import Exit
+from deployer import scheduler
+from deployer.terminal import warn
+
+@attr.s
+class Rollout(object):
+    canary = attr.ib(default=0)
+    wave_size = attr.ib(default=None)
+    health_check = attr.ib(default=None)
+    health_check_sudo = attr.ib(default=False)
+    max_failures = attr.ib(default=0)
+
+def parse_rollout(settings):
+    """
+    Create a `Rollout` from the `rollout` section of a role.
+    Returns None if `settings` is None.
+    """
+    if settings is None:
+        return None
+    canary = settings.get('canary', 0)
+    if not isinstance(canary, (int, list)):
+        raise Exit("Rollout `canary` must be a host count or a list of hosts.")
+    wave_size = settings.get('wave-size', None)
+    if wave_size is not None:
+        wave_size = str(wave_size).strip()
+        size = wave_size.rstrip('%')
+        if not size.isdigit() or int(size) == 0:
+            raise Exit("Rollout `wave-size` must be a positive count or percentage, not '{}'.".format(wave_size))
+    return Rollout(
+        canary=canary,
+        wave_size=wave_size,
+        health_check=settings.get('health-check', None),
+        health_check_sudo=settings.get('health-check-sudo', False),
+        max_failures=int(settings.get('max-failures', 0)))
+
+def plan_waves(pool, rollout):
+    """
+    Split the connections in `pool` into a list of waves.
+
+    The canary wave (if any) is first.  The remaining hosts are split into
+    waves of `rollout.wave_size`, which may be a host count or a percentage
+    of the hosts left after the canaries.
+    """
+    conns = list(pool)
+    if rollout is None:
+        return [conns]
+    if isinstance(rollout.canary, list):
+        canary_hosts = set(rollout.canary)
+        canaries = [conn for conn in conns if conn.host in canary_hosts]
+        missing = canary_hosts - set(conn.host for conn in canaries)
+        for host in sorted(missing):
+            warn("Canary host '{}' is not a target host.".format(host))
+    else:
+        canaries = conns[:rollout.canary]
+    rest = [conn for conn in conns if not conn in canaries]
+    waves = []
+    if len(canaries) > 0:
+        waves.append(canaries)
+    if len(rest) == 0:
+        return waves
+    size = wave_size_for(rollout.wave_size, len(rest))
+    for n in range(0, len(rest), size):
+        waves.append(rest[n:n + size])
+    return waves
+
+def wave_size_for(wave_size, host_count):
+    """
+    Resolve a wave size setting to a number of hosts.
+    """
+    if wave_size is None:
+        return host_count
+    if wave_size.endswith('%'):
+        return max(1, int(math.ceil(host_count * int(wave_size[:-1]) / 100.0)))
+    return int(wave_size)
+
+def run_health_check(conn, rollout):
+    """
+    Run the rollout health check on a host.  Raises on failure.
+    """
+    if rollout.health_check is None:
+        return
+    if rollout.health_check_sudo:
+        conn.sudo(rollout.health_check)
+    else:
+        conn.run(rollout.health_check)
+
+def rolling_run(pool, func, rollout, parallel=1):
+    """
+    Call `func(conn)` for each connection in `pool`, one wave at a time.
+    Each host in a wave is health checked after `func` completes.
+    The rollout halts if a canary fails or if more than
+    `rollout.max_failures` hosts have failed.
+
+    :returns: A list of `HostResult` for the hosts that were attempted.
+    """
+    if rollout is None:
+        return scheduler.run_on_hosts(pool, func, parallel)
+
+    def deploy_and_check(conn):
+        func(conn)
+        run_health_check(conn, rollout)
+
+    waves = plan_waves(pool, rollout)
+    has_canary = rollout.canary not in (0, [])
+    results = []
+    failures = 0
+    for n, wave in enumerate(waves):
+        print()
+        print("*** Wave {} of {}: {} ***".format(n + 1, len(waves), ', '.join(conn.host for conn in wave)))
+        wave_results = scheduler.run_on_hosts(wave, deploy_and_check, parallel, keep_going=True)
+        results.extend(wave_results)
+        failures += len([r for r in wave_results if not r.ok])
+        is_canary = (n == 0) and has_canary
+        remaining = [conn.host for w in waves[n + 1:] for conn in w]
+        if failures > 0 and is_canary:
+            halt_rollout(results, remaining, "Canary failed.")
+        if failures > rollout.max_failures:
+            halt_rollout(
+                results,
+                remaining,
+                "{} failure(s) exceeds the budget of {}.".format(failures, rollout.max_failures))
+    return results
+
+def halt_rollout(results, remaining, reason):
+    """
+    Stop the rollout and report the hosts that were skipped.
+    """
+    if len(remaining) > 0:
+        warn("Skipping hosts: {}".format(', '.join(remaining)))
+    scheduler.print_summary(results)
+    raise Exit("Rollout halted: {}".format(reason))
@@ -0,0 +1,148 @@
+
+import io
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import attr
+from invoke import Exit
+from deployer import terminal
+
+@attr.s
+class HostResult(object):
+    host = attr.ib()
+    ok = attr.ib(default=False)
+    error = attr.ib(default=None)
+    elapsed = attr.ib(default=0.0)
+
+class BufferedConnection(object):
+    """
+    Wrap a connection so the output of remote commands is written to
+    `buffer` instead of the terminal.  Stdin mirroring is disabled because
+    several hosts can't share the local terminal.
+    """
+    def __init__(self, conn, buffer):
+        self._conn = conn
+        self._buffer = buffer
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def run(self, command, **kwargs):
+        return self._conn.run(command, **self._stream_kwargs(kwargs))
+
+    def sudo(self, command, **kwargs):
+        return self._conn.sudo(command, **self._stream_kwargs(kwargs))
+
+    def _stream_kwargs(self, kwargs):
+        kwargs.setdefault('out_stream', self._buffer)
+        kwargs.setdefault('err_stream', self._buffer)
+        kwargs.setdefault('in_stream', False)
+        return kwargs
+
+def print_host_banner(conn):
+    """
+    Print the host banner.
+    """
+    msg = "=== [Connected to {}] ===".format(conn.host)
+    border = "=" * len(msg)
+    print()
+    print(border)
+    print(msg)
+    print(border)
+    print()
+
+def run_on_hosts(pool, func, parallel=1, keep_going=False):
+    """
+    Call `func(conn)` for each connection in `pool`, running on at most
+    `parallel` hosts at once.
+
+    When `parallel` is 1, hosts are processed in order with output going
+    straight to the terminal and the first failure is raised (unless
+    `keep_going` is set, in which case it is recorded).  Otherwise
+    the output for each host is buffered and printed when the host
+    finishes, failures are recorded rather than raised, and a summary is
+    printed at the end.
+
+    :returns: A list of `HostResult`.
+    """
+    pool = list(pool)
+    if parallel <= 1:
+        results = []
+        for conn in pool:
+            result = HostResult(conn.host)
+            start = time.time()
+            print_host_banner(conn)
+            try:
+                func(conn)
+                result.ok = True
+            except (Exception, SystemExit) as ex:
+                if not keep_going:
+                    raise
+                result.error = ex
+                print("[ERROR] {}".format(describe_error(ex)))
+            result.elapsed = time.time() - start
+            results.append(result)
+        return results
+    print_lock = threading.Lock()
+
+    def run_one(conn):
+        buffer = io.StringIO()
+        result = HostResult(conn.host)
+        start = time.time()
+        terminal.capture_thread_output(buffer)
+        try:
+            print_host_banner(conn)
+            func(BufferedConnection(conn, buffer))
+            result.ok = True
+        except (Exception, SystemExit) as ex:
+            result.error = ex
+            print("[ERROR] {}".format(describe_error(ex)))
+        finally:
+            terminal.capture_thread_output(None)
+            result.elapsed = time.time() - start
+        with print_lock:
+            sys.stdout.write(buffer.getvalue())
+            sys.stdout.flush()
+        return result
+
+    original = terminal.install_output_router()
+    try:
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            results = list(executor.map(run_one, pool))
+    finally:
+        terminal.restore_output(original)
+    print_summary(results)
+    return results
+
+def describe_error(ex):
+    """
+    Return a one line description of a host failure.
+    """
+    msg = str(ex).strip()
+    if msg == "":
+        return ex.__class__.__name__
+    return msg.splitlines()[-1]
+
+def print_summary(results):
+    """
+    Print a per-host success/failure summary.
+    """
+    print()
+    print("=== Summary ===")
+    for result in results:
+        if result.ok:
+            status = "OK"
+        else:
+            status = "FAILED: {}".format(describe_error(result.error))
+        print("{}  [{:.1f}s]  {}".format(result.host, result.elapsed, status))
+    failed = [r for r in results if not r.ok]
+    print("{} succeeded, {} failed.".format(len(results) - len(failed), len(failed)))
+
+def check_results(results):
+    """
+    Raise `Exit` if any host failed.
+    """
+    failed = [r.host for r in results if not r.ok]
+    if len(failed) > 0:
+        raise Exit("Failed on {} host(s): {}".format(len(failed), ', '.join(failed)))
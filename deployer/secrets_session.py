@@ -0,0 +1,255 @@
+
+import atexit
+import os
+import subprocess
+import sys
+import threading
+import time
+from invoke import Exit
+from deployer.terminal import warn
+
+DEFAULT_SESSION_TTL = 900
+
+def decrypt_blob(data):
+    """
+    Decrypt a `git secret` encrypted blob with GnuPG and return the plain
+    text.  The GnuPG command may be overridden with the
+    `SECRETS_GPG_COMMAND` environment variable, as with `git secret`.
+    """
+    gpg = os.environ.get('SECRETS_GPG_COMMAND', 'gpg')
+    proc = subprocess.run(
+        [gpg, '--use-agent', '-q', '--decrypt', '--yes', '--no-permission-warning'],
+        input=data,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise Exit("Could not decrypt secret: {}".format(proc.stderr.decode('utf-8', 'replace').strip()))
+    return proc.stdout
+
+def default_session_dir():
+    """
+    Return a folder on a memory backed file system for the session store,
+    or None if there isn't one.
+    """
+    name = "config-deployer-{}".format(os.getuid())
+    for base in ('/dev/shm', os.environ.get('XDG_RUNTIME_DIR', None)):
+        if base is not None and os.path.isdir(base):
+            return os.path.join(base, name)
+    return None
+
+def expire_folder(path, ttl):
+    """
+    Remove the plain text in the session folder `path` that is older than
+    `ttl` seconds.
+
+    :returns: The number of seconds until the next file expires, or None
+        if the folder is empty.
+    """
+    now = time.time()
+    remaining = None
+    for name in os.listdir(path):
+        fpath = os.path.join(path, name)
+        try:
+            age = now - os.path.getmtime(fpath)
+            if age > ttl:
+                os.unlink(fpath)
+                continue
+        except FileNotFoundError:
+            continue
+        if remaining is None or ttl - age < remaining:
+            remaining = ttl - age
+    return remaining
+
+def reap(path, ttl):
+    """
+    Remove the plain text in the session folder `path` as it expires,
+    until the folder is empty.
+    """
+    while True:
+        remaining = expire_folder(path, ttl)
+        if remaining is None:
+            return
+        time.sleep(remaining + 1)
+
+def start_reaper(path, ttl):
+    """
+    Start a detached process that runs `reap()` on the session folder
+    `path`, so plain text doesn't outlive its `ttl` after this process
+    exits.
+    """
+    env = dict(os.environ)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (package_root, env.get('PYTHONPATH', None)) if p)
+    subprocess.Popen(
+        [sys.executable, '-c', 'import sys; from deployer.secrets_session import reap; reap(sys.argv[1], float(sys.argv[2]))',
+         path, str(ttl)],
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True)
+
+class SecretsSession(object):
+    """
+    Decrypted secrets, keyed by the SHA of the encrypted git blob.
+
+    A blob is only handed to GnuPG if it hasn't been decrypted within the
+    last `ttl` seconds.  Plain text is kept in memory for the life of the
+    process and, if `path` is not None, in a folder only the owner can
+    access until it expires.  It is never written to the working tree.
+    """
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.memory = {}
+        self.lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+            os.chmod(path, 0o700)
+            self.expire()
+
+    def expire(self):
+        """
+        Remove expired plain text from the session folder.
+
+        :returns: The number of seconds until the next file expires, or
+            None if the folder is empty.
+        """
+        if self.path is None:
+            return None
+        return expire_folder(self.path, self.ttl)
+
+    def close(self):
+        """
+        Drop the plain text held in memory and make sure the plain text in
+        the session folder is removed once it expires.
+        """
+        with self.lock:
+            self.memory.clear()
+        if self.expire() is not None:
+            start_reaper(self.path, self.ttl)
+
+    def forget(self):
+        """
+        Remove all plain text from the session.
+        """
+        with self.lock:
+            self.memory.clear()
+            if self.path is not None:
+                for name in os.listdir(self.path):
+                    os.unlink(os.path.join(self.path, name))
+
+    def decrypt(self, sha, read_blob):
+        """
+        Return the plain text of encrypted blob `sha`.  `read_blob()` is only
+        called when the blob must actually be decrypted.
+        """
+        with self.lock:
+            if sha in self.memory:
+                return self.memory[sha]
+        if self.path is None:
+            data = decrypt_blob(read_blob())
+            with self.lock:
+                self.memory[sha] = data
+            return data
+        path = os.path.join(self.path, sha)
+        try:
+            if time.time() - os.path.getmtime(path) <= self.ttl:
+                with open(path, "rb") as f:
+                    data = f.read()
+                with self.lock:
+                    self.memory[sha] = data
+                return data
+        except FileNotFoundError:
+            pass
+        data = decrypt_blob(read_blob())
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+        with self.lock:
+            self.memory[sha] = data
+        return data
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def close_sessions():
+    """
+    Close every session opened by this process.  Runs at exit.
+    """
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        try:
+            session.close()
+        except OSError as ex:
+            warn("Could not clean up secrets session '{}': {}".format(session.path, ex))
+
+def open_secrets_session(config):
+    """
+    Return the `SecretsSession` described by the user settings, or None if
+    secrets sessions are disabled.  Sessions are shared within a process.
+    If no folder is configured and there is no memory backed file system,
+    plain text is only kept in memory.
+    """
+    settings = config.get_secrets_session_settings()
+    if not settings.get('enabled', False):
+        return None
+    path = settings.get('path', None)
+    if path is None:
+        path = default_session_dir()
+        if path is None:
+            warn("No memory backed file system for the secrets session; keeping decrypted secrets in memory only.")
+    else:
+        path = os.path.expanduser(path)
+    ttl = settings.get('ttl', DEFAULT_SESSION_TTL)
+    with _sessions_lock:
+        if not path in _sessions:
+            try:
+                session = SecretsSession(path, ttl)
+            except OSError as ex:
+                warn("Secrets session '{}' is unavailable: {}".format(path, ex))
+                return None
+            if len(_sessions) == 0:
+                atexit.register(close_sessions)
+            _sessions[path] = session
+        return _sessions[path]
+
+def decrypt_with(session, sha, read_blob):
+    """
+    Decrypt blob `sha` through `session`, or directly if `session` is None.
+    """
+    if session is None:
+        return decrypt_blob(read_blob())
+    return session.decrypt(sha, read_blob)
+
+def reveal_working_tree(session, wt):
+    """
+    Decrypt every `.secret` file in the index of the working tree `wt`
+    next to its encrypted file, like `git secret reveal`, using `session`
+    so only changed blobs are handed to GnuPG.
+    """
+    output = subprocess.run(
+        ['git', 'ls-files', '-s', '-z', '--', '*.secret'],
+        cwd=wt,
+        stdout=subprocess.PIPE,
+        check=True).stdout
+    for record in output.split(b'\0'):
+        if record == b'':
+            continue
+        info, path = record.split(b'\t', 1)
+        sha = info.decode('ascii').split(' ')[1]
+        path = path.decode('utf-8')
+        encrypted_path = os.path.join(wt, path)
+
+        def read_blob():
+            with open(encrypted_path, "rb") as f:
+                return f.read()
+
+        data = session.decrypt(sha, read_blob)
+        with open(encrypted_path[:-len('.secret')], "wb") as f:
+            f.write(data)
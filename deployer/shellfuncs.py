@@ -7,3 +7,10 @@ def shellquote(s):
     """
     return "'" + s.replace("'", "'\\''") + "'"
 
+def chunked(items, size=500):
+    """
+    Split `items` into lists of at most `size` items so that commands
+    built from them stay well under the command line length limit.
+    """
+    for n in range(0, len(items), size):
+        yield items[n:n + size]
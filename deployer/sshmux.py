@@ -0,0 +1,211 @@
+
+import contextlib
+import os
+import re
+import subprocess
+import threading
+import attr
+from invoke import Exit, Responder
+from deployer.shellfuncs import shellquote
+
+SUDO_PROMPT = '[sudo] password: '
+DEFAULT_CONTROL_DIR = '~/.ssh'
+DEFAULT_CONTROL_PERSIST = 600
+
+@attr.s
+class ConnectionStats(object):
+    """
+    Counts how many remote commands had to set up a new SSH master
+    connection (a full handshake) and how many reused an existing one.
+    """
+    handshakes = attr.ib(default=0)
+    reuses = attr.ib(default=0)
+    lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+
+    def record(self, reused):
+        with self.lock:
+            if reused:
+                self.reuses += 1
+            else:
+                self.handshakes += 1
+
+    def report(self):
+        return "SSH connections: {} handshake(s), {} reuse(s).".format(self.handshakes, self.reuses)
+
+STATS = ConnectionStats()
+
+def parse_host(host):
+    """
+    Split a `[user@]host[:port]` string into (user, hostname, port).
+    """
+    user = None
+    port = None
+    if '@' in host:
+        user, host = host.rsplit('@', 1)
+    if host.count(':') == 1:
+        host, port = host.split(':')
+    return user, host, port
+
+def read_stream(stream, outputs, name):
+    """
+    Read `stream` to the end into `outputs[name]`.
+    """
+    outputs[name] = stream.read()
+
+class MuxConnection(object):
+    """
+    A connection that runs remote commands with the OpenSSH client over a
+    shared master connection (`ControlMaster`).  The master outlives the
+    `deploy.py` process for `control_persist` idle seconds, so back-to-back
+    sub-commands against the same hosts skip the SSH handshake entirely.
+
+    Supports the subset of the Fabric `Connection` interface used by the
+    deployer: `host`, `run()`, `sudo()`, `put()`, and `cd()`, plus `pipe()`.
+    """
+    def __init__(self, host, invoker, sudo_passwd=None, pty=False,
+                 control_dir=DEFAULT_CONTROL_DIR, control_persist=DEFAULT_CONTROL_PERSIST, stats=STATS):
+        self.host = host
+        self.user, self.hostname, self.port = parse_host(host)
+        self.invoker = invoker
+        self.sudo_passwd = sudo_passwd
+        self.pty = pty
+        self.control_dir = os.path.expanduser(control_dir)
+        self.control_persist = control_persist
+        self.stats = stats
+        self.command_cwds = []
+
+    def destination(self):
+        if self.user is None:
+            return self.hostname
+        return "{}@{}".format(self.user, self.hostname)
+
+    def control_path(self):
+        """
+        Return the path of the master connection socket for this host.
+        """
+        name = "deployer-{}-{}".format(self.destination(), self.port or 22)
+        return os.path.join(self.control_dir, name)
+
+    def ssh_args(self, tty=False):
+        """
+        Return the `ssh` command line (without the remote command).
+        """
+        args = [
+            'ssh',
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={}'.format(self.control_path()),
+            '-o', 'ControlPersist={}'.format(self.control_persist),
+        ]
+        if self.port is not None:
+            args.extend(['-p', self.port])
+        if tty:
+            args.append('-tt')
+        args.append(self.destination())
+        return args
+
+    @contextlib.contextmanager
+    def cd(self, path):
+        self.command_cwds.append(path)
+        try:
+            yield
+        finally:
+            self.command_cwds.pop()
+
+    def _prefix(self, command):
+        for cwd in reversed(self.command_cwds):
+            command = "cd {} && {}".format(shellquote(cwd), command)
+        return command
+
+    def _run(self, command, display, **kwargs):
+        """
+        Run `command` on the remote host via the local invoker.
+        `display` is the command that is echoed.
+        """
+        reused = os.path.exists(self.control_path())
+        self.stats.record(reused)
+        if self.invoker.config.run.echo:
+            print("\033[1;37m{}\033[0m".format(display))
+        pty = kwargs.pop('pty', self.pty)
+        ssh = ' '.join(shellquote(arg) for arg in self.ssh_args(tty=pty))
+        full_cmd = "{} {}".format(ssh, shellquote(self._prefix(command)))
+        kwargs['echo'] = False
+        return self.invoker.run(full_cmd, **kwargs)
+
+    def run(self, command, **kwargs):
+        return self._run(command, command, **kwargs)
+
+    def sudo(self, command, **kwargs):
+        watchers = list(kwargs.pop('watchers', []))
+        password = kwargs.pop('password', self.sudo_passwd)
+        if password is not None:
+            watchers.append(Responder(pattern=re.escape(SUDO_PROMPT), response="{}\n".format(password)))
+        sudo_cmd = "sudo -S -p {} -H {}".format(shellquote(SUDO_PROMPT), command)
+        return self._run(sudo_cmd, command, watchers=watchers, **kwargs)
+
+    def put(self, local, remote):
+        """
+        Copy the local file (a path or a file-like object) to `remote`
+        over the master connection.
+        """
+        reused = os.path.exists(self.control_path())
+        self.stats.record(reused)
+        args = self.ssh_args() + ["cat > {}".format(shellquote(remote))]
+        if hasattr(local, 'read'):
+            proc = subprocess.run(args, input=local.read(), stderr=subprocess.PIPE)
+        else:
+            with open(local, "rb") as f:
+                proc = subprocess.run(args, stdin=f, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise Exit("Upload to {}:{} failed: {}".format(
+                self.host, remote, proc.stderr.decode('utf-8', 'replace').strip()))
+
+    def pipe(self, command, chunks):
+        """
+        Run `command` over the master connection with the byte strings in
+        `chunks` as its stdin.  Return its stdout.
+        """
+        reused = os.path.exists(self.control_path())
+        self.stats.record(reused)
+        args = self.ssh_args() + [self._prefix(command)]
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Drain stdout and stderr while stdin is written, so a command that
+        # fills either pipe can't block the upload.
+        outputs = {}
+        readers = [
+            threading.Thread(target=read_stream, args=(proc.stdout, outputs, 'stdout'), daemon=True),
+            threading.Thread(target=read_stream, args=(proc.stderr, outputs, 'stderr'), daemon=True)]
+        for reader in readers:
+            reader.start()
+        try:
+            for chunk in chunks:
+                proc.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            for reader in readers:
+                reader.join()
+            proc.wait()
+        stdout = outputs['stdout']
+        stderr = outputs['stderr']
+        if proc.returncode != 0:
+            raise Exit("Streaming to {} failed with exit status {}: {}".format(
+                self.host, proc.returncode, stderr.decode('utf-8', 'replace').strip()))
+        return stdout.decode('utf-8')
+
+    def close_master(self):
+        """
+        Stop the persistent master connection for this host, if any.
+        """
+        if not os.path.exists(self.control_path()):
+            return False
+        args = self.ssh_args()
+        args[1:1] = ['-O', 'exit']
+        subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return True
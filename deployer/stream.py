@@ -0,0 +1,125 @@
+
+import threading
+from invoke import Exit
+from deployer import profiling
+from deployer.shellfuncs import shellquote
+from deployer.sshmux import read_stream
+
+STREAM_CHUNK = 65536
+
+def extract_stream_command(baked_perms=False, with_password=False):
+    """
+    Return the remote command that creates a staging folder, prints its
+    path, and extracts the archive read from stdin into it.
+
+    If `baked_perms` is True, `tar` runs as root to keep the owners and
+    modes of the entries.  If `with_password` is True, the first line of
+    stdin is the `sudo` password.  It is read by the shell and handed to
+    `sudo -S` on its own, so `tar` only sees the archive.
+    """
+    if not baked_perms:
+        extract = 'tar xzf - -C "$d"'
+    elif with_password:
+        extract = (
+            'IFS= read -r pw && printf "%s\\n" "$pw" | sudo -S -p "" -v && unset pw && '
+            'sudo -n tar xzpf - --same-owner -C "$d"')
+    else:
+        extract = 'sudo -n tar xzpf - --same-owner -C "$d"'
+    inner_cmd = 'd=$(mktemp -d) && echo "$d" && {}'.format(extract)
+    return "bash -c {}".format(shellquote(inner_cmd))
+
+def sudo_password(conn):
+    """
+    Return the `sudo` password configured for `conn` or None.
+    """
+    try:
+        return conn.sudo_passwd
+    except AttributeError:
+        pass
+    try:
+        return conn.config.sudo.password
+    except AttributeError:
+        return None
+
+def file_chunks(f, prefix=b''):
+    """
+    Yield `prefix` followed by the contents of the binary file `f`.
+    """
+    if len(prefix) > 0:
+        yield prefix
+    for chunk in iter(lambda: f.read(STREAM_CHUNK), b''):
+        yield chunk
+
+def stream_archive(conn, archive_path, baked_perms=False):
+    """
+    Extract the local archive at `archive_path` into a new remote staging
+    folder by piping it into `tar` over the SSH connection.  The archive
+    itself is never written to a file on the remote host, and the staging
+    folder (from `mktemp -d`) is created in the same round trip.
+
+    Return the path of the staging folder.
+    """
+    password = None
+    if baked_perms:
+        password = sudo_password(conn)
+    command = extract_stream_command(baked_perms, password is not None)
+    prefix = b''
+    if password is not None:
+        prefix = "{}\n".format(password).encode('utf-8')
+    with profiling.phase("stream archive", conn.host):
+        with open(archive_path, "rb") as f:
+            stdout = pipe_to_command(conn, command, file_chunks(f, prefix))
+    remote_stagedir = stdout.splitlines()[0]
+    print("Extracted archive into {}.".format(remote_stagedir))
+    return remote_stagedir
+
+def pipe_to_command(conn, command, chunks):
+    """
+    Run `command` on the host of `conn` with the byte strings in `chunks`
+    as its stdin.  Return its stdout.  Connections that provide a `pipe()`
+    method use it, otherwise `conn` must be a Fabric connection.
+    """
+    pipe = getattr(conn, 'pipe', None)
+    if pipe is not None:
+        return pipe(command, chunks)
+    return paramiko_pipe(conn, command, chunks)
+
+def paramiko_pipe(conn, command, chunks):
+    """
+    Pipe `chunks` into `command` over a new channel of the Fabric
+    connection's SSH transport.  stdout and stderr are read while the
+    chunks are sent, so a command that writes a lot to either never
+    blocks on a full window.  If the command stops reading early, its
+    exit status and stderr are reported.
+    """
+    conn.open()
+    channel = conn.client.get_transport().open_session()
+    try:
+        channel.exec_command(command)
+        outputs = {}
+        readers = [
+            threading.Thread(target=read_stream, args=(channel.makefile('rb'), outputs, 'stdout'), daemon=True),
+            threading.Thread(target=read_stream, args=(channel.makefile_stderr('rb'), outputs, 'stderr'), daemon=True)]
+        for reader in readers:
+            reader.start()
+        try:
+            for chunk in chunks:
+                channel.sendall(chunk)
+            channel.shutdown_write()
+        except OSError:
+            pass
+        for reader in readers:
+            reader.join()
+        status = channel.recv_exit_status()
+    finally:
+        channel.close()
+    check_pipe_status(conn.host, status, outputs.get('stderr', b''))
+    return outputs.get('stdout', b'').decode('utf-8')
+
+def check_pipe_status(host, status, stderr):
+    """
+    Raise `Exit` if a piped command failed.
+    """
+    if status != 0:
+        raise Exit("Streaming to {} failed with exit status {}: {}".format(
+            host, status, stderr.decode('utf-8', 'replace').strip()))
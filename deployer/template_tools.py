@@ -1,10 +1,120 @@
 
+import hashlib
+import hmac
+import json
 import os
 import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from invoke import Exit
 import jinja2
+import jinja2.meta
 from jinja2.exceptions import TemplateSyntaxError
 import yaml
+from deployer.terminal import warn
+
+JINJA_OPTIONS = {
+    'trim_blocks': True,
+    'lstrip_blocks': True,
+}
+DEFAULT_TEMPLATE_CACHE_DIR = '~/.cache/config-deployer/templates'
+DEFAULT_MAX_AGE_DAYS = 7
+
+class TemplateCache(object):
+    """
+    A persistent cache of compiled templates (Jinja bytecode) and of
+    rendered outputs.
+
+    Each output is keyed on an HMAC of its template source, the sources of
+    the templates it includes, imports, or extends, its secrets, and the
+    Jinja options, so unchanged templates are not rendered again.
+    Rendered outputs contain secrets, so the cache folder is only
+    accessible by its owner and the HMAC key keeps the secrets from being
+    guessed from the cache keys.
+    """
+    def __init__(self, path, max_age):
+        self.path = path
+        self.max_age = max_age
+        self.output_path = os.path.join(path, "rendered")
+        bytecode_path = os.path.join(path, "bytecode")
+        for folder in (path, self.output_path, bytecode_path):
+            os.makedirs(folder, mode=0o700, exist_ok=True)
+            os.chmod(folder, 0o700)
+        self.bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_path)
+        self.hmac_key = self.load_hmac_key()
+
+    def load_hmac_key(self):
+        key_path = os.path.join(self.path, "hmac.key")
+        if not os.path.exists(key_path):
+            fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(os.urandom(32))
+        with open(key_path, "rb") as f:
+            return f.read()
+
+    def output_key(self, sources, secrets):
+        """
+        Return the cache key for rendering a template with `secrets`.
+        `sources` maps the name of the template and of each template it
+        depends on to its source.
+        """
+        data = json.dumps(
+            [sources, secrets, JINJA_OPTIONS, jinja2.__version__],
+            sort_keys=True,
+            default=str)
+        return hmac.new(self.hmac_key, data.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached output for `key` or None.
+        """
+        path = os.path.join(self.output_path, key)
+        try:
+            with open(path, "r") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return text
+
+    def put(self, key, text):
+        fd, tmp_path = tempfile.mkstemp(dir=self.output_path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(text)
+            os.rename(tmp_path, os.path.join(self.output_path, key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def evict(self):
+        """
+        Remove rendered outputs that haven't been used within the maximum age.
+        """
+        now = time.time()
+        for name in os.listdir(self.output_path):
+            path = os.path.join(self.output_path, name)
+            if now - os.path.getmtime(path) > self.max_age:
+                os.unlink(path)
+
+def open_template_cache(config):
+    """
+    Return the `TemplateCache` described by the user settings, or None if
+    caching is disabled.
+    """
+    settings = config.get_archive_cache_settings()
+    if not settings.get('enabled', True):
+        return None
+    path = os.path.expanduser(settings.get('template_path', DEFAULT_TEMPLATE_CACHE_DIR))
+    max_age = settings.get('max_age_days', DEFAULT_MAX_AGE_DAYS) * 86400
+    try:
+        cache = TemplateCache(path, max_age)
+        cache.evict()
+        return cache
+    except OSError as ex:
+        warn("Template cache '{}' is unavailable: {}".format(path, ex))
+        return None
 
 def fill_templates(config):
     """
@@ -19,18 +129,85 @@ def fill_templates(config):
     secrets_path = os.path.join(basedir, secrets)
     if not os.path.exists(secrets_path):
         raise Exit("Secrets file '{}' does not exist.".format(secrets_path))
-    jinja2_env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
     with open(secrets_path, "r") as f:
-        doc = yaml.load(f)
-    for fname, info in doc['files'].items():
-        path = os.path.join(basedir, fname)
-        with open(path) as f:
-            try:
-                t = jinja2_env.from_string(f.read())
-            except Exception as ex:
-                fabutils.warn("Error processing template '{0}'.".format(path))
-                raise
-            transformed = os.path.splitext(path)[0]
-            with open(transformed, "w") as fout:
-                print(t.render(info['secrets']), file=fout)
+        doc = yaml.safe_load(f)
+
+    def read_template(fname):
+        with open(os.path.join(basedir, fname)) as f:
+            return f.read()
+
+    cache = open_template_cache(config)
+    for fname, text in render_templates(doc, read_template, cache):
+        transformed = os.path.splitext(os.path.join(basedir, fname))[0]
+        with open(transformed, "w") as fout:
+            print(text, file=fout)
+
+def template_dependencies(env, sources, fname):
+    """
+    Return a mapping of name to source for the template `fname` and every
+    template it includes, imports, or extends, directly or not.  Return
+    None if a template name is only known when rendering.
+    """
+    found = {}
+    pending = [fname]
+    while len(pending) > 0:
+        name = pending.pop()
+        if name in found or not name in sources:
+            continue
+        found[name] = sources[name]
+        try:
+            ast = env.parse(sources[name], name)
+        except TemplateSyntaxError:
+            return None
+        for ref in jinja2.meta.find_referenced_templates(ast):
+            if ref is None:
+                return None
+            pending.append(ref)
+    return found
+
+def render_templates(doc, read_template, cache=None, workers=4):
+    """
+    Render the templates described in the parsed secrets document `doc`.
+    `read_template(fname)` must return the source of the template `fname`.
+
+    If a `TemplateCache` is given, outputs whose template, included
+    templates, and secrets are unchanged are taken from the cache and
+    compiled templates are reused.  Templates that include a template
+    chosen at render time are always rendered.
+    Templates are rendered on up to `workers` threads.
+
+    Yields (template file name, rendered text) pairs in document order.
+    """
+    items = list(doc['files'].items())
+    sources = dict((fname, read_template(fname)) for fname, info in items)
+    bytecode_cache = None
+    if cache is not None:
+        bytecode_cache = cache.bytecode_cache
+    jinja2_env = jinja2.Environment(
+        loader=jinja2.FunctionLoader(sources.get),
+        bytecode_cache=bytecode_cache,
+        **JINJA_OPTIONS)
+
+    def render(item):
+        fname, info = item
+        key = None
+        if cache is not None:
+            dependencies = template_dependencies(jinja2_env, sources, fname)
+            if dependencies is not None:
+                key = cache.output_key(dependencies, info['secrets'])
+                text = cache.get(key)
+                if text is not None:
+                    return fname, text
+        try:
+            t = jinja2_env.get_template(fname)
+        except Exception as ex:
+            warn("Error processing template '{0}'.".format(fname))
+            raise
+        text = t.render(info['secrets'])
+        if key is not None:
+            cache.put(key, text)
+        return fname, text
 
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(render, items):
+            yield result
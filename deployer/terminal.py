@@ -1,5 +1,6 @@
 
 import sys
+import threading
 
 def warn(msg):
     """
@@ -7,3 +8,52 @@ def warn(msg):
     """
     print("[WARN] {}".format(msg), file=sys.stderr)
 
+class RoutedStream(object):
+    """
+    A file-like object that stands in for `sys.stdout` or `sys.stderr`.
+    Writes made from a thread that has a capture buffer registered go to
+    that buffer.  All other writes go to the wrapped stream.
+    """
+    def __init__(self, stream, local):
+        self.stream = stream
+        self._local = local
+
+    def write(self, s):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(s)
+        return buffer.write(s)
+
+    def flush(self):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+_local = threading.local()
+
+def install_output_router():
+    """
+    Replace `sys.stdout` and `sys.stderr` with routed streams so that
+    worker threads can capture their own output.
+    Returns the original (stdout, stderr) pair.
+    """
+    original = (sys.stdout, sys.stderr)
+    sys.stdout = RoutedStream(sys.stdout, _local)
+    sys.stderr = RoutedStream(sys.stderr, _local)
+    return original
+
+def restore_output(original):
+    """
+    Restore the streams returned by `install_output_router()`.
+    """
+    sys.stdout, sys.stderr = original
+
+def capture_thread_output(buffer):
+    """
+    Route output written by the current thread to `buffer`.
+    Pass None to stop capturing.
+    """
+    _local.buffer = buffer